@@ -1,9 +1,13 @@
-from flask import Flask, request
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
+import hashlib
+import json
 import math
 import numpy as np
+import os
 import sys
 import socket
+import threading
 from functools import reduce
 import pathlib
 
@@ -13,72 +17,124 @@ from libstrava import KDTree
 from libstrava import gradient_decend, representative_subgraph, embed, \
                                 embedding_loss, random_init, edges_as_points
 from libstrava import gradient_decend, regularized_loss, random_init
-from libstrava import get_subgraph, graph_from_edges
+from libstrava import get_subgraph, iter_subgraph, graph_from_edges
+from libstrava import get_map_context, MapContext, DrawPool
+from libstrava.map_context import edges_version
+from libstrava.draw_pool import usable_cores
+from libstrava import JobQueue, QueueFull, JobQueueClient, serve_job_queue
+from libstrava import ResultCache, result_key
+from libstrava import read_in_data_new_api, write_edge_list, write_points, \
+                      unpack_drawing, drawing_from_json, pack_edges, edges_to_json, as_point_lists
+from libstrava import optimize
 
 root = str(pathlib.Path(__file__).parent.parent)
+MAP_FILE = f"{root}/data/edge_list.txt"
+MAPS = {"college-hill": MAP_FILE} # maps v1 clients can refer to by name
+OPTIMIZE_STARTS = 16
+OPTIMIZE_BUDGET = 5 # seconds
+SERVER_WORKERS = 1 # server processes sharing the cores, set by serve.py before it forks them
+DRAW_PROCESSES = None # workers drawing v2 segments per server process, defaults to its share of the cores, at most all of them
+DRAW_CANDIDATES = 16 # random embeddings v2 tries per drawing, keeping the best drawn one
+DRAW_BUDGET = 2 # seconds v2 may spend drawing candidates
+LOCAL_SEARCH_BUDGET = 1 # seconds v2 spends improving the best candidate afterwards
+LOCAL_SEARCH_MOVES = 1000 # moves v2's local search proposes instead, for a seeded drawing
+JOB_PROCESSES = None # workers running queued drawings, defaults to one per core
+MAX_PENDING_JOBS = 64 # queued drawings past this, server-wide, are refused with a 503
+JOB_RETRY_AFTER = 5 # seconds a refused client is told to wait
+JOB_KEEPALIVE = 15 # seconds between keep-alive comments while a job stream waits
+RESULT_CACHE_SIZE = 1024 # v1/v2 responses cached in memory
+RESULT_CACHE_DIR = None # a directory to also cache responses on disk in, shared by every process
+RESULT_CACHE_BYTES = 256 * 1024 * 1024 # size of the disk cache
 
 buffer = ""
 app = Flask(__name__)
 CORS(app)
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_DIR, RESULT_CACHE_BYTES)
 
 """
 Reads from stdin a point, graph, and parameter bundle
 Returns (points, graph, parameters)
 Points is a list of points, which are pairs of ints in draw-box coords
-Graph is a list of edges, where each edge is a pair of points
+Graph is a MapContext. On the wire it is either a list of edges, where each edge
+is a pair of points, or a single `map <name>` line naming one of MAPS, in which
+case the server's preloaded graph and indexes are used. An empty edge list is
+refused unless graph_required is False, when it reads as None
 x, y are the gps coords of the box's top-left corner
 theta is the angle of roation (counter-clockwise)
 r is the GPS degrees spanned by bottom of box to top
 gamma is a stretch factor - gamma*r is the span left-to-right of the box
 """
-def read_in_data_old_api(lines):
-    # get points
+def read_in_data_old_api(lines, graph_required=True):
+    points = read_points(lines)
+    graph = read_graph(lines, graph_required)
+
+    # get params
+    x = float(next(lines))
+    y = float(next(lines))
+    theta = float(next(lines))
+    r = float(next(lines))
+    gamma = float(next(lines))
+
+    return points, graph, (x, y, theta, r, gamma)
+
+"""Reads a point count, then that many `x y` lines"""
+def read_points(lines):
     num_points = int(next(lines))
     points = []
     for _ in range(num_points):
         x, y = next(lines).split()
         x, y = float(x), float(y)
         points.append((x, y))
+    return points
+
+"""
+A graph sent inline with a v1 request. Its version is hashed from the edges as
+read, so the result cache can be checked without indexing them; everything else
+is the MapContext's, built on first use - that is, only on a cache miss
+"""
+class InlineGraph:
+    def __init__(self, edges):
+        self.version = edges_version(edges)
+        self.__edges = edges
+        self.__context = None
+
+    def __getattr__(self, name):
+        if self.__context is None:
+            self.__context = MapContext(self.__edges)
+        return getattr(self.__context, name)
+
+"""
+Reads the graph section of a v1 request, see read_in_data_old_api: the shared
+MapContext of a named map, or an InlineGraph
+"""
+def read_graph(lines, required=True):
+    line = next(lines)
+    if line.startswith("map "):
+        name = line.split(maxsplit=1)[1]
+        if name not in MAPS:
+            raise ValueError(f"`{name}` is not a known map")
+        return get_map_context(MAPS[name])
 
-    # get edges
-    num_edges = int(next(lines))
+    num_edges = int(line)
     edges = []
     for _ in range(num_edges):
         x1, y1, x2, y2 = next(lines).split()
         x1, y1, x2, y2 = float(x1), float(y1), float(x2), float(y2)
         edges.append(((x1, y1), (x2, y2)))
+    if not edges:
+        if required:
+            raise ValueError("empty graph")
+        return None
+    return InlineGraph(edges)
 
-    # get params
-    x = float(next(lines))
-    y = float(next(lines))
-    theta = float(next(lines))
-    r = float(next(lines))
-    gamma = float(next(lines))
-
-    return points, edges, (x, y, theta, r, gamma)
-
-"""
-Reads in a drawing, which will be turned into a list of lists of points,
-where each inner list represents a path the user drew. The drawing data
-itself looks like a series of inner list strings, where each inner list
-string is the length n of the list on a line, then x y on the next n lines
-
-Returns the list of paths
-"""
-def read_in_data_new_api(lines) -> list[list[tuple[float, float]]]:
-    paths = []
-    while True:
-        try:
-            path_len = int(next(lines))
-        except StopIteration:
-            break
-        path = []
-        paths.append(path)
-        for _ in range(path_len):
-            x, y = next(lines).split()
-            point = float(x), float(y)
-            path.append(point)
-    return paths
+"""Reads any remaining `key value` lines into a dict of strings"""
+def read_options(lines):
+    options = {}
+    for line in lines:
+        if line.strip():
+            key, value = line.split(maxsplit=1)
+            options[key] = value
+    return options
 
 """writes a parameter bundle to stdout"""
 def write_param_bundle(parameters):
@@ -87,42 +143,74 @@ def write_param_bundle(parameters):
 
 """Interface wrapper for gradient_decend"""
 def GD_iter(points, graph, parameters):
-    improved_bundle = gradient_decend(points, graph, parameters)
+    improved_bundle = gradient_decend(points, graph.edges, parameters, graph.edge_index)
     return write_param_bundle(improved_bundle)
 
-"""Writes a list of edges (aka a subgraph) to stdout"""
-def write_edge_list(edges):
-    string = f"{len(edges)}\n"
-    for edge in edges:
-        (a, b), (c, d) = edge
-        string += f"{a} {b} {c} {d}\n"
-    return string
+"""
+Interface wrapper for optimize. Reads points and a graph, then optional
+`starts n`, `seed n` and `budget seconds` lines. A seeded call runs every start
+to convergence or its step limit, ignoring the budget, so that it is repeatable
+and can be cached.
+Returns the best parameter bundle, then its subgraph as an edge list, then the
+number of starts followed by each start's loss curve on its own line
+"""
+def optimize_embedding(lines):
+    points = read_points(lines)
+    graph = read_graph(lines)
+    options = read_options(lines)
+
+    seeded = "seed" in options
+    budget = None if seeded else float(options.get("budget", OPTIMIZE_BUDGET))
+    def run():
+        parameters, subg, curves = optimize(points, graph.edges,
+                                            starts=int(options.get("starts", OPTIMIZE_STARTS)),
+                                            time_budget=budget,
+                                            seed=int(options["seed"]) if seeded else None,
+                                            graph_index=graph.edge_index,
+                                            pool=worker_pools()[0])
+        curves_string = f"{len(curves)}\n" + "".join(" ".join(map(str, curve)) + "\n" for curve in curves)
+        return write_param_bundle(parameters) + write_edge_list(subg) + curves_string
+
+    if not seeded:
+        return run()
+    options.pop("budget", None) # it doesn't change a seeded result
+    return cached(run, "optimize", points, map_version(graph), options)
 
 """Interface wrapper for representative_subgraph"""
 def subgraph(points, graph, parameters):
-    subg = representative_subgraph(points, graph, parameters)
+    subg = representative_subgraph(points, graph.edges, parameters, graph.edge_index)
     return write_edge_list(subg)
 
-def subgraph_new_api(paths):
-    graph = graph_from_edges(read_edges(f"{root}/data/edge_list.txt"))
-    points_tree = KDTree(list(graph.keys()))
-    
-    return get_subgraph(graph, points_tree, paths)
+"""
+get_subgraph with v2's settings. An unseeded drawing gets DRAW_BUDGET and
+LOCAL_SEARCH_BUDGET seconds, a seeded one every shortlisted candidate and
+LOCAL_SEARCH_MOVES moves instead, so that it depends on the seed alone and can
+be cached
+"""
+def subgraph_new_api(paths, seed=None):
+    context = get_map_context(MAP_FILE)
+    draw_pool, _ = worker_pools()
+    if seed is None:
+        return get_subgraph(context, context.vertex_tree, paths, pool=draw_pool,
+                            candidates=DRAW_CANDIDATES, time_budget=DRAW_BUDGET,
+                            local_search_budget=LOCAL_SEARCH_BUDGET)
+    return get_subgraph(context, context.vertex_tree, paths, pool=draw_pool, candidates=DRAW_CANDIDATES,
+                        local_search_moves=LOCAL_SEARCH_MOVES, seed=seed)
 
 """
 interface wrapper for regularized_loss
 NOTE: Edges passed should JUST BE THE SUBGRAPH, NOT THE WHOLE GRAPH
 """
 def loss(points, graph, parameters):
-    return str(embedding_loss(points, graph, parameters))
+    return str(embedding_loss(points, graph.edges, parameters, graph.edge_index))
     # samples_to_parents = {}
     # subgraph_points = edges_as_points(subgraph, samples_to_parents)
     # subgraph_tree = KDTree(subgraph_points)
     # return str(regularized_loss(points, subgraph_tree, samples_to_parents))
 
-"""Interface wrapper for random_init"""
-def get_init():
-    params = random_init()
+"""Interface wrapper for random_init, seeded with seed if it isn't None"""
+def get_init(seed=None):
+    params = random_init(np.random if seed is None else np.random.default_rng(seed))
     return write_param_bundle(params)
 
 """Transposes each point - sends (a, b) to (b, a)"""
@@ -138,13 +226,21 @@ def embed_points(points, _, parameters):
     points = embed(points, parameters)
     return write_points(points)
 
-"""Converts a set of points to a string to print"""
-def write_points(points):
-    string = f"{len(points)}\n"
-    for point in points:
-        x, y = point
-        string += f"{x} {y}\n"
-    return string
+"""
+compute(), or the result it gave before for the same request. key_parts make
+up the request, parsed: which call, the drawing or points, the map version,
+parameters and seed. Only deterministic calls, or seeded ones, may be cached
+"""
+def cached(compute, *key_parts) -> str:
+    return result_cache.get_or_compute(result_key(*key_parts), compute)
+
+"""The version of a request's map for result keys, None for a request without one"""
+def map_version(graph):
+    return None if graph is None else graph.version
+
+"""v1 calls taking a point, graph, and parameter bundle, see read_in_data_old_api"""
+OLD_API_CALLS = {"GD_iter": GD_iter, "subgraph": subgraph, "loss": loss, "embed_points": embed_points}
+GRAPHLESS_CALLS = {"embed_points"} # v1 calls ignoring their graph, which the website sends empty
 
 def getline() -> str:
     global buffer
@@ -170,29 +266,252 @@ def api_v1():
     lines = iter(string.splitlines())
     call = next(lines)
 
-    if call == "GD_iter":
-        return GD_iter(*read_in_data_old_api(lines))
-    elif call == "subgraph":
-        return subgraph(*read_in_data_old_api(lines))
-    elif call == "loss":
-        return loss(*read_in_data_old_api(lines))
-    elif call == "get_init":
-        return get_init()
-    elif call == "embed_points":
-        return embed_points(*read_in_data_old_api(lines))
-    else:
-        print(f"[-] Error: {call} is not a recognized function call", file=sys.stderr)
-        return f"bad request: `{call}` must be GD_iter/subgraph/loss/get_init"
+    try:
+        if call in OLD_API_CALLS:
+            points, graph, parameters = read_in_data_old_api(lines, call not in GRAPHLESS_CALLS)
+            return cached(lambda: OLD_API_CALLS[call](points, graph, parameters),
+                          call, points, map_version(graph), parameters)
+        elif call == "get_init":
+            # `seed n` makes it repeatable, and so cacheable
+            seed = read_options(lines).get("seed")
+            if seed is None:
+                return get_init()
+            return cached(lambda: get_init(int(seed)), call, int(seed))
+        elif call == "optimize":
+            return optimize_embedding(lines)
+        else:
+            print(f"[-] Error: {call} is not a recognized function call", file=sys.stderr)
+            return f"bad request: `{call}` must be GD_iter/subgraph/loss/get_init/optimize"
+    except ValueError as e:
+        print(f"[-] Error: {e}", file=sys.stderr)
+        return f"bad request: {e}"
 
+"""
+Draws a route. Takes the drawing in full_data, and optionally a seed, which
+makes the route repeatable and so lets it be cached
+"""
 @app.route('/api/v2', methods=['POST'])
 def api_v2():
     string = request.form['full_data']
     list_of_lists = read_in_data_new_api(iter(string.splitlines()))
-    list_of_edges = subgraph_new_api(list_of_lists)
-    print("list of edges (hopefully):", list_of_edges)
-    return write_edge_list(list_of_edges)
+    seed = request.form.get('seed', type=int)
+
+    def run():
+        list_of_edges = subgraph_new_api(list_of_lists, seed)
+        print("list of edges (hopefully):", list_of_edges)
+        return write_edge_list(list_of_edges)
+
+    if seed is None:
+        return run()
+    return cached(run, "v2", list_of_lists, get_map_context(MAP_FILE).version, seed)
+
+"""
+Draws a route, like v2, in one of the compact formats of libstrava.wire: a
+packed drawing (application/octet-stream) is answered with a packed route in
+the same float precision, a JSON one (application/json) with a JSON route.
+An optional `seed` query parameter is as for v2.
+"""
+@app.route('/api/v3', methods=['POST'])
+def api_v3():
+    try:
+        if request.mimetype == "application/json":
+            paths, code = drawing_from_json(request.get_json(silent=True)), None
+        else:
+            paths, code = unpack_drawing(request.get_data())
+    except ValueError as e:
+        print(f"[-] Error: {e}", file=sys.stderr)
+        return f"bad request: {e}", 400
+
+    edges = subgraph_new_api(as_point_lists(paths), request.args.get('seed', type=int))
+    if code is None:
+        return Response(edges_to_json(edges), mimetype="application/json")
+    return Response(pack_edges(edges, code), mimetype="application/octet-stream")
+
+"""One server-sent event, with its payload as JSON"""
+def server_sent_event(kind, payload) -> str:
+    return f"event: {kind}\ndata: {json.dumps(payload)}\n\n"
+
+"""
+Streaming version of v2, as server-sent events. Takes the same drawing, then
+sends `glue` and `segmentize` progress events, a `segment` event with each
+segment's edges (a list of [x1, y1, x2, y2]) of a provisional route as soon as
+it is drawn, a `replace` event with all the edges of the route v2 would draw,
+to show instead, and a final `done` event with its number of edges. A client
+that disconnects stops the drawing at the next segment.
+"""
+@app.route('/api/v2/stream', methods=['POST'])
+def api_v2_stream():
+    string = request.form['full_data']
+    list_of_lists = read_in_data_new_api(iter(string.splitlines()))
+    context = get_map_context(MAP_FILE)
+    draw_pool, _ = worker_pools()
+
+    def events():
+        total = 0
+        try:
+            for kind, payload in iter_subgraph(context, context.vertex_tree, list_of_lists, pool=draw_pool,
+                                               candidates=DRAW_CANDIDATES, time_budget=DRAW_BUDGET,
+                                               local_search_budget=LOCAL_SEARCH_BUDGET):
+                if kind in ("segment", "replace"):
+                    payload = [[a, b, c, d] for (a, b), (c, d) in payload]
+                if kind == "replace":
+                    total = len(payload)
+                yield server_sent_event(kind, payload)
+        except GeneratorExit:
+            print("[-] stream closed by client", file=sys.stderr)
+            raise
+        yield server_sent_event("done", total)
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+"""
+A queued drawing, run in a job worker. Workers draw in-process on the map they
+were forked with (reloading it if the file changed), since they can't use the
+parent's draw pool. Returns the edges as a list of [x1, y1, x2, y2]
+"""
+def draw_job(paths):
+    context = get_map_context(MAP_FILE)
+    edges = get_subgraph(context, context.vertex_tree, paths, candidates=DRAW_CANDIDATES,
+                         time_budget=DRAW_BUDGET, local_search_budget=LOCAL_SEARCH_BUDGET)
+    return [[a, b, c, d] for (a, b), (c, d) in edges]
+
+"""The content key of a drawing: identical drawings share it, so their jobs coalesce"""
+def drawing_key(paths) -> str:
+    return hashlib.sha256(json.dumps(paths).encode()).hexdigest()
+
+"""A job's state as JSON: its id and status, then its edges once done or its error once failed"""
+def job_json(job) -> dict:
+    body = {"id": job.id, "status": job.status}
+    if body["status"] == "done":
+        body["edges"] = job.result
+    elif body["status"] == "failed":
+        body["error"] = job.error
+    return body
+
+"""
+Queues a v2 drawing (same form as /api/v2) and answers 202 with the job's id
+and status straight away. A drawing identical to one already pending or
+recently finished gets that job back. When too many jobs are pending the
+drawing is refused with a 503 and a Retry-After header.
+"""
+@app.route('/api/jobs', methods=['POST'])
+def api_submit_job():
+    string = request.form['full_data']
+    list_of_lists = read_in_data_new_api(iter(string.splitlines()))
+    _, job_queue = worker_pools()
+    try:
+        job = job_queue.submit(drawing_key(list_of_lists), list_of_lists)
+    except QueueFull as e:
+        print(f"[-] Error: job refused, {e}", file=sys.stderr)
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(JOB_RETRY_AFTER)}
+    return jsonify(job_json(job)), 202
+
+"""Polls a job, see job_json. 404 if there is no such job (or it was long since forgotten)"""
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def api_poll_job(job_id):
+    _, job_queue = worker_pools()
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": f"no job `{job_id}`"}), 404
+    return jsonify(job_json(job))
+
+"""
+Waits on a job as server-sent events: a `status` event straight away, keep-alive
+comments while it runs, then a `done` event with its edges or an `error` event
+"""
+@app.route('/api/jobs/<job_id>/stream', methods=['GET'])
+def api_stream_job(job_id):
+    _, job_queue = worker_pools()
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": f"no job `{job_id}`"}), 404
+
+    def events():
+        yield server_sent_event("status", job.status)
+        while not job.wait(JOB_KEEPALIVE):
+            yield ": keep-alive\n\n"
+        if job.status == "done":
+            yield server_sent_event("done", job.result)
+        else:
+            yield server_sent_event("error", job.error)
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+"""
+Counters for monitoring: the loaded map, how well its path and result caches
+are doing, and the job queue - null if this process hasn't started it yet, as
+asking for stats shouldn't start worker processes
+"""
+@app.route('/api/stats', methods=['GET'])
+def api_stats():
+    context = get_map_context(MAP_FILE, watch=False)
+    with pools_lock:
+        started = pools is not None and pools[0] == os.getpid()
+        jobs = pools[2] if started else None
+    return jsonify({"map": {"source": context.source,
+                            "vertices": int(context.csr.num_vertices),
+                            "edges": len(context.edge_index)},
+                    "path_cache": context.path_cache.stats(),
+                    "result_cache": result_cache.stats(),
+                    "jobs": None if jobs is None else jobs.stats()})
+
+"""this process's (pid, DrawPool, JobQueue or JobQueueClient), see worker_pools"""
+pools = None
+pools_lock = threading.Lock()
+"""the manager of the job queue every server worker shares, see start_job_server"""
+job_server = None
+
+"""
+Starts the one job queue all server workers share, in a process of its own.
+serve.py calls it in the master, before it forks the workers
+"""
+def start_job_server():
+    global job_server
+    job_server = serve_job_queue(draw_job, JOB_PROCESSES, MAX_PENDING_JOBS)
+
+def stop_job_server():
+    global job_server
+    if job_server is not None:
+        job_server.shutdown()
+        job_server = None
+
+"""
+This process's DrawPool and job queue, started on first use. Pools don't carry
+over a fork, so a server worker forked off this module (see serve.py) starts
+its own DrawPool, forking its workers off the map it inherited, with its share
+of the cores. The job queue is the shared one if start_job_server was called,
+else one of this process's own.
+"""
+def worker_pools() -> tuple[DrawPool, JobQueue]:
+    global pools
+    with pools_lock:
+        if pools is None or pools[0] != os.getpid():
+            # more workers than cores only adds round trips: on one core a pool of 2
+            # draws at half the speed of drawing in-process, which a pool of 1 does
+            draw_processes = min(DRAW_PROCESSES or usable_cores() // SERVER_WORKERS, usable_cores()) or 1
+            if job_server is not None:
+                job_queue = JobQueueClient(job_server.address)
+            else:
+                job_queue = JobQueue(draw_job, JOB_PROCESSES, MAX_PENDING_JOBS)
+            pools = (os.getpid(), DrawPool(get_map_context(MAP_FILE), draw_processes), job_queue)
+        return pools[1:]
+
+"""Shuts down this process's DrawPool and JobQueue, if it started them, e.g. as a server worker exits"""
+def stop_pools():
+    global pools
+    with pools_lock:
+        if pools is not None and pools[0] == os.getpid():
+            pools[1].close()
+            pools[2].shutdown()
+        pools = None
+
+# load the map up front so no request pays for it, and every process forked from here shares it
+get_map_context(MAP_FILE).router # built before forking so no worker has to build its own
 
 if __name__ == "__main__":
+    worker_pools() # forked before the server starts any threads
     cert_files = ('/etc/letsencrypt/live/sky.jason.cash/fullchain.pem', '/etc/letsencrypt/live/sky.jason.cash/privkey.pem')
     app.run(ssl_context=cert_files, host="0.0.0.0", port=8080)
 
@@ -0,0 +1,67 @@
+"""
+Benchmarks drawing a batch of segments on the college-hill map in-process
+against a DrawPool of growing size, up to one worker per core (and at least 2,
+as a pool of 1 draws in-process), and checks both draw the same paths.
+Segments run between random nearby map vertices through a jittered midpoint,
+like the segments of an embedded drawing, and every timed batch is a fresh one
+on an empty PathCache so nothing is served from cache.
+Run from src/ with `python -m benchmarks.draw_pool`
+"""
+import os
+import pathlib
+import time
+
+import numpy as np
+
+from libstrava import get_map_context, DrawPool
+from libstrava.segment import Segment, draw_uncached
+
+root = str(pathlib.Path(__file__).parent.parent.parent)
+MAP_FILE = f"{root}/data/edge_list.txt"
+SEGMENTS = 64 # per batch, a large drawing's worth
+REPEATS = 3 # batches per configuration
+SPAN = 0.004 # degrees between a segment's ends, at most
+
+"""count segments between random vertices at most SPAN apart, bending through a jittered midpoint"""
+def fake_segments(rng, context, count):
+    coords = context.csr.coords
+    starts = rng.integers(0, len(coords), count)
+    segments = []
+    for start in starts.tolist():
+        candidates = np.flatnonzero(np.linalg.norm(coords - coords[start], axis=1) <= SPAN)
+        end = int(rng.choice(candidates))
+        middle = (coords[start] + coords[end]) / 2 + rng.normal(0, SPAN / 4, 2)
+        segments.append(Segment([tuple(coords[start].tolist()), tuple(middle.tolist()), tuple(coords[end].tolist())]))
+    return segments
+
+"""Mean ms per batch drawing each of batches with draw, on an empty cache each time"""
+def timed(context, draw, batches):
+    drawn, total = [], 0.0
+    for segments in batches:
+        context.path_cache.clear()
+        start = time.perf_counter()
+        drawn.append(draw(segments))
+        total += time.perf_counter() - start
+    return drawn, total * 1000 / len(batches)
+
+def main():
+    context = get_map_context(MAP_FILE)
+    context.router
+    context.csr.arc_directions()
+    cores = os.cpu_count() or 1
+    print(f"{REPEATS} batches of {SEGMENTS} segments, {cores} cores")
+
+    for processes in sorted({2, 4, cores} & set(range(2, max(cores, 2) + 1))):
+        batches = [fake_segments(np.random.default_rng(seed), context, SEGMENTS) for seed in range(REPEATS)]
+        serial, serial_ms = timed(context, lambda segments: draw_uncached(segments, context), batches)
+        batches = [fake_segments(np.random.default_rng(seed), context, SEGMENTS) for seed in range(REPEATS)]
+        context.path_cache.clear()
+        pool = DrawPool(context, processes)
+        pooled, pooled_ms = timed(context, lambda segments: pool.draw(segments, context), batches)
+        pool.close()
+        assert pooled == serial, "the pool drew different paths"
+        print(f"    {processes} workers   in-process {serial_ms:8.1f} ms   pool {pooled_ms:8.1f} ms"
+              f"   speedup {serial_ms / pooled_ms:5.2f}x")
+
+if __name__ == "__main__":
+    main()
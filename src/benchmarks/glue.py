@@ -0,0 +1,292 @@
+"""
+Benchmarks the single-index glue against the original per-path-pair glue on
+synthetic drawings, and checks what they glue.
+
+The original glue raises ValueError on larger drawings (its do_the_glue splits
+an edge an earlier glue already split, see legacy_do_the_glue), so the two are
+compared on the pairs of points each decides to glue, which is also where all
+the time goes; the glued graphs are compared up to LEGACY_GRAPH_MAX points.
+
+The pairs differ in one way. Two pairs are clones when walking from one to the
+other stays within GLUE_THRESH; the original only walked from the pair later in
+its set's order to the earlier one, the new glue walks both ways. The smallest
+case: with T = GLUE_THRESH, one stroke at x = 0, 1.5T, 3T and another 0.5T
+above it at x = 1.5T, 2.5T, 3.5T are close at pairs (1, 0), (2, 1) and (2, 2).
+The walk from (1, 0) to (2, 2) goes through (2, 1), which is close, the walk
+back goes through (1, 1), which isn't. So the original glues the strokes at
+(1, 0) and again at (2, 2), or only once, depending on set order; the new glue
+always glues them once, at (1, 0). main checks every difference is such a
+one-way clone.
+
+A closed stroke, one ending on its first point, must come out as a loop.
+
+Run from src/ with `python -m benchmarks.glue`
+"""
+import numpy as np
+import time
+
+from libstrava.kd_tree import KDTree
+from libstrava.fast_gradient_decent import point_point_dist
+from libstrava.graphs import glue, find_intersections, GLUE_THRESH
+
+SIZES = [10, 100, 500, 1000, 2000, 5000] # total points per drawing
+STROKE_LENGTH = 50 # points per stroke, at most
+LEGACY_MAX = 2000 # the original gets slow past this
+LEGACY_GRAPH_MAX = 500 # and its do_the_glue raises ValueError on these drawings past this
+
+"""The original glue and its helpers, kept here as the baseline"""
+def legacy_glue(paths):
+    glued_graph = {}
+
+    # add intra-path connections
+    for path in paths:
+        last_index = len(path) - 1
+        for i, point in enumerate(path):
+            # initialize neighbors list
+            glued_graph[point] = []
+
+            # add neighbors, keeping edge cases in mind
+            if i != 0:
+                glued_graph[point].append(path[i-1])
+            if i != last_index:
+                glued_graph[point].append(path[i+1])
+
+    # glue
+    for i, j, con_i, con_j in legacy_intersections(paths):
+        legacy_do_the_glue(glued_graph, paths[i], paths[j], con_i, con_j)
+    
+    return glued_graph
+
+"""The original glue's (path1, path2, i, j) pairs to glue, like find_intersections, in the order it glued them"""
+def legacy_intersections(paths):
+    kdtrees = list(map(lambda x: KDTree(x), paths))
+    points_to_indices = []
+    for path in paths:
+        path_dict = {}
+        points_to_indices.append(path_dict)
+        for i, point in enumerate(path):
+            path_dict[point] = i
+
+    pairs = []
+    for i in range(len(paths)):
+        for j in range(i, len(paths)):
+            connections = legacy_find_intersections(paths[i], paths[j], kdtrees[j], points_to_indices[j])
+            if i == j:
+                # removes (i, i) and one of (i, j) and (j, i)
+                connections = remove_self_matches(connections)
+            pairs.extend((i, j, con_i, con_j) for con_i, con_j in connections)
+    return pairs
+
+"""
+Glues paths 1 and 2 together using the points at indices i and j
+Mutates graph. Returns nothing.
+"""
+def legacy_do_the_glue(graph, path1, path2, i, j):
+    p1 = path1[i]
+    p2 = path2[j]
+
+    # if i or j is endpoint of path, just connect it onto other path
+    if i*j == 0 or i == len(path1) - 1 or j == len(path2) - 1:
+        graph[p1].append(p2)
+        graph[p2].append(p1)
+    else: # stick i in between j and its neighbor
+        neighbor = path2[j-1]
+        graph[neighbor].remove(p2)
+        graph[neighbor].append(p1)
+        graph[p2].remove(neighbor)
+        graph[p2].append(p1)
+        graph[p1].append(p2)
+        graph[p1].append(neighbor)
+
+"""Returns a list of pairs of indices at which some gluing should occur"""                
+def legacy_find_intersections(path1, path2, path2KDtree : KDTree, point2index : dict):
+    intersections = []
+
+    # add every pair within thresh
+    for i, p1 in enumerate(path1):
+        matches = path2KDtree.query_radius(p1, GLUE_THRESH)
+        for match in matches:
+            intersections.append((i, j := point2index[tuple(match)]))
+    
+    # replace them all with their corresponding local minima and remove dupes
+    intersections = list(set(map(lambda intrscn: local_min_match(path1, path2, intrscn[0], intrscn[1]), intersections)))
+
+    # remove inferior clones
+    while remove_clone(path1, path2, intersections): # remove_clone returns true when it removes a clone, false when none left
+        pass
+
+    return intersections
+
+"""Given a pair of paths and indices into them, decends to a local optimum, where closer is more optimal"""
+def local_min_match(path1, path2, index1, index2):
+    def local_min_rec(i, j):
+        cur_dist = point_point_dist(path1[i], path2[j])
+        if i != len(path1) - 1 and \
+                point_point_dist(path1[i + 1], path2[j]) < cur_dist:
+            local_min_rec(i + 1, j)
+        if i != 0 and \
+                point_point_dist(path1[i - 1], path2[j]) < cur_dist:
+            local_min_rec(i - 1, j)
+        if j != len(path2) - 1 and \
+                point_point_dist(path1[i], path2[j + 1]) < cur_dist:
+            local_min_rec(i, j + 1)
+        if j != 0 and \
+                point_point_dist(path1[i], path2[j - 1]) < cur_dist:
+            local_min_rec(i, j - 1)
+
+        return i, j
+    
+    return local_min_rec(index1, index2)
+
+"""
+Searches pairwise until it finds a clone. Removes the worse clone and returns true.
+If no clone is found after searching all pairs, returns false.
+NOTE: The main behavior of this function is to MUTATE the passed intersections list,
+not return a slightly different copy
+
+Params:
+    path1, path2 - the two paths we're trying to glue together
+    intersections - a list of intersections (2tuples of indices) to remove clones from
+Returns:
+    a boolean - true if clone removed, false if no clones found
+"""
+def remove_clone(path1, path2, intersections):
+    for i, intersection1 in enumerate(intersections):
+        for intersection2 in intersections[i+1:]:
+            if clones(path1, path2, intersection1, intersection2):
+                if first_intersection_better(path1, path2, intersection1, intersection2):
+                    intersections.remove(intersection2)
+                else:
+                    intersections.remove(intersection1)
+                return True
+    return False
+
+"""
+Determines whether 2 pairs of points are "clones" in the sense that you can
+obtain one from the other by incrementing indices without ever making the distance
+larger than GLUE_THRESH
+
+NOTE: The correctness of this implementation relies on convexity of clone blobs,
+which may not be valid. Even if wrong in certain pathalogical cases, should be good
+enough
+
+Params:
+    path1, path2 - the two paths on which the pairs lie
+    intersection1 - tuple of indices into each path of the first pair
+    intersection2 - same as intersection1 but second pair
+Returns:
+    boolean - true if clones, false if distinct
+"""
+def clones(path1, path2, intersection1 : tuple[int, int], intersection2 : tuple[int, int]):
+    i1, j1 = intersection1
+    i2, j2 = intersection2
+
+    assert(i1 >= 0 and i1 < len(path1))
+    assert(i2 >= 0 and i2 < len(path1))
+    assert(j1 >= 0 and j1 < len(path2))
+    assert(j2 >= 0 and j2 < len(path2))
+
+    while True:
+        if i2 > i1:
+            iinc = -1
+        elif i2 == i1:
+            iinc = 0
+        else:
+            iinc = 1
+
+        if j2 > j1:
+            jinc = -1
+        elif j2 == j1:
+            jinc = 0
+        else:
+            jinc = 1
+
+        new_i = i2 + iinc
+        new_j = j2 + jinc
+
+        if new_i == i1 and new_j == j1:
+            return True
+        if point_point_dist(path1[new_i], path2[new_j]) > GLUE_THRESH:
+            return False
+        
+        i2, j2 = new_i, new_j
+
+"""Exactly what it sounds like. Returns true if left has closer dist, else false"""
+def first_intersection_better(path1, path2, intersection1, intersection2):
+    i1p1, i1p2 = path1[intersection1[0]], path2[intersection1[1]]
+    i2p1, i2p2 = path1[intersection2[0]], path2[intersection2[1]]
+    i1_dist = point_point_dist(i1p1, i1p2)
+    i2_dist = point_point_dist(i2p1, i2p2)
+    return i1_dist < i2_dist
+
+"""given a list of intersections, removes trivial ones and repeats"""
+def remove_self_matches(intersections):
+    i = 0
+    while i < len(intersections):
+        if intersections[i][0] == intersections[i][1]:
+            intersections.pop(i)
+        else:
+            i += 1
+
+    return list(set(sorted(intersections)))
+
+"""
+A drawing of random wandering strokes over the unit square, about n points in
+total. Consecutive points are a bit more than GLUE_THRESH apart, like a
+resampled mouse stroke
+"""
+def fake_drawing(rng, n):
+    paths = []
+    while n > 0:
+        length = min(n, int(rng.integers(2, STROKE_LENGTH + 1)))
+        heading = rng.uniform(0, 2 * np.pi) + np.cumsum(rng.normal(0, 0.3, length))
+        steps = 1.5 * GLUE_THRESH * np.stack((np.cos(heading), np.sin(heading)), axis=1)
+        path = rng.random(2) + np.cumsum(steps, axis=0)
+        paths.append(list(map(tuple, path.tolist())))
+        n -= length
+    return paths
+
+"""a graph with its neighbor lists sorted, so graphs glued in a different order compare equal"""
+def normalized(graph):
+    return {vertex: sorted(neighbors) for vertex, neighbors in graph.items()}
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, (time.perf_counter() - start) * 1000
+
+"""
+Whether pair, glued by only one of the glues, is a clone (walking either way)
+of a pair in the same blob that both glue
+"""
+def one_way_clone(paths, pair, shared):
+    path1, path2, i, j = pair
+    return any(clones(paths[path1], paths[path2], (i, j), (other_i, other_j)) or
+               clones(paths[path1], paths[path2], (other_i, other_j), (i, j))
+               for other1, other2, other_i, other_j in shared if (other1, other2) == (path1, path2))
+
+def main():
+    angles = np.linspace(0, 2 * np.pi, 30)
+    closed = [tuple(point) for point in (0.5 + 0.1 * np.stack((np.cos(angles), np.sin(angles)), axis=1)).tolist()]
+    closed[-1] = closed[0]
+    assert all(len(neighbors) == 2 for neighbors in glue([closed]).values()), "a closed stroke didn't glue into a loop"
+    print("closed stroke: glued into a loop")
+
+    rng = np.random.default_rng(0)
+    for n in SIZES:
+        paths = fake_drawing(rng, n)
+        new_pairs, new_ms = timed(lambda: sorted(find_intersections(paths)))
+        line = f"{n:5} points, {len(paths):3} strokes:   new {new_ms:9.2f} ms"
+        if n <= LEGACY_MAX:
+            old_pairs, old_ms = timed(lambda: sorted(legacy_intersections(paths)))
+            shared = set(new_pairs) & set(old_pairs)
+            differing = set(new_pairs) ^ set(old_pairs)
+            assert all(one_way_clone(paths, pair, shared) for pair in differing), "glues differ by more than one-way clones"
+            line += f"   old {old_ms:10.2f} ms   {len(new_pairs)} pairs, {len(differing)} one-way clones"
+            if n <= LEGACY_GRAPH_MAX:
+                assert normalized(glue(paths)) == normalized(legacy_glue(paths)), "same pairs glued differently"
+                line += ", same graph"
+        print(line)
+
+if __name__ == "__main__":
+    main()
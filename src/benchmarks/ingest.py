@@ -0,0 +1,77 @@
+"""
+Benchmarks building a map graph from GPS points, the hashed and tree-based
+griddy_edges against the original scans.
+Run from src/ with `python -m benchmarks.ingest`
+"""
+import numpy as np
+import pathlib
+import time
+
+from libstrava.edges import griddy_edges, find_closest_in_direction, already_included, DIRECTIONS
+from libstrava.points import remove_duplicate_points, read_gps
+
+root = str(pathlib.Path(__file__).parent.parent.parent)
+
+SIZES = [1000, 3000, 10000, 40000]
+LEGACY_MAX = 3000 # the originals are cubic, skip them past this
+
+"""The original quadratic dedup, kept here as the baseline"""
+def legacy_remove_duplicate_points(points):
+    unique_points = []
+    for point in points:
+        is_a_duplicate = False
+        nx, ny = point
+        for unique_point in unique_points:
+            ux, uy = unique_point
+            if nx == ux and ny == uy:
+                is_a_duplicate = True
+        if not is_a_duplicate:
+            unique_points.append(point)
+    return unique_points
+
+"""The original griddy_edges, kept here as the baseline"""
+def legacy_griddy_edges(points):
+    edges = []
+    for point in points:
+        for dir in DIRECTIONS:
+            closest = find_closest_in_direction(point, points, dir)
+            if closest is not None:
+                new_edge = tuple(sorted((point, closest)))
+                if not already_included(new_edge, edges):
+                    edges.append(new_edge)
+    return edges
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, (time.perf_counter() - start) * 1000
+
+"""GPS-like points scattered over the combined.txt area, with some exact repeats"""
+def fake_points(rng, n, low, high):
+    points = low + (high - low) * rng.random((n, 2))
+    points[rng.integers(0, n, n // 10)] = points[rng.integers(0, n, n // 10)]
+    return list(map(tuple, points.tolist()))
+
+def main():
+    rng = np.random.default_rng(0)
+    real = np.array(read_gps(f"{root}/data/combined.txt"))
+    low, high = real.min(axis=0), real.max(axis=0)
+
+    for n in SIZES:
+        points = fake_points(rng, n, low, high)
+        print(f"{n} points")
+        unique, new_ms = timed(lambda: remove_duplicate_points(points))
+        edges, edges_ms = timed(lambda: griddy_edges(unique))
+        if n <= LEGACY_MAX:
+            old_unique, old_ms = timed(lambda: legacy_remove_duplicate_points(points))
+            old_edges, old_edges_ms = timed(lambda: legacy_griddy_edges(old_unique))
+            assert old_unique == unique, "dedup disagrees"
+            assert old_edges == edges, "griddy_edges disagrees"
+            print(f"    dedup          old {old_ms:10.2f} ms   new {new_ms:9.2f} ms")
+            print(f"    griddy_edges   old {old_edges_ms:10.2f} ms   new {edges_ms:9.2f} ms")
+        else:
+            print(f"    dedup          new {new_ms:9.2f} ms")
+            print(f"    griddy_edges   new {edges_ms:9.2f} ms   ({len(edges)} edges)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Benchmarks the array-backed KDTree against the original linked-node tree.
+Run from src/ with `python -m benchmarks.kd_tree`
+"""
+import numpy as np
+import pathlib
+import time
+
+from libstrava import KDTree, read_gps, read_edges, edges_as_points
+
+root = str(pathlib.Path(__file__).parent.parent.parent)
+
+NUM_QUERIES = 5000
+
+"""The original linked-node tree, kept here as the baseline"""
+class NodeKDTree:
+    def __init__(self, points):
+        if isinstance(points, list):
+            points = np.array(points)
+        self.tree = self.build_tree(points)
+        
+    class Node:
+        def __init__(self, point, left, right):
+            self.point = point
+            self.left = left
+            self.right = right
+            
+    
+    def build_tree(self, points, depth=0):
+        if len(points) == 0:
+            return None
+        
+        axis = depth % 2
+        
+        sorted_points = points[points[:, axis].argsort()]
+        mid = len(points) // 2
+        
+        return self.Node(sorted_points[mid], 
+                          self.build_tree(sorted_points[:mid], depth + 1), 
+                          self.build_tree(sorted_points[mid+1:], depth + 1))
+        
+    """returns the closest point in the tree to point in logarithmic time"""
+    def closest_point(self, point) -> tuple[float]:
+        best_point = None
+        best_dist = np.inf
+        
+        def search(node, depth=0):
+            nonlocal best_point, best_dist
+            
+            if node is None:
+                return
+            
+            dist = np.linalg.norm(point - node.point)
+            
+            if dist < best_dist:
+                best_point = node.point
+                best_dist = dist
+            
+            axis = depth % 2
+            
+            if point[axis] < node.point[axis]:
+                search(node.left, depth + 1)
+                if point[axis] + best_dist >= node.point[axis]:
+                    search(node.right, depth + 1)
+            else:
+                search(node.right, depth + 1)
+                if point[axis] - best_dist <= node.point[axis]:
+                    search(node.left, depth + 1)
+            
+        search(self.tree)
+        return tuple(best_point)
+    
+    """
+    returns all points within radius of target. 
+    Worst-case linear but should be prtty good on average
+    It's also impossible to have an alg for this that has worst-case runtime
+    better than linear anyway so I'm happy with this
+    """
+    def query_radius(self, target, radius) -> list:
+        results = []
+        self.__query_radius(self.tree, target, radius, results)
+        return results
+    
+    def __query_radius(self, node, target, radius, results, depth=0):
+        if node is None:
+            return
+        
+        if np.linalg.norm(node.point - target) <= radius:
+            results.append(node.point)
+        
+        axis = depth % 2
+        if target[axis] - radius < node.point[axis]:
+            self.__query_radius(node.left, target, radius, results, depth + 1)
+        if target[axis] + radius > node.point[axis]:
+            self.__query_radius(node.right, target, radius, results, depth + 1)
+
+"""Runs fn once and returns how long it took, in milliseconds"""
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return (time.perf_counter() - start) * 1000
+
+def bench(name, points, queries):
+    print(f"{name}: {len(points)} points, {len(queries)} queries")
+
+    old_tree = None
+    new_tree = None
+    def build_old():
+        nonlocal old_tree
+        old_tree = NodeKDTree(points)
+    def build_new():
+        nonlocal new_tree
+        new_tree = KDTree(points)
+    print(f"    build          old {timed(build_old):9.2f} ms   new {timed(build_new):9.2f} ms")
+
+    old_ms = timed(lambda: [old_tree.closest_point(q) for q in queries])
+    one_ms = timed(lambda: [new_tree.closest_point(q) for q in queries])
+    batch_ms = timed(lambda: new_tree.closest_points(queries))
+    print(f"    closest_point  old {old_ms:9.2f} ms   new {one_ms:9.2f} ms   batched {batch_ms:9.2f} ms")
+
+    radius = 0.5 * np.median(new_tree.closest_points(queries)[1]) + 1e-9
+    old_ms = timed(lambda: [old_tree.query_radius(q, radius) for q in queries])
+    one_ms = timed(lambda: [new_tree.query_radius(q, radius) for q in queries])
+    batch_ms = timed(lambda: new_tree.query_radius_pairs(queries, radius))
+    print(f"    query_radius   old {old_ms:9.2f} ms   new {one_ms:9.2f} ms   batched {batch_ms:9.2f} ms")
+
+    # sanity check - both trees must agree on the nearest distance
+    old_dists = [np.linalg.norm(np.array(old_tree.closest_point(q)) - q) for q in queries[:200]]
+    _, new_dists = new_tree.closest_points(queries[:200])
+    assert np.allclose(old_dists, new_dists), "trees disagree"
+
+def main():
+    rng = np.random.default_rng(0)
+
+    vertices = np.array(read_gps(f"{root}/data/combined.txt"))
+    low, high = vertices.min(axis=0), vertices.max(axis=0)
+    queries = low + (high - low) * rng.random((NUM_QUERIES, 2))
+    bench("combined.txt vertices", vertices, queries)
+
+    samples = np.array(edges_as_points(read_edges(f"{root}/data/edge_list.txt"), {}))
+    bench("edge_list.txt edge samples", samples, queries)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Benchmarks optimize on the college-hill map: the per-call cost of forking and
+tearing down a pool for every call (as v1 optimize used to) against reusing a
+long-lived DrawPool, and how the starts scale with the pool's size, up to one
+worker per core (and at least 2, as a pool of 1 runs in-process). Every start
+runs its full MAX_ITERS steps, so each configuration does the same work.
+Run from src/ with `python -m benchmarks.optimize`
+"""
+import multiprocessing
+import os
+import pathlib
+import time
+
+import numpy as np
+
+from libstrava import get_map_context, DrawPool
+from libstrava.optimize import optimize, run_start
+from libstrava.draw_pool import share_context, call_on_shared_context
+
+root = str(pathlib.Path(__file__).parent.parent.parent)
+MAP_FILE = f"{root}/data/edge_list.txt"
+STARTS = 8
+MAX_ITERS = 20
+REPEATS = 3
+
+"""optimize's starts as they used to run, in a pool forked for the call"""
+def optimize_forking(points, context, seed, processes):
+    seeds = np.random.SeedSequence(seed).spawn(STARTS)
+    jobs = [(points, start_seed, MAX_ITERS, np.inf, None, None) for start_seed in seeds]
+    share_context(context)
+    with multiprocessing.get_context("fork").Pool(processes) as pool:
+        results = pool.map(call_on_shared_context, [(run_start, job) for job in jobs], chunksize=1)
+    return min(results, key=lambda result: result[1])[0]
+
+"""Mean ms per call of fn over REPEATS calls"""
+def timed(fn):
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        result = fn()
+    return result, (time.perf_counter() - start) * 1000 / REPEATS
+
+def main():
+    context = get_map_context(MAP_FILE)
+    context.router
+    points = list(map(tuple, np.random.default_rng(0).random((200, 2)).tolist()))
+    run = lambda pool: optimize(points, context.edges, STARTS, MAX_ITERS, np.inf, seed=0,
+                                graph_index=context.edge_index, pool=pool)[0]
+    cores = os.cpu_count() or 1
+
+    print(f"{STARTS} starts of {MAX_ITERS} steps, {len(points)} points, {cores} cores")
+    serial, serial_ms = timed(lambda: run(None))
+    print(f"    in-process             {serial_ms:8.1f} ms")
+    for processes in sorted({2, 4, cores} & set(range(2, max(cores, 2) + 1))):
+        pool = DrawPool(context, processes)
+        reused, reused_ms = timed(lambda: run(pool))
+        forked, forked_ms = timed(lambda: optimize_forking(points, context, 0, processes))
+        pool.close()
+        assert reused == serial == forked, "the pool found a different embedding"
+        print(f"    {processes} workers  reused {reused_ms:8.1f} ms   forked per call {forked_ms:8.1f} ms"
+              f"   speedup {serial_ms / reused_ms:5.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Benchmarks point-to-point routing with and without landmark (ALT) tables, on
+jittered grid street maps of growing size, and checks both find equally
+short paths. Random pairs span the whole map; local pairs are LOCAL_SPAN
+blocks apart, like the neighboring critical vertices of a drawing, whose routes
+are what requests actually ask for.
+Run from src/ with `python -m benchmarks.routing`
+"""
+import numpy as np
+import time
+
+from libstrava.csr_graph import CSRGraph
+from libstrava.kd_tree import KDTree
+from libstrava.routing import Router, Landmarks
+
+SIDES = [30, 100, 300] # grid maps of side x side intersections
+QUERIES = 200
+DROPPED = 0.2 # fraction of grid streets left out, so routes have to go around
+LOCAL_SPAN = 10 # blocks between the ends of a local query
+
+"""A side x side grid of jittered intersections with some streets missing"""
+def fake_map(rng, side):
+    coords = np.stack(np.meshgrid(np.arange(side), np.arange(side)), axis=2).reshape(-1, 2).astype(float)
+    coords += rng.uniform(-0.3, 0.3, coords.shape)
+    ids = np.arange(side * side).reshape(side, side)
+    pairs = np.concatenate((np.stack((ids[:, :-1].ravel(), ids[:, 1:].ravel()), axis=1),
+                            np.stack((ids[:-1].ravel(), ids[1:].ravel()), axis=1)))
+    pairs = pairs[rng.random(len(pairs)) >= DROPPED]
+    points = list(map(tuple, coords.tolist()))
+    return CSRGraph.from_edges([(points[a], points[b]) for a, b in pairs.tolist()])
+
+"""count pairs of vertices about LOCAL_SPAN blocks apart as the crow flies"""
+def local_pairs(rng, csr, count):
+    starts = rng.integers(0, csr.num_vertices, count)
+    angles = rng.uniform(0, 2 * np.pi, count)
+    targets = np.asarray(csr.coords)[starts] + LOCAL_SPAN * np.stack((np.cos(angles), np.sin(angles)), axis=1)
+    goals, _ = KDTree(csr.coords).closest_points(targets)
+    return list(zip(starts.tolist(), goals.tolist()))
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, (time.perf_counter() - start) * 1000
+
+def main():
+    rng = np.random.default_rng(0)
+    for side in SIDES:
+        csr = fake_map(rng, side)
+        landmarks, build_ms = timed(lambda: Landmarks.build(csr))
+        plain, alt = Router(csr), Router(csr, landmarks)
+        print(f"{csr.num_vertices} vertices (landmarks built in {build_ms:.0f} ms)")
+        for kind, pairs in (("random", rng.integers(0, csr.num_vertices, (QUERIES, 2)).tolist()),
+                            ("local", local_pairs(rng, csr, QUERIES))):
+            plain_dists, plain_ms = timed(lambda: [plain.distance(a, b) for a, b in pairs])
+            alt_dists, alt_ms = timed(lambda: [alt.distance(a, b) for a, b in pairs])
+            assert np.allclose(plain_dists, alt_dists), "landmark routing found a longer path"
+            print(f"    per {kind:6} query   plain {plain_ms / QUERIES:8.3f} ms   landmarks {alt_ms / QUERIES:8.3f} ms")
+
+if __name__ == "__main__":
+    main()
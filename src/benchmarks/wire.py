@@ -0,0 +1,82 @@
+"""
+Benchmarks the wire formats on a 5000 point drawing and a route of as many
+edges: what the server spends parsing the drawing and serializing the route in
+the v1/v2 text protocol (including the form encoding it travels in) against
+v3's packed and JSON formats, and how many bytes each puts on the wire.
+Run from src/ with `python -m benchmarks.wire`
+"""
+import json
+import time
+import urllib.parse
+
+import numpy as np
+
+from libstrava.wire import read_in_data_new_api, write_edge_list, pack_drawing, unpack_drawing, \
+                           pack_edges, drawing_from_json, edges_to_json, as_point_lists
+
+POINTS = 5000
+PATHS = 10
+REPEATS = 20
+
+"""A drawing of random walks in the unit box, as the website sends them"""
+def fake_drawing(rng):
+    steps = rng.normal(0, 0.005, (POINTS, 2))
+    coords = np.clip(0.5 + np.cumsum(steps, axis=0), 0, 1)
+    return [list(map(tuple, path.tolist())) for path in np.array_split(coords, PATHS)]
+
+"""The text protocol body for a drawing, built the way App.vue builds it"""
+def drawing_text(paths):
+    return "".join(f"{len(path)}\n" + "".join(f"{x} {y}\n" for x, y in path) for path in paths)
+
+"""write_edge_list as it was, growing the string one edge at a time"""
+def write_edge_list_concat(edges):
+    string = f"{len(edges)}\n"
+    for edge in edges:
+        (a, b), (c, d) = edge
+        string += f"{a} {b} {c} {d}\n"
+    return string
+
+"""Mean ms per call of fn over REPEATS calls"""
+def timed(fn):
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        fn()
+    return (time.perf_counter() - start) * 1000 / REPEATS
+
+def main():
+    rng = np.random.default_rng(0)
+    paths = fake_drawing(rng)
+    edges = [((41.8 + a, -71.4 + b), (41.8 + c, -71.4 + d)) for a, b, c, d in rng.random((POINTS, 4)).tolist()]
+
+    form = urllib.parse.urlencode({"full_data": drawing_text(paths)})
+    packed = {code: pack_drawing(paths, code) for code in (b"d", b"f")}
+    as_json = json.dumps({"paths": [np.ravel(path).tolist() for path in paths]}, separators=(",", ":"))
+
+    # the flattest input each protocol can give get_subgraph: lists of point tuples
+    parsers = {
+        "text (form + lines)": (len(form), lambda: read_in_data_new_api(
+            iter(urllib.parse.parse_qs(form)["full_data"][0].splitlines()))),
+        "packed float64": (len(packed[b"d"]), lambda: as_point_lists(unpack_drawing(packed[b"d"])[0])),
+        "packed float32": (len(packed[b"f"]), lambda: as_point_lists(unpack_drawing(packed[b"f"])[0])),
+        "json": (len(as_json), lambda: as_point_lists(drawing_from_json(json.loads(as_json)))),
+    }
+    assert parsers["packed float64"][1]() == parsers["text (form + lines)"][1](), "packed drawing came back different"
+    print(f"parsing a {POINTS} point drawing")
+    for name, (size, parse) in parsers.items():
+        print(f"    {name:22} {size:8} bytes {timed(parse):8.3f} ms")
+    print(f"    {'packed, arrays only':22} {len(packed[b'd']):8} bytes {timed(lambda: unpack_drawing(packed[b'd'])):8.3f} ms")
+
+    serializers = {
+        "text, += per edge": lambda: write_edge_list_concat(edges),
+        "text, one join": lambda: write_edge_list(edges),
+        "packed float64": lambda: pack_edges(edges, b"d"),
+        "packed float32": lambda: pack_edges(edges, b"f"),
+        "json": lambda: edges_to_json(edges),
+    }
+    assert serializers["text, one join"]() == serializers["text, += per edge"](), "edge lists differ"
+    print(f"serializing a {POINTS} edge route")
+    for name, serialize in serializers.items():
+        print(f"    {name:22} {len(serialize()):8} bytes {timed(serialize):8.3f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,20 @@ from .fast_gradient_decent import gradient_decend, regularized_loss, random_init
 from .points import read_gps
 from .edges import read_edges, point_edge_dist
 from .kd_tree import KDTree
-from .graphs import get_subgraph, graph_from_edges
+from .graphs import get_subgraph, iter_subgraph, graph_from_edges
+from .fast_gradient_decent import build_edge_index
+from .map_context import MapContext, get_map_context
+from .csr_graph import CSRGraph
+from .map_file import compile_map, load_map
+from .routing import Router, Landmarks
+from .path_cache import PathCache
+from .result_cache import ResultCache, result_key
+from .wire import read_in_data_new_api, write_edge_list, write_points, \
+                  unpack_drawing, pack_drawing, drawing_from_json, pack_edges, unpack_edges, \
+                  edges_to_json, as_point_lists
+from .draw_pool import DrawPool
+from .jobs import JobQueue, QueueFull, JobQueueClient, serve_job_queue
+from .optimize import optimize
 
 from .edges import main as edgestest 
 from .fast_gradient_decent import main as gradtest
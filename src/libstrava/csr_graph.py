@@ -0,0 +1,159 @@
+"""
+A compressed-sparse-row representation of the map graph.
+
+Vertices are integer ids into a coordinate array, and the neighbors of vertex v
+are neighbors[offsets[v]:offsets[v+1]], with the matching slots of lengths
+holding the edge lengths. Compared to the dict-of-lists graph this costs a few
+dozen bytes per vertex instead of a few hundred, and walking it never hashes a
+float tuple.
+"""
+import numpy as np
+
+from .edges import read_edges, write_edges_to_file
+
+ARRAYS = ["coords", "offsets", "neighbors", "lengths"]
+
+"""
+Params:
+    coords - (n, 2) float array of vertex positions
+    offsets - (n + 1,) int array, see module docstring
+    neighbors - (m,) int array of vertex ids, two entries per undirected edge
+    lengths - (m,) float array of euclidian edge lengths, computed if not given
+"""
+class CSRGraph:
+    def __init__(self, coords, offsets, neighbors, lengths=None):
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        self.offsets = np.asarray(offsets, dtype=np.int32)
+        self.neighbors = np.asarray(neighbors, dtype=np.int32)
+        if lengths is None:
+            sources = np.repeat(np.arange(len(self.coords)), np.diff(self.offsets))
+            lengths = np.linalg.norm(self.coords[self.neighbors] - self.coords[sources], axis=1)
+        self.lengths = np.asarray(lengths, dtype=float)
+        self.__ids = None
+        self.__points = None
+        self.__lists = None
+        self.__directions = None
+
+    """
+    Builds the graph from a list of edges. Vertex ids are assigned in order of first
+    appearance, and each vertex's neighbors keep edge list order, so to_dict()
+    matches what graph_from_edges builds from the same edges.
+    """
+    @classmethod
+    def from_edges(cls, edges):
+        ends = np.asarray(edges, dtype=float).reshape(-1, 2)
+        if len(ends) == 0:
+            return cls(np.zeros((0, 2)), np.zeros(1), np.zeros(0))
+
+        unique, first_seen, inverse = np.unique(ends, axis=0, return_index=True, return_inverse=True)
+        order = np.argsort(first_seen)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        ids = rank[inverse.ravel()].reshape(-1, 2)
+
+        # one arc per direction, interleaved so a stable sort keeps edge order per vertex
+        sources = ids.ravel()
+        targets = ids[:, ::-1].ravel()
+        arc_order = np.argsort(sources, kind="stable")
+        offsets = np.zeros(len(unique) + 1, dtype=np.int32)
+        np.cumsum(np.bincount(sources, minlength=len(unique)), out=offsets[1:])
+        return cls(unique[order], offsets, targets[arc_order])
+
+    """Builds the graph from a dict graph, vertex -> list of neighboring vertices"""
+    @classmethod
+    def from_dict(cls, graph):
+        ids = {vertex: i for i, vertex in enumerate(graph)}
+        offsets = np.zeros(len(ids) + 1, dtype=np.int32)
+        np.cumsum([len(neighbors) for neighbors in graph.values()], out=offsets[1:])
+        neighbors = [ids[neighbor] for vertex in graph for neighbor in graph[vertex]]
+        return cls(list(graph.keys()), offsets, neighbors)
+
+    """The arrays that make up the graph, e.g. for np.save"""
+    def to_arrays(self) -> dict:
+        return {name: getattr(self, name) for name in ARRAYS}
+
+    """Rebuilds a graph from to_arrays output, e.g. from memory-mapped files"""
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(*(arrays[name] for name in ARRAYS))
+
+    """Reads an edge list file, in the data/edge_list.txt format"""
+    @classmethod
+    def read(cls, filename):
+        return cls.from_edges(read_edges(filename))
+
+    """The dict graph form, vertex -> list of neighboring vertices"""
+    def to_dict(self) -> dict[tuple[float], list[tuple[float]]]:
+        points = self.points
+        neighbors = self.neighbors.tolist()
+        offsets = self.offsets.tolist()
+        return {points[v]: [points[n] for n in neighbors[offsets[v]:offsets[v+1]]]
+                for v in range(len(points))}
+
+    """Each undirected edge once, as a pair of points"""
+    def to_edges(self) -> list[tuple[tuple[float]]]:
+        sources = np.repeat(np.arange(self.num_vertices), np.diff(self.offsets))
+        forward = sources < self.neighbors
+        # a self loop has two arcs to itself, keep one of them
+        loops = np.flatnonzero(sources == self.neighbors)[::2]
+        keep = np.sort(np.concatenate((np.flatnonzero(forward), loops)))
+        points = self.points
+        return [(points[a], points[b]) for a, b in zip(sources[keep].tolist(), self.neighbors[keep].tolist())]
+
+    """Writes the graph as an edge list file, in the data/edge_list.txt format"""
+    def write(self, filename):
+        write_edges_to_file(self.to_edges(), filename)
+
+    @property
+    def num_vertices(self):
+        return len(self.coords)
+
+    """The vertex coordinates as a list of tuples, built on first use"""
+    @property
+    def points(self) -> list[tuple[float]]:
+        if self.__points is None:
+            self.__points = list(map(tuple, self.coords.tolist()))
+        return self.__points
+
+    """
+    offsets and neighbors as plain lists, built on first use. Walking the graph
+    one vertex at a time is much faster on these than on the arrays
+    """
+    def adjacency(self) -> tuple[list[int], list[int]]:
+        if self.__lists is None:
+            self.__lists = self.offsets.tolist(), self.neighbors.tolist()
+        return self.__lists
+
+    """
+    The unit vector along every arc (the slots of neighbors) as two plain lists,
+    x parts and y parts, built on first use. Zero length arcs get (0, 0)
+    """
+    def arc_directions(self) -> tuple[list[float], list[float]]:
+        if self.__directions is None:
+            sources = np.repeat(np.arange(self.num_vertices), np.diff(self.offsets))
+            vecs = self.coords[self.neighbors] - self.coords[sources]
+            units = vecs / np.where(self.lengths == 0, 1, self.lengths)[:, None]
+            self.__directions = units[:, 0].tolist(), units[:, 1].tolist()
+        return self.__directions
+
+    """neighbor ids of vertex v"""
+    def neighbors_of(self, v):
+        return self.neighbors[self.offsets[v]:self.offsets[v+1]]
+
+    """lengths of the edges from vertex v, matching neighbors_of(v)"""
+    def lengths_of(self, v):
+        return self.lengths[self.offsets[v]:self.offsets[v+1]]
+
+    def degree(self, v):
+        return self.offsets[v+1] - self.offsets[v]
+
+    """The id of the vertex at point, or None if there is no vertex there"""
+    def vertex_id(self, point):
+        if self.__ids is None:
+            self.__ids = {point: i for i, point in enumerate(self.points)}
+        return self.__ids.get(tuple(point))
+
+    """bytes used by the arrays"""
+    @property
+    def nbytes(self):
+        return self.coords.nbytes + self.offsets.nbytes + self.neighbors.nbytes + self.lengths.nbytes
@@ -0,0 +1,197 @@
+"""
+Draws a drawing's segments across a pool of worker processes.
+
+Once the critical points are embedded every segment draws independently, so
+the segments are split into chunks and each worker draws one chunk at a time
+with draw_uncached. The pool is forked once the map is loaded (and its router
+and walk lists built), so every worker starts with the whole map already in
+memory, shared copy-on-write with the parent, and a request only sends segment
+paths over and drawn edges back, along with the routes the workers had to find,
+which go into the parent's PathCache like the drawings do.
+
+Forking is only safe while the process has no other threads, as one of them
+could hold a lock (a Router's, a PathCache's) that the forked workers would
+then wait on forever. So the pool is forked when the backend starts it, before
+serving; restarting it later, on a reloaded map, takes workers from a
+forkserver instead, which load the map by its path. Retired pools are joined
+in the background, so the request that triggered the restart doesn't wait on
+them.
+"""
+import collections
+import itertools
+import math
+import multiprocessing
+import os
+import threading
+
+from .segment import Segment, draw_uncached
+from .map_context import get_map_context
+
+PARALLEL_MIN_SEGMENTS = 8 # fewer segments than this are drawn in-process, it isn't worth the round trip
+CHUNKS_PER_PROCESS = 2 # smaller chunks even out segments that take longer to draw
+
+"""the map shared with pool workers, set in the parent before the pool forks"""
+shared_context = None
+
+def share_context(context):
+    global shared_context
+    shared_context = context
+
+"""Worker initializer where the workers aren't forked: loads the map by path instead"""
+def load_shared_context(path):
+    context = get_map_context(path, watch=False)
+    context.router
+    context.csr.arc_directions()
+    share_context(context)
+
+"""
+One chunk of segments, given by their paths, as drawn in a pool worker.
+Returns the drawn paths, and the routes found on the way, {(start, end): route}
+"""
+def draw_chunk(paths):
+    routes = {}
+    return draw_uncached([Segment(path) for path in paths], shared_context, routes), routes
+
+"""
+How to start workers on context: "fork" while this is the process's only
+thread, else "forkserver" (or "spawn" where there is none) if the workers can
+load the map by its path, else None - there is no safe way
+"""
+def start_method(context):
+    methods = multiprocessing.get_all_start_methods()
+    if "fork" in methods and threading.active_count() == 1:
+        return "fork"
+    if context.path is None:
+        return None
+    return "forkserver" if "forkserver" in methods else "spawn"
+
+"""
+The cores this process may run on, which under taskset or a container's cpuset
+can be fewer than os.cpu_count() reports
+"""
+def usable_cores() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+"""fn(arg, the shared map) in a pool worker, see DrawPool.map"""
+def call_on_shared_context(call):
+    fn, arg = call
+    return fn(arg, shared_context)
+
+"""
+Params:
+    context - the MapContext the workers draw on
+    processes - pool size, defaults to one per usable core. 1 draws everything in-process,
+        as does a pool that can't start its workers safely (see start_method)
+"""
+class DrawPool:
+    def __init__(self, context, processes=None):
+        self.context = context
+        self.processes = processes or usable_cores()
+        self.pool = None
+        self.lock = threading.Lock()
+        if self.processes > 1:
+            with self.lock:
+                self.__start(context)
+
+    """(Re)starts the workers on context. Call with self.lock held"""
+    def __start(self, context):
+        if self.pool is not None:
+            retired = self.pool
+            retired.close() # the old workers finish what they are drawing, then exit
+            threading.Thread(target=retired.join, daemon=True).start()
+        self.context = context
+        method = start_method(context)
+        if method == "fork":
+            context.router # built before forking so no worker has to build its own
+            context.csr.arc_directions()
+            share_context(context)
+            self.pool = multiprocessing.get_context("fork").Pool(self.processes)
+        elif method is not None:
+            self.pool = multiprocessing.get_context(method).Pool(self.processes, initializer=load_shared_context,
+                                                                 initargs=(context.path,))
+        else:
+            self.pool = None
+
+    """
+    Draws segments on context, like draw_uncached. Only context, or a reload of
+    the same map file (which restarts the workers on it), is drawn on in the
+    workers - any other map, a small batch, or a single process pool is drawn
+    in-process.
+    Returns a list of drawn paths, one per segment
+    """
+    def draw(self, segments, context) -> list[list[tuple[tuple]]]:
+        same_map = context is self.context or (context.path is not None and context.path == self.context.path)
+        if not same_map or self.processes == 1 or len(segments) < PARALLEL_MIN_SEGMENTS:
+            return draw_uncached(segments, context)
+
+        with self.lock:
+            if context is not self.context: # the map was reloaded
+                self.__start(context)
+            pool = self.pool
+        if pool is None:
+            return draw_uncached(segments, context)
+
+        chunk_size = math.ceil(len(segments) / (self.processes * CHUNKS_PER_PROCESS))
+        chunks = [[segment.path for segment in segments[i:i + chunk_size]]
+                  for i in range(0, len(segments), chunk_size)]
+        results = pool.map(draw_chunk, chunks)
+        for _, routes in results:
+            for pair, route in routes.items():
+                context.path_cache.put(("route", *pair), route)
+        return list(itertools.chain.from_iterable(drawn for drawn, _ in results))
+
+    """
+    draw as a generator, yielding each segment's drawn path in order as soon as
+    it is drawn, for streaming. Each segment goes to the workers on its own, so
+    the first arrives after one segment's drawing rather than one chunk's, and
+    only a few are handed out ahead of the one being waited on, so closing the
+    generator stops the drawing soon after. Where draw would draw in-process,
+    the segments are drawn one by one.
+    """
+    def iter_draw(self, segments, context):
+        same_map = context is self.context or (context.path is not None and context.path == self.context.path)
+        pool = None
+        if same_map and self.processes > 1 and len(segments) >= PARALLEL_MIN_SEGMENTS:
+            with self.lock:
+                if context is not self.context:
+                    self.__start(context)
+                pool = self.pool
+        if pool is None:
+            for segment in segments:
+                yield draw_uncached([segment], context)[0]
+            return
+
+        pending = collections.deque()
+        segments = iter(segments)
+        while True:
+            for segment in itertools.islice(segments, self.processes * CHUNKS_PER_PROCESS - len(pending)):
+                pending.append(pool.apply_async(draw_chunk, ([segment.path],)))
+            if not pending:
+                return
+            drawn, routes = pending.popleft().get()
+            for pair, route in routes.items():
+                context.path_cache.put(("route", *pair), route)
+            yield drawn[0]
+
+    """
+    fn(arg, context) for each of args across the workers, one call at a time,
+    context being the map they were started on; for other long-running work on
+    the map, such as optimize's starts. fn must be a module level function. A
+    single process pool calls it in-process.
+    Returns the results in order
+    """
+    def map(self, fn, args) -> list:
+        with self.lock:
+            pool, context = self.pool, self.context
+        if pool is None:
+            return [fn(arg, context) for arg in args]
+        return pool.map(call_on_shared_context, [(fn, arg) for arg in args], chunksize=1)
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
@@ -6,11 +6,15 @@ import cv2
 import os
 import pathlib
 
-from .points import read_gps, plot_point, gps2pixel, pixel2gps
+from .points import read_gps, plot_point, gps2pixel, pixel2gps, ToleranceSet
+from .kd_tree import KDTree
 
 """GLOBALS"""
 root = str(pathlib.Path(__file__).parent.parent.parent)
 tol = 0.00001 # float comparison tolerance
+DIRECTIONS = ["north", "south", "east", "west"]
+PAIR_BUDGET = 1 << 20 # (point, candidate) pairs examined at once by closest_in_directions
+MAX_RADIUS = 1 / 16 # past this fraction of the point set's extent, closest_in_directions brute forces the rest
 
 corners1 = ((41.837521, -71.413896), (41.817705, -71.371781))
 fname1 = f"{root}/data/ss 1.png"
@@ -83,6 +87,95 @@ def find_closest_in_direction(target, points, direction):
                 closest_distance = distance
     return closest
 
+"""
+is_in_direction for many displacements (end - start) at once.
+Returns an (n, 4) bool array, one column per entry of DIRECTIONS
+"""
+def direction_masks(displacements):
+    x_displacement, y_displacement = displacements[:, 0], displacements[:, 1]
+    x_abs, y_abs = np.abs(x_displacement), np.abs(y_displacement)
+    return np.stack(((y_displacement > 0) & (y_abs - x_abs >= 0),
+                     (y_displacement < 0) & (y_abs - x_abs >= 0),
+                     (x_displacement > 0) & (x_abs - y_abs > 0),
+                     (x_displacement < 0) & (x_abs - y_abs > 0)), axis=1)
+
+"""
+The closest point to points[i] in each of the given directions, by brute force
+over the half plane each direction's cone lies in. by_x and by_y are argsorts of
+points by their coordinates, so the half plane is a slice of one of them
+"""
+def closest_in_half_planes(points, i, directions, by_x, by_y):
+    closest = []
+    for direction in directions:
+        by, axis = (by_y, 1) if DIRECTIONS[direction] in ("north", "south") else (by_x, 0)
+        if DIRECTIONS[direction] in ("north", "east"):
+            candidates = by[np.searchsorted(points[by, axis], points[i, axis], side="right"):]
+        else:
+            candidates = by[:np.searchsorted(points[by, axis], points[i, axis], side="left")]
+        displacements = points[candidates] - points[i]
+        in_cone = direction_masks(displacements)[:, direction]
+        candidates, displacements = candidates[in_cone], displacements[in_cone]
+        if len(candidates) == 0:
+            closest.append(-1)
+            continue
+        dist2 = (displacements ** 2).sum(axis=1)
+        closest.append(candidates[dist2 == dist2.min()].min())
+    return closest
+
+"""
+find_closest_in_direction for every point and every direction at once.
+
+Each round takes all pairs of points within a radius from a KDTree. A point's
+closest neighbor in a direction is settled as soon as the radius holds any
+candidate there, and the radius doubles for points with directions still
+unsettled. The few points left once the radius gets large are mostly on the
+edge of the set with nothing at all in some direction, and those directions
+are settled by brute force over a half plane, which is small exactly there.
+
+Params:
+    points - (n, 2) array (or list of 2tuples)
+Returns:
+    (n, 4) int array - index of the closest point in each of DIRECTIONS, -1 if there is none.
+    Ties go to the lowest index, like find_closest_in_direction
+"""
+def closest_in_directions(points):
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    closest = np.full((len(points), len(DIRECTIONS)), -1)
+    extent = np.linalg.norm(points.max(axis=0) - points.min(axis=0)) if len(points) else 0.0
+    if extent == 0:
+        return closest
+
+    tree = KDTree(points)
+    radius = extent / np.sqrt(len(points)) # about the typical spacing
+    pending = np.arange(len(points))
+    while len(pending) and radius <= extent * MAX_RADIUS:
+        # roughly how many points each query will see, to keep the pair arrays bounded
+        expected = len(points) * min(1.0, 4 * (radius / extent) ** 2)
+        batch = max(1, int(PAIR_BUDGET // max(expected, 1)))
+        for chunk in range(0, len(pending), batch):
+            queries = pending[chunk:chunk + batch]
+            query_ids, point_ids = tree.query_radius_pairs(points[queries], radius)
+            query_ids = queries[query_ids]
+            displacements = points[point_ids] - points[query_ids]
+            dist2 = (displacements ** 2).sum(axis=1)
+            masks = direction_masks(displacements)
+            for direction in range(len(DIRECTIONS)):
+                q, p, d = query_ids[masks[:, direction]], point_ids[masks[:, direction]], dist2[masks[:, direction]]
+                order = np.lexsort((p, d, q))
+                q, p = q[order], p[order]
+                first = np.ones(len(q), dtype=bool)
+                first[1:] = q[1:] != q[:-1]
+                closest[q[first], direction] = p[first]
+
+        pending = pending[(closest[pending] < 0).any(axis=1)]
+        radius *= 2
+
+    by_x, by_y = np.argsort(points[:, 0], kind="stable"), np.argsort(points[:, 1], kind="stable")
+    for i in pending.tolist():
+        directions = np.flatnonzero(closest[i] < 0)
+        closest[i, directions] = closest_in_half_planes(points, i, directions, by_x, by_y)
+    return closest
+
 """
 Determines whether an edge is already included in a list of edges
 NOTE: This assumes every point's x coord is unique. Should be fine bc they're floats
@@ -108,13 +201,15 @@ Adds an edge to from each point to its closest neighbor in each direction
 Edges are represented as (point, point) with the points sorted lexicographically
 """
 def griddy_edges(points):
+    points = list(points)
+    neighbors = closest_in_directions(points).tolist()
     edges = []
-    for point in points:
-        for dir in ["north", "south", "east", "west"]:
-            closest = find_closest_in_direction(point, points, dir)
-            if closest is not None:
-                new_edge = tuple(sorted((point, closest)))
-                if not already_included(new_edge, edges):
+    included = ToleranceSet(tol)
+    for point, closest in zip(points, neighbors):
+        for neighbor in closest:
+            if neighbor >= 0:
+                new_edge = tuple(sorted((point, points[neighbor])))
+                if included.add(new_edge):
                     edges.append(new_edge)
 
     return edges
@@ -4,15 +4,11 @@ import pathlib
 
 from .edges import read_edges
 from .kd_tree import KDTree
+from .segment_index import SegmentIndex
 
 root = str(pathlib.Path(__file__).parent.parent.parent)
 
 ################ HYPERPARAMETERS ####################
-XY_STEP = 0.00001
-THETA_STEP = 0.0001
-R_STEP = 0.000001
-GAMMA_STEP = 0.000001
-
 REGULARIZATION_CONST = 0.2
 XY_LEARNING_RATE = 0.5
 THETA_LEARNING_RATE = 500000
@@ -20,10 +16,20 @@ R_LEARNING_RATE = 0.5
 GAMMA_LEARNING_RATE = 5
 HOARDING_FACTOR = 3 # the higher this hyperparam, the less aggressively we'll prune
 
-"""Return a better parameter bundle """
-def gradient_decend(points, graph, parameters):
+"""
+Return a better parameter bundle
+graph_index is a SegmentIndex over graph, as build_edge_index(graph) returns.
+Pass it in when the map is fixed across calls so it isn't rebuilt every step.
+"""
+def gradient_decend(points, graph, parameters, graph_index=None):
+    grad = gradient(points, graph, parameters, graph_index)
+    print("change in theta:", grad[2] * THETA_LEARNING_RATE)
+    return apply_gradient(parameters, grad)
+
+"""Takes one learning-rate-scaled step against grad, keeping r and gamma in bounds"""
+def apply_gradient(parameters, grad):
     x, y, theta, r, gamma = parameters
-    xgrad, ygrad, theta_grad, rgrad, gamma_grad = gradient(points, graph, parameters)
+    xgrad, ygrad, theta_grad, rgrad, gamma_grad = grad
 
     xgrad *= XY_LEARNING_RATE
     ygrad *= XY_LEARNING_RATE
@@ -31,8 +37,6 @@ def gradient_decend(points, graph, parameters):
     rgrad *= R_LEARNING_RATE
     gamma_grad *= GAMMA_LEARNING_RATE
 
-    print("change in theta:", theta_grad)
-
     new_x, new_y, new_theta, new_r, new_gamma = x - xgrad, y - ygrad, theta - theta_grad, r - rgrad, gamma - gamma_grad
 
     # bound r and gamma to prevent trivial solutions
@@ -45,171 +49,123 @@ def gradient_decend(points, graph, parameters):
     
     return new_x, new_y, new_theta, new_r, new_gamma
 
-"""Compute the gradient using finite differences"""
-def gradient(points, graph, parameters):
-    x, y, theta, r, gamma = parameters
-    unperturbed_loss = embedding_loss(points, graph, parameters)
-
-    x_perturbed = (x + XY_STEP, y, theta, r, gamma)
-    xgrad = (embedding_loss(points, graph, x_perturbed) - unperturbed_loss) / XY_STEP
-    y_perturbed = (x, y + XY_STEP, theta, r, gamma)
-    ygrad = (embedding_loss(points, graph, y_perturbed) - unperturbed_loss) / XY_STEP
-    theta_perturbed = (x, y, theta + THETA_STEP, r, gamma)
-    theta_grad = (embedding_loss(points, graph, theta_perturbed) - unperturbed_loss) / THETA_STEP
-    r_perturbed = (x, y, theta, r + R_STEP, gamma)
-    rgrad = (embedding_loss(points, graph, r_perturbed) - unperturbed_loss) / R_STEP
-    gamma_perturbed = (x, y, theta, r, gamma + GAMMA_STEP)
-    gamma_grad = (embedding_loss(points, graph, gamma_perturbed) - unperturbed_loss) / GAMMA_STEP
+"""Compute the gradient of embedding_loss. See loss_and_gradient"""
+def gradient(points, graph, parameters, graph_index=None):
+    _, grad = loss_and_gradient(points, graph, parameters, graph_index)
+    return grad
 
-    return xgrad, ygrad, theta_grad, rgrad, gamma_grad
+"""
+Returns embedding_loss and its exact gradient w.r.t. (x, y, theta, r, gamma).
+
+The subgraph, and which of its edges each point is closest to, are held fixed
+for the step. With that assignment fixed, each point's loss is the squared
+distance to a fixed segment, whose derivative w.r.t. the embedded point p is
+2 (p - c) with c the closest point on the segment (whether c is interior or an
+endpoint). The chain rule through embed then gives the bundle gradient, all as
+array operations over the points.
+"""
+def loss_and_gradient(points, graph, parameters, graph_index=None):
+    x, y, theta, r, gamma = parameters
+    _, subgraph_index = representative_subgraph(points, graph, parameters, graph_index, with_index=True)
+
+    embedded = embed(points, parameters)
+    edge_ids, _ = subgraph_index.nearest(embedded)
+    residuals = embedded - subgraph_index.project(embedded, edge_ids)
+    loss = (residuals ** 2).sum(axis=1).mean()
+
+    # d loss / d embedded point, then d embedded point / d parameter for each point
+    dloss = 2 * residuals / len(points)
+    a, b = np.array(points, dtype=float).T
+    sin, cos = math.sin(theta), math.cos(theta)
+    dtheta = np.stack((a*r*cos - b*gamma*r*sin, a*r*sin + b*gamma*r*cos), axis=1)
+    dr = np.stack((a*sin + b*gamma*cos, -a*cos + b*gamma*sin), axis=1)
+    dgamma = np.stack((b*r*cos, b*r*sin), axis=1)
+
+    xgrad, ygrad = dloss.sum(axis=0)
+    theta_grad = (dloss * dtheta).sum()
+    rgrad = (dloss * dr).sum()
+    gamma_grad = (dloss * dgamma).sum()
+    return loss, (xgrad, ygrad, theta_grad, rgrad, gamma_grad)
 
 """
 Returns the loss of an embedding of points in the graph
 Does so by finding the best subgraph corresponding to the embedding
 and calculates the loss between the points and the subgraph
 """
-def embedding_loss(points, graph, parameters):
-    points = embed(points, parameters)
-
-    #setup for image and fast_prune
-    points_tree = KDTree(points)
-    samples_to_parents = {}
-    graph_points = edges_as_points(graph, samples_to_parents)
-    graph_tree = KDTree(graph_points)
+def embedding_loss(points, graph, parameters, graph_index=None):
+    _, subgraph_index = representative_subgraph(points, graph, parameters, graph_index, with_index=True)
+    return regularized_loss(embed(points, parameters), subgraph_index)
+    
 
-    img = image(points, graph_tree, samples_to_parents)
+"""
+Using a set of points in box-space and a parameter bundle, embeds the points in GPS coords
 
-    image_tree = KDTree(edges_as_points(img, samples_to_parents))
-    subgraph = fast_prune(points, points_tree, img, image_tree, samples_to_parents)
+Params:
+    points - (n, 2) array, or a list of points
+    parameters - one bundle, or a (k, 5) array of bundles to embed the same points under
+Returns:
+    (n, 2) array of embedded points, or (k, n, 2) for k bundles
+"""
+def embed(points, parameters):
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    x, y, theta, r, gamma = np.asarray(parameters, dtype=float).T
+    sin, cos = np.sin(theta), np.cos(theta)
 
-    subgraph_tree = KDTree(edges_as_points(subgraph, samples_to_parents))
-    return regularized_loss(points, subgraph_tree, samples_to_parents)
-    
+    # (a, b) -> (x + a r sin + b gamma r cos, y - a r cos + b gamma r sin), as one matrix per bundle
+    transform = np.stack((np.stack((r*sin, -r*cos), axis=-1),
+                          np.stack((gamma*r*cos, gamma*r*sin), axis=-1)), axis=-2)
+    offset = np.stack((x, y), axis=-1)[..., None, :]
+    return points @ transform + offset
 
-"""Using a set of points in box-space and a parameter bundle, embeds the points in GPS coords"""
-def embed(points, parameters):
-    x, y, theta, r, gamma = parameters
-    embedded_points = []
-    for point in points:
-        a, b = point
-        embedding = (x + a*r*math.sin(theta) + b*gamma*r*math.cos(theta), y - a*r*math.cos(theta) + b*gamma*r*math.sin(theta))
-        embedded_points.append(embedding)
-    return embedded_points
-
-"""Returns the image of the map from points to their closest edges"""
-def image(points, graph_tree, samples_to_edges):
-    edges = set()
-    for point in points:
-        new_edge = samples_to_edges[graph_tree.closest_point(point)]
-        edges.add(new_edge)
-    return list(edges)
+"""
+Returns the image of the map from points to their closest edges,
+as ids into graph_index.edges
+"""
+def image(points, graph_index):
+    edge_ids, _ = graph_index.nearest(points)
+    return np.unique(edge_ids)
 
 """Prunes the subgraph in a quick, heuristic way"""
-def fast_prune(points, points_tree, edges, edges_tree, samples_to_parents):
+def fast_prune(points, points_tree, edges, edges_index):
     # calc average distance from points to edges
-    points2edges_dist = 0
-    for point in points:
-        points2edges_dist += point_to_line_segment_distance(point, samples_to_parents[edges_tree.closest_point(point)])
-    points2edges_dist /= len(points)
+    _, dists = edges_index.nearest(points)
+    points2edges_dist = np.mean(dists)
     # multiply by constant to get threshold
     threshold = HOARDING_FACTOR * points2edges_dist
 
     # remove bad edges (a bad edge is one that doesn't stay close to the points)
-    for edge in edges:
-        v1, v2 = edge
-        m = (v1[0] + v2[0]) / 2, (v1[1] + v2[1]) / 2
-        v1_neighbor = points_tree.closest_point(v1)
-        v2_neighbor = points_tree.closest_point(v2)
-        m_neighbor = points_tree.closest_point(m)
-        edge_badness = np.max([point_point_dist(v1, v1_neighbor), \
-                            point_point_dist(v2, v2_neighbor), \
-                            point_point_dist(m, m_neighbor)])
+    # badness is the worst distance from either endpoint or the midpoint to the points
+    ends = np.array(edges, dtype=float)
+    probes = np.concatenate((ends[:, 0], ends[:, 1], ends.mean(axis=1)))
+    _, probe_dists = points_tree.closest_points(probes)
+    all_badness = probe_dists.reshape(3, len(edges)).max(axis=0)
+    for edge, edge_badness in zip(list(edges), all_badness):
         if edge_badness > threshold and len(edges) > 1:
             edges.remove(edge)
 
     return edges
 
-"""The euclidian distance between a point and an edge. Written by chat GPT"""
-def point_to_line_segment_distance(point, edge):
-    p = point
-    e1, e2 = edge
-
-    # Calculate the vector between e1 and e2
-    e_vec = (e2[0] - e1[0], e2[1] - e1[1])
-
-    # Calculate the vector between e1 and p
-    p_vec = (p[0] - e1[0], p[1] - e1[1])
-
-    # Calculate the dot product of e_vec and p_vec
-    dot_product = e_vec[0] * p_vec[0] + e_vec[1] * p_vec[1]
-
-    # Calculate the squared length of e_vec
-    e_vec_squared_length = e_vec[0] ** 2 + e_vec[1] ** 2
-
-    # Calculate the parameter along the line segment where the closest point to p lies
-    if e_vec_squared_length == 0:
-        print(edge)
-    param = dot_product / e_vec_squared_length
-
-    if param < 0:
-        # The closest point to p is e1
-        closest_point = e1
-    elif param > 1:
-        # The closest point to p is e2
-        closest_point = e2
-    else:
-        # The closest point to p lies along the line segment
-        closest_point = (e1[0] + param * e_vec[0], e1[1] + param * e_vec[1])
-
-    # Calculate the distance between p and the closest point
-    distance = math.sqrt((p[0] - closest_point[0]) ** 2 + (p[1] - closest_point[1]) ** 2)
-
-    return distance
-
 """
 Calculate the regularized loss of a subgraph and an emedding of points
 MSE of points into edges + k * MSE of vertices into points
 """
-def regularized_loss(points, edges_tree, samples_to_parents):
-    points2edges = 0
-    for point in points:
-        points2edges += point_to_line_segment_distance(point, samples_to_parents[edges_tree.closest_point(point)]) ** 2
-    points2edges /= len(points)
-
-    return points2edges
+def regularized_loss(points, edges_index):
+    _, dists = edges_index.nearest(points)
+    return np.mean(dists ** 2)
 
-
-"""Prunes the subgraph to minimize regularized loss"""
-def prune(points, edges, parameters):
-    if len(edges) <= 1:
-        return edges
-
-    best_loss = regularized_loss(points, edges, parameters)
-    problem_edge = None
-    for edge in edges:
-        subgraph = edges.copy()
-        subgraph.remove(edge)
-        subgraph_loss = regularized_loss(points, subgraph, parameters)
-        if subgraph_loss < best_loss:
-            best_loss = subgraph_loss
-            problem_edge = edge
-    if problem_edge is not None:
-        edges = edges.copy()
-        edges.remove(problem_edge)
-        return prune(points, edges, parameters)
-    else:
-        return edges
-    
 def point_point_dist(p1, p2):
     return math.sqrt((p1[0] - p2[0])**2 + (p1[1] - p2[1])**2)
 
-"""Returns a random intial parameter bundle"""
-def random_init():
-    x = 41.820 + 0.02 * np.random.rand()
-    y = -71.385 - 0.018 * np.random.rand()
-    theta = 2 * math.pi * np.random.rand()
-    r = 0.008 + 0.008 * np.random.rand()
-    gamma = 0.7 + 0.6 * np.random.rand()
+"""
+Returns a random intial parameter bundle
+rng is anything with a random() method, e.g. a seeded np.random.default_rng()
+"""
+def random_init(rng=np.random):
+    x = 41.820 + 0.02 * rng.random()
+    y = -71.385 - 0.018 * rng.random()
+    theta = 2 * math.pi * rng.random()
+    r = 0.008 + 0.008 * rng.random()
+    gamma = 0.7 + 0.6 * rng.random()
     return x, y, theta, r, gamma
 
 """Takes a list of edges and discretizes it into a large list of points"""
@@ -230,20 +186,26 @@ def edge_to_points(edge, dict, fineness):
         dict[(x, y)] = edge
     return points
 
-"""The best subgraph for an embedding"""
-def representative_subgraph(points, graph, parameters):
+"""An exact nearest-edge index over graph's edges, see SegmentIndex"""
+def build_edge_index(graph):
+    return SegmentIndex(graph)
+
+"""
+The best subgraph for an embedding
+With with_index set, also returns a SegmentIndex over the subgraph's edges
+"""
+def representative_subgraph(points, graph, parameters, graph_index=None, with_index=False):
     points = embed(points, parameters)
+    if graph_index is None:
+        graph_index = build_edge_index(graph)
 
     #setup for image and fast_prune
     points_tree = KDTree(points)
-    samples_to_parents = {}
-    graph_points = edges_as_points(graph, samples_to_parents)
-    graph_tree = KDTree(graph_points)
-
-    img = image(points, graph_tree, samples_to_parents)
-
-    image_tree = KDTree(edges_as_points(img, samples_to_parents))
-    return fast_prune(points, points_tree, img, image_tree, samples_to_parents)
+    image_index = graph_index.subset(image(points, graph_index))
+    subgraph = fast_prune(points, points_tree, list(image_index.edges), image_index)
+    if with_index:
+        return subgraph, SegmentIndex(subgraph)
+    return subgraph
 
 """For testing"""
 def main():
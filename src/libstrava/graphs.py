@@ -3,31 +3,37 @@ Hirearchy:
 subgraph - generates subgraph from drawing
     glue - glues paths together
         find_intersections - finds pairs which are intended to intersect
-            local_min_match - GDs to locally closest pair
-            remove_clones - removes a single clone, as defined below
-                clones - whether 2 intersections can be turned into eachother continously
-                first_intersection_better - pair of "intersecting" points are closer than other
-        remove_self_matches - remove intersections of point with self
+            close_pairs - every pair of points within GLUE_THRESH, from one spatial index
+                path_arc_lengths - distance along a path, to leave out its band of self pairs
+            connected_components - groups close pairs into blobs
+            clones - whether 2 intersections can be turned into eachother continously
         do_the_glue - edits graph dict to incorporate found intersections
         shave_stubble - removes short hairs sticking out
             hair_length - computes length of hair
             remove_hair - removes hair from graph
     segmentize - breaks graph up into distinct segments
-        compress - removes "unimportant" vertices to speed up segmentation
-            importance - measured using angle at vertex + distance to neighbors
-                angle_measure - calculates angle at a degree 2 vertex
+        split_at_critical_vertices - the part that doesn't depend on the embedding
+            compress - removes "unimportant" vertices to speed up segmentation
+                importance - measured using angle at vertex + distance to neighbors
+                    angle_measure - calculates angle at a degree 2 vertex
         get_embedding - randomly embeds drawing in map
             get_embedding_params - create random parameter bundle
-        recover_params - calc parameter bundle corresponding to pair of embedded points
-        Segment - 
-            edges_from_path
-    draw - each segment draws itself a path
-        __continue_path - finds best next intersection to move to
-            __alignment - alignment of possible continuation w/ vector field
-                __get_vec - samples vector field w/ which we want to be aligned
-        __finish - finihses attempted draw with A*
-            a_star - connects points in graph
-                __reconstruct_path
+        embed_segments - places the pieces between embedded critical vertices
+            recover_params - calc parameter bundle corresponding to pair of embedded points
+            Segment - 
+                edges_from_path
+    best_embedding - with candidates > 1, segmentizes and draws many embeddings, keeps the best
+        snap_embeddings - embeds every candidate at once, scores how well it lands
+        Segment.drawing_loss - scores a drawn segment
+    local_search - moves critical vertices around, redrawing only what they touch
+        embed_piece - the segments of one piece
+iter_subgraph - a provisional subgraph streamed segment by segment, then the full one
+    draw_all - each segment draws itself a path
+        walk - steps to the best aligned neighbor until stuck or done
+            __precompute_field - samples vector field near the segment in one batch
+                __field_at - vector field w/ which we want to be aligned
+        finish_start - where a stuck walk gets finished with A*
+        Router.shortest_paths - finishes every stuck walk in one batch (see routing)
 
 NOTE ON GRAPH REPRESENTATION:
 In most cases, graphs are represented as dictionaries mapping from vertices to 
@@ -35,15 +41,19 @@ neighboring vertices. Exceptions include the input to glue, which is a list
 of lists of points, with the understanding that each list corresponds to a 
 path in the natural way (neighboring points in a list are adjacent in graph).
 """
+import collections
 import math
 import numpy as np
-import random
-from functools import reduce
+import heapq
+import itertools
 import pathlib
+import sys
+import time
 
-from .kd_tree import KDTree
+from .kd_tree import KDTree, QUERY_CHUNK
 from .fast_gradient_decent import point_point_dist, embed
-from .segment import Segment, misalignment
+from .segment import Segment, misalignment, draw_all, iter_draw_all
+from .map_context import as_map_context
 from .edges import read_edges
 from .points import read_gps
 
@@ -54,6 +64,11 @@ STUBBLE_THRESH = 0.04
 IMPORTANCE_THRESH = 0.001
 ANGLE_WEIGHT = 2
 COMPRESS = False
+CANDIDATES = 1 # random embeddings tried per drawing, the best drawn one wins
+KEEP_FRACTION = 0.25 # of the candidates, the ones whose critical vertices snap best get drawn
+ANNEALING_TEMPERATURE = 0.05 # local search starts out accepting moves this much worse, relative to the loss
+SHAPE_WEIGHT = 4 # local search's penalty on a piece for scaling (per doubling) or turning (per radian) away from its start
+MIN_SHAPE_SCALE = 1 / 64 # local search counts pieces shrunk further than this, relative to r, as shrunk this far
 
 ############################## GLUE SHIT ###################################
 
@@ -61,20 +76,13 @@ COMPRESS = False
 def glue(paths):
     glued_graph = {}
 
-    kdtrees = list(map(lambda x: KDTree(x), paths))
-    points_to_indices = []
-    for path in paths:
-        path_dict = {}
-        points_to_indices.append(path_dict)
-        for i, point in enumerate(path):
-            path_dict[point] = i
-
     # add intra-path connections
     for path in paths:
         last_index = len(path) - 1
         for i, point in enumerate(path):
-            # initialize neighbors list
-            glued_graph[point] = []
+            # initialize neighbors list, unless the point came up before - a
+            # closed stroke ends on its first point, which already has neighbors
+            glued_graph.setdefault(point, [])
 
             # add neighbors, keeping edge cases in mind
             if i != 0:
@@ -83,15 +91,8 @@ def glue(paths):
                 glued_graph[point].append(path[i+1])
 
     # glue
-    for i in range(len(paths)):
-        for j in range(i, len(paths)):
-            connections = find_intersections(paths[i], paths[j], kdtrees[j], points_to_indices[j])
-            if i == j:
-                # removes (i, i) and one of (i, j) and (j, i)
-                connections = remove_self_matches(connections)
-
-            for con_i, con_j in connections:
-                do_the_glue(glued_graph, paths[i], paths[j], con_i, con_j)
+    for path1, path2, i, j in find_intersections(paths):
+        do_the_glue(glued_graph, paths[path1], paths[path2], i, j)
     
     return glued_graph
 
@@ -103,12 +104,13 @@ def do_the_glue(graph, path1, path2, i, j):
     p1 = path1[i]
     p2 = path2[j]
 
-    # if i or j is endpoint of path, just connect it onto other path
-    if i*j == 0 or i == len(path1) - 1 or j == len(path2) - 1:
+    # if i or j is endpoint of path, just connect it onto other path. Same if an
+    # earlier glue already stuck something in between j and its neighbor
+    neighbor = path2[j-1]
+    if i*j == 0 or i == len(path1) - 1 or j == len(path2) - 1 or neighbor not in graph[p2]:
         graph[p1].append(p2)
         graph[p2].append(p1)
     else: # stick i in between j and its neighbor
-        neighbor = path2[j-1]
         graph[neighbor].remove(p2)
         graph[neighbor].append(p1)
         graph[p2].remove(neighbor)
@@ -116,68 +118,147 @@ def do_the_glue(graph, path1, path2, i, j):
         graph[p1].append(p2)
         graph[p1].append(neighbor)
 
-"""Returns a list of pairs of indices at which some gluing should occur"""                
-def find_intersections(path1, path2, path2KDtree : KDTree, point2index : dict):
-    intersections = []
-
-    # add every pair within thresh
-    for i, p1 in enumerate(path1):
-        matches = path2KDtree.query_radius(p1, GLUE_THRESH)
-        for match in matches:
-            intersections.append((i, j := point2index[tuple(match)]))
-    
-    # replace them all with their corresponding local minima and remove dupes
-    intersections = list(set(map(lambda intrscn: local_min_match(path1, path2, intrscn[0], intrscn[1]), intersections)))
-
-    # remove inferior clones
-    while remove_clone(path1, path2, intersections): # remove_clone returns true when it removes a clone, false when none left
-        pass
-
-    return intersections
-
-"""Given a pair of paths and indices into them, decends to a local optimum, where closer is more optimal"""
-def local_min_match(path1, path2, index1, index2):
-    def local_min_rec(i, j):
-        cur_dist = point_point_dist(path1[i], path2[j])
-        if i != len(path1) - 1 and \
-                point_point_dist(path1[i + 1], path2[j]) < cur_dist:
-            local_min_rec(i + 1, j)
-        if i != 0 and \
-                point_point_dist(path1[i - 1], path2[j]) < cur_dist:
-            local_min_rec(i - 1, j)
-        if j != len(path2) - 1 and \
-                point_point_dist(path1[i], path2[j + 1]) < cur_dist:
-            local_min_rec(i, j + 1)
-        if j != 0 and \
-                point_point_dist(path1[i], path2[j - 1]) < cur_dist:
-            local_min_rec(i, j - 1)
-
-        return i, j
-    
-    return local_min_rec(index1, index2)
+"""
+Returns a sorted list of (path1, path2, i, j), each meaning paths[path1][i]
+should be glued to paths[path2][j].
+
+Wherever two strokes run close together, their close pairs of points form a
+blob in (i, j) index space. Blobs are the 8-connected components of the close
+pairs, found in one union-find pass, and two pairs can only be clones (see
+clones) within a blob. Each blob's local minima of distance are then taken
+closest first, keeping those that are not clones of one already kept - usually
+just one per blob, but two where strokes run alongside each other around a
+bend. Matches of a point with itself (or with a copy of itself further along
+its path, which glue already made the same vertex) are dropped last.
+
+Every path's pairs with itself include a band around the diagonal, of points
+less than GLUE_THRESH apart along the path. That band is always one blob with
+the diagonal, so rather than listing it pair by pair (it is most of the pairs
+of a dense drawing) it stands in as a single node per path, represented by (0, 0).
+"""
+def find_intersections(paths):
+    path1, path2, i, j, dist = close_pairs(paths)
+    lengths = np.array([len(path) for path in paths], dtype=int)
+    arcs = [path_arc_lengths(path) for path in paths]
+
+    # the diagonal band nodes go last, one per path
+    num_pairs = len(i)
+    bands = np.arange(len(paths))
+    path1, path2 = np.concatenate((path1, bands)), np.concatenate((path2, bands))
+    i, j = np.concatenate((i, np.zeros_like(bands))), np.concatenate((j, np.zeros_like(bands)))
+    dist = np.concatenate((dist, np.zeros(len(paths))))
+    if num_pairs == 0:
+        return []
+
+    # one integer per pair, laid out so neighbors in index space are a fixed offset apart
+    width = int(lengths.max()) + 2
+    keys = ((path1 * len(paths) + path2) * width + i + 1) * width + j + 1
+    sorted_keys = np.sort(keys[:num_pairs])
+    order = np.argsort(keys[:num_pairs])
+
+    # link each pair to its neighbors further along, the links back are the same links
+    sources, targets = [], []
+    closest_neighbor = np.full(len(keys), np.inf)
+    def link(found, neighbors, neighbor_dist):
+        np.minimum.at(closest_neighbor, found, neighbor_dist)
+        np.minimum.at(closest_neighbor, neighbors, dist[found])
+        sources.append(found)
+        targets.append(neighbors)
+    for di, dj in ((0, 1), (1, -1), (1, 0), (1, 1)):
+        neighbor_keys = keys[:num_pairs] + di * width + dj
+        slots = np.minimum(np.searchsorted(sorted_keys, neighbor_keys), num_pairs - 1)
+        found = np.flatnonzero(sorted_keys[slots] == neighbor_keys)
+        neighbors = order[slots[found]]
+        link(found, neighbors, dist[neighbors])
+
+    # and pairs of a path with itself to its band, where they touch it
+    same = np.flatnonzero(path1[:num_pairs] == path2[:num_pairs])
+    for di, dj in ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)):
+        ni, nj = i[same] + di, j[same] + dj
+        inside = (ni >= 0) & (nj >= 0) & (ni < lengths[path1[same]]) & (nj < lengths[path1[same]])
+        found, ni, nj = same[inside], ni[inside], nj[inside]
+        along = np.array([abs(arcs[p][a] - arcs[p][b]) for p, a, b in
+                          zip(path1[found].tolist(), ni.tolist(), nj.tolist())]).reshape(-1)
+        in_band = along <= GLUE_THRESH
+        found, ni, nj = found[in_band], ni[in_band], nj[in_band]
+        neighbor_dist = np.array([point_point_dist(paths[p][a], paths[p][b]) for p, a, b in
+                                  zip(path1[found].tolist(), ni.tolist(), nj.tolist())]).reshape(-1)
+        link(found, num_pairs + path1[found], neighbor_dist)
+
+    labels = connected_components(len(keys), np.concatenate(sources), np.concatenate(targets))
+
+    candidates = np.flatnonzero(dist[:num_pairs] <= closest_neighbor[:num_pairs])
+    candidates = np.concatenate((candidates, num_pairs + bands))
+    candidates = candidates[np.lexsort((keys[candidates], dist[candidates], labels[candidates]))]
+
+    kept = {}
+    for pair in candidates.tolist():
+        p1, p2 = paths[path1[pair]], paths[path2[pair]]
+        blob = kept.setdefault(labels[pair], [])
+        if not any(clones(p1, p2, (i[other], j[other]), (i[pair], j[pair])) or
+                   clones(p1, p2, (i[pair], j[pair]), (i[other], j[other])) for other in blob):
+            blob.append(pair)
+
+    best = np.array([pair for blob in kept.values() for pair in blob], dtype=int)
+    best = best[(path1[best] != path2[best]) | (dist[best] > 0)]
+    best = best[np.argsort(keys[best])]
+    return list(zip(path1[best].tolist(), path2[best].tolist(), i[best].tolist(), j[best].tolist()))
+
+"""cumulative length along path at each of its points"""
+def path_arc_lengths(path):
+    steps = np.linalg.norm(np.diff(np.asarray(path, dtype=float).reshape(-1, 2), axis=0), axis=1)
+    return np.concatenate(([0.0], np.cumsum(steps))).tolist()
 
 """
-Searches pairwise until it finds a clone. Removes the worse clone and returns true.
-If no clone is found after searching all pairs, returns false.
-NOTE: The main behavior of this function is to MUTATE the passed intersections list,
-not return a slightly different copy
+Every pair of drawing points within GLUE_THRESH of each other, found with
+batched radius queries on a KDTree over all the points of all the paths.
+A pair is only listed from the lower path id to the higher, but within a path
+both (i, j) and (j, i) are listed - except for the band of pairs less than
+GLUE_THRESH apart along their path, see find_intersections.
+
+Returns: arrays path1, path2, i, j, dist - pair k is paths[path1[k]][i[k]] and
+paths[path2[k]][j[k]], dist[k] apart
+"""
+def close_pairs(paths):
+    lengths = [len(path) for path in paths]
+    path_ids = np.repeat(np.arange(len(paths)), lengths)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(int)
+    points = np.array([point for path in paths for point in path], dtype=float).reshape(-1, 2)
+    arcs = np.concatenate([path_arc_lengths(path) for path in paths] or [[]])
+
+    tree = KDTree(points)
+    chunks = []
+    for chunk in range(0, len(points), QUERY_CHUNK):
+        first, second = tree.query_radius_pairs(points[chunk:chunk + QUERY_CHUNK], GLUE_THRESH)
+        first += chunk
+        path1, path2 = path_ids[first], path_ids[second]
+        in_band = (path1 == path2) & (np.abs(arcs[first] - arcs[second]) <= GLUE_THRESH)
+        keep = (path1 <= path2) & ~in_band
+        chunks.append((first[keep], second[keep]))
+
+    first = np.concatenate([first for first, _ in chunks] or [np.zeros(0, dtype=int)])
+    second = np.concatenate([second for _, second in chunks] or [np.zeros(0, dtype=int)])
+    path1, path2 = path_ids[first], path_ids[second]
+    dist = np.linalg.norm(points[first] - points[second], axis=1)
+    return path1, path2, first - starts[path1], second - starts[path2], dist
 
-Params:
-    path1, path2 - the two paths we're trying to glue together
-    intersections - a list of intersections (2tuples of indices) to remove clones from
-Returns:
-    a boolean - true if clone removed, false if no clones found
 """
-def remove_clone(path1, path2, intersections):
-    for i, intersection1 in enumerate(intersections):
-        for intersection2 in intersections[i+1:]:
-            if clones(path1, path2, intersection1, intersection2):
-                if first_intersection_better(path1, path2, intersection1, intersection2):
-                    intersections.remove(intersection2)
-                else:
-                    intersections.remove(intersection1)
-                return True
-    return False
+Labels the connected components of the graph on num_nodes nodes with edges
+sources[k] - targets[k], by hooking and pointer jumping until nothing changes.
+Every node ends up labeled with the smallest node id in its component.
+"""
+def connected_components(num_nodes, sources, targets):
+    labels = np.arange(num_nodes)
+    while True:
+        low = np.minimum(labels[sources], labels[targets])
+        hooked = labels.copy()
+        np.minimum.at(hooked, labels[sources], low)
+        np.minimum.at(hooked, labels[targets], low)
+        while not np.array_equal(hooked, hooked[hooked]):
+            hooked = hooked[hooked]
+        if np.array_equal(hooked, labels):
+            return labels
+        labels = hooked
 
 """
 Determines whether 2 pairs of points are "clones" in the sense that you can
@@ -229,37 +310,30 @@ def clones(path1, path2, intersection1 : tuple[int, int], intersection2 : tuple[
         
         i2, j2 = new_i, new_j
 
-"""Exactly what it sounds like. Returns true if left has closer dist, else false"""
-def first_intersection_better(path1, path2, intersection1, intersection2):
-    i1p1, i1p2 = path1[intersection1[0]], path2[intersection1[1]]
-    i2p1, i2p2 = path1[intersection2[0]], path2[intersection2[1]]
-    i1_dist = point_point_dist(i1p1, i1p2)
-    i2_dist = point_point_dist(i2p1, i2p2)
-    return i1_dist < i2_dist
-
-"""given a list of intersections, removes trivial ones and repeats"""
-def remove_self_matches(intersections):
-    i = 0
-    while i < len(intersections):
-        if intersections[i][0] == intersections[i][1]:
-            intersections.pop(i)
-        else:
-            i += 1
-
-    return list(set(sorted(intersections)))
+"""
+Removes hairs with distance < stubble_thresh, shortest first. Mutates graph.
 
-"""Removes hairs with distance < stubble_thresh"""
+Tips wait in a heap keyed on their hair length. Removing a hair can only make
+others longer (a junction it hung off may turn into a plain path vertex), so a
+popped tip whose hair grew since it was pushed just goes back in.
+"""
 def shave_stubble(graph, threshold=STUBBLE_THRESH):
-    done = False
-    while not done:
-        points = graph.keys()
-        for point in points:
-            if len(graph[point] == 1) and hair_length(point, graph) < threshold:
-                remove_hair(point, graph)
-                break
-        else:
-            done = True
-                
+    heap = [(hair_length(point, graph), point) for point in graph if len(graph[point]) == 1]
+    heapq.heapify(heap)
+    while heap:
+        length, tip = heapq.heappop(heap)
+        if length >= threshold:
+            break
+        if tip not in graph or len(graph[tip]) != 1:
+            continue
+        if (current := hair_length(tip, graph)) != length:
+            heapq.heappush(heap, (current, tip))
+            continue
+
+        base = remove_hair(tip, graph)
+        if len(graph[base]) == 1:
+            heapq.heappush(heap, (hair_length(base, graph), base))
+
 """Computes the length of the hair with point at its tip"""
 def hair_length(tip, graph):
     last_point = tip
@@ -279,8 +353,8 @@ def hair_length(tip, graph):
 
     return dist
 
-"""Removes a hair defined by its tip from the graph"""
-def remove_hair(tip : tuple[float], graph : dict[tuple[float], list[tuple[float]]]) -> None:
+"""Removes a hair defined by its tip from the graph. Returns the point it was attached to"""
+def remove_hair(tip : tuple[float], graph : dict[tuple[float], list[tuple[float]]]) -> tuple[float]:
     cur_point = tip
 
     while len(graph[cur_point]) == 1:
@@ -292,97 +366,170 @@ def remove_hair(tip : tuple[float], graph : dict[tuple[float], list[tuple[float]
         # update location
         cur_point = next_point
 
+    return cur_point
+
 ########################### END GLUE SHIT ###################################
 ############################ SEGMENTIZE #####################################
 
 """
 We have a glued graph. We need to split it into segments so that we can draw each segment.
 This function handles that.
+
+tolerance - if given, first compress the graph, dropping path vertices with importance below it.
+            Defaults to IMPORTANCE_THRESH when COMPRESS is set
 """
-def segmentize(glued_graph, ch_points_tree : KDTree) -> list[Segment]:
-    if COMPRESS:
-        compress(glued_graph)
+def segmentize(glued_graph, ch_points_tree : KDTree, tolerance=None) -> list[Segment]:
+    critical_vertices, pieces = split_at_critical_vertices(glued_graph, tolerance)
+    embeddings = get_embedding(ch_points_tree, critical_vertices)
+    segments = embed_segments(pieces, dict(zip(critical_vertices, embeddings, strict=True)), ch_points_tree)
+    for segment in segments:
+        print("segment:")
+        print(segment.path)
+    return segments
 
-    segments = []
+"""
+The embedding-independent half of segmentize: compresses the glued graph if
+asked to, then follows it from every critical vertex (degree other than 2, or
+three spread round a component that is a pure cycle) to the next one.
+
+Returns:
+    critical_vertices - list of the critical vertices
+    pieces - list of (start vertex, end vertex, path between them) in the drawing
+"""
+def split_at_critical_vertices(glued_graph, tolerance=None):
+    if tolerance is None and COMPRESS:
+        tolerance = IMPORTANCE_THRESH
+    if tolerance is not None:
+        compress(glued_graph, tolerance)
 
     critical_vertices = set()
     for vertex in glued_graph.keys():
         if len(glued_graph[vertex]) != 2:
             critical_vertices.add(vertex)
-    critical_vertices = list(critical_vertices)
 
-    embeddings = {k : v for (k, v) in zip(critical_vertices, get_embedding(ch_points_tree, list(critical_vertices)), strict=True)}
-    
-    for vertex in critical_vertices:
+    pieces = []
+    visited = set()
+    for vertex in list(critical_vertices):
         for neighbor in glued_graph[vertex]:
-            # follow this path
-            last = vertex
-            current = neighbor
-            path = [last, current]
-            while len(neighbors := glued_graph[current]) == 2:
-                if neighbors[0] == last:
-                    next = neighbors[1]
-                else:
-                    next = neighbors[0]
-                path.append(next)
-                last = current
-                current = next
-
-            # (vertex, current) are endpoints
-            embedded_endpoints = (embeddings[vertex], embeddings[current])
-            params = recover_parameters((vertex, current), embedded_endpoints)
-
-            path = embed(path, params)
-
-            # ensure endpoints exactly match graph intersections
-            path[0] = embeddings[vertex]
-            path[-1] = embeddings[current]
-
-            if current == vertex: # we just traversed a loop
-                # split loop into 2 segments
-                path_len = len(path)
-                
-                # ensure endpoints of split segments are intersections on graph
-                break_point = path[path_len // 2]
-                break_point = ch_points_tree.closest_point(break_point)
-                path[path_len // 2] = break_point
-
-                print("segment:")
-                print(path[: path_len // 2 + 1])
-                print("segment:")
-                print(path[path_len // 2 :])
-
-                segments.append(Segment(path[: path_len // 2 + 1]))
-                segments.append(Segment(path[path_len // 2 :]))
-
-            # so as to avoid double-counting segments
-            # we'll miss a segment if both its endpoints get hashed to the same thing, but nbd
-            if hash(tuple(vertex)) < hash(tuple(current)):
-                print("segment:")
-                print(path)
-                segments.append(Segment(path))
+            pieces.append(follow_piece(glued_graph, critical_vertices, vertex, neighbor, visited))
+
+    # what's left are components that are pure cycles, like a stroke closing on
+    # itself. Make three vertices a third of the way round from each other on
+    # each critical: a piece from a vertex back to itself has no length to scale
+    # its embedding by, and two pieces between the same pair of vertices would
+    # both be drawn as the shortest path between them
+    for vertex in glued_graph.keys():
+        if vertex not in visited:
+            cycle = follow_piece(glued_graph, {vertex}, vertex, glued_graph[vertex][0], set())[2]
+            ends = {cycle[(len(cycle) - 1) * k // 3] for k in range(3)}
+            critical_vertices.update(ends)
+            for end in ends:
+                for neighbor in glued_graph[end]:
+                    pieces.append(follow_piece(glued_graph, critical_vertices, end, neighbor, visited))
+    return list(critical_vertices), pieces
+
+"""
+Follows the drawing from critical vertex through neighbor to the next critical
+vertex, marking the vertices passed as visited. Returns the piece as
+(start vertex, end vertex, path between them)
+"""
+def follow_piece(glued_graph, critical_vertices, vertex, neighbor, visited):
+    last = vertex
+    current = neighbor
+    path = [last, current]
+    visited.add(vertex)
+    while current not in critical_vertices:
+        visited.add(current)
+        neighbors = glued_graph[current]
+        if neighbors[0] == last:
+            next = neighbors[1]
+        else:
+            next = neighbors[0]
+        path.append(next)
+        last = current
+        current = next
+    return vertex, current, path
+
+"""
+The embedding-dependent half of segmentize: places every piece of the drawing
+between the map vertices its critical vertices are embedded at.
+
+Params:
+    pieces - as returned by split_at_critical_vertices
+    embeddings - dict from critical vertex to the map vertex it is embedded at
+"""
+def embed_segments(pieces, embeddings, ch_points_tree : KDTree) -> list[Segment]:
+    return [segment for piece in pieces for segment in embed_piece(piece, embeddings, ch_points_tree)]
+
+"""The segments one piece of the drawing embeds to, see embed_segments. May be none"""
+def embed_piece(piece, embeddings, ch_points_tree : KDTree) -> list[Segment]:
+    vertex, current, path = piece
+    segments = []
+    # (vertex, current) are endpoints
+    embedded_endpoints = (embeddings[vertex], embeddings[current])
+    params = recover_parameters((vertex, current), embedded_endpoints)
+
+    path = list(map(tuple, embed(path, params).tolist()))
+
+    # ensure endpoints exactly match graph intersections
+    path[0] = embeddings[vertex]
+    path[-1] = embeddings[current]
+
+    if current == vertex: # we just traversed a loop
+        # split loop into 2 segments
+        path_len = len(path)
+
+        # ensure endpoints of split segments are intersections on graph
+        break_point = path[path_len // 2]
+        break_point = ch_points_tree.closest_point(break_point)
+        path[path_len // 2] = break_point
+
+        segments.append(Segment(path[: path_len // 2 + 1]))
+        segments.append(Segment(path[path_len // 2 :]))
+
+    # so as to avoid double-counting segments
+    # we'll miss a segment if both its endpoints get hashed to the same thing, but nbd
+    if hash(tuple(vertex)) < hash(tuple(current)):
+        segments.append(Segment(path))
 
     return segments
 
-"""Compresses the drawing representation to one without many edges"""
-def compress(graph):
-    points = graph.keys()
-    done = False
-    while not done:
-        points = random.shuffle(points)
-        for point in points:
-            if len(neighbors := graph[point]) == 2:
-                n1, n2 = neighbors
-                if importance(point, n1, n2) < IMPORTANCE_THRESH:
-                    points.remove(point)
-                    graph[n1].remove(point)
-                    graph[n1].append(n2)
-                    graph[n2].remove(point)
-                    graph[n2].append(n1)
-                    del graph[point]
-                    break
+"""
+Compresses the drawing representation to one without many edges, by removing
+path (degree 2) vertices least important first until every one left has
+importance >= threshold. Mutates graph.
+
+Visvalingam-style: vertices wait in a heap keyed on importance, and removing one
+only changes the importance of its two neighbors, which get pushed again.
+entry[point] is the id of point's live heap entry, older entries are skipped.
+"""
+def compress(graph, threshold=IMPORTANCE_THRESH):
+    ids = itertools.count()
+    entry = {}
+    heap = []
+    def push(point):
+        if len(graph[point]) == 2:
+            entry[point] = next(ids)
+            heapq.heappush(heap, (importance(graph, point), entry[point], point))
         else:
-            done = True
+            entry.pop(point, None)
+
+    for point in graph:
+        push(point)
+    while heap:
+        score, entry_id, point = heapq.heappop(heap)
+        if entry.get(point) != entry_id:
+            continue
+        if score >= threshold:
+            break
+
+        n1, n2 = graph[point]
+        graph[n1][graph[n1].index(point)] = n2
+        graph[n2][graph[n2].index(point)] = n1
+        del graph[point]
+        del entry[point]
+        push(n1)
+        push(n2)
 
 """
 How important a point is to the structure of drawing graph
@@ -397,9 +544,12 @@ def importance(graph, point):
 
     ldist = point_point_dist(lneighbor, point)
     rdist = point_point_dist(rneighbor, point)
-    angle = angle_measure(lneighbor, point, rneighbor)
+    if ldist == 0 or rdist == 0: # a repeated point adds nothing
+        return 0.0
+    # how far the drawing turns at point, 0 on a straight line
+    turn = math.pi - angle_measure(lneighbor, point, rneighbor)
 
-    return angle ** ANGLE_WEIGHT * (ldist + rdist)
+    return turn ** ANGLE_WEIGHT * (ldist + rdist)
 
 """
 calculates the measure of angle abc in radians
@@ -409,7 +559,7 @@ https://stackoverflow.com/questions/35176451/python-code-to-calculate-angle-betw
 def angle_measure(a, b, c):
     a = np.array(a)
     b = np.array(b)
-    c = np.array(b)
+    c = np.array(c)
 
     ba = a - b
     bc = c - b
@@ -422,22 +572,46 @@ Gets a representation of the vertices of the fundemental graph in vertices of th
 Params:
     ch_points_tree - a kd tree made from the college hill graph vertices (combined.txt)
     fg_points - the vertices of the fundemental graph
+    params - the parameter bundle to embed with, random by default
 """
-def get_embedding(ch_points_tree : KDTree, fg_points):
-    embedded_points = embed(fg_points, get_embedding_params())
+def get_embedding(ch_points_tree : KDTree, fg_points, params=None):
+    embedded_points = embed(fg_points, params or get_embedding_params())
     # map points into college hill points
-    map_image = map(lambda x: ch_points_tree.closest_point(x), embedded_points)
+    indices, _ = ch_points_tree.closest_points(embedded_points)
+    map_image = map(tuple, ch_points_tree.points[indices].tolist())
     # add back points that we removed
     # map(lambda x: ch_points_tree.add(x), injection_image) <- used when injecting
 
     return list(map_image)
 
-def get_embedding_params():
-    x = 41.830 #+ 0.010 * np.random.rand()
-    y = -71.390 #- 0.010 * np.random.rand()
-    theta = 0#2 * math.pi * np.random.rand()
-    r = 0.02 + 0.01 * np.random.rand()
-    gamma = 0.8 + 0.4 * np.random.rand()
+"""
+Embeds the critical vertices with every one of a batch of parameter bundles at
+once, and measures how far each bundle had to move them to land on map
+vertices, relative to its scale: mean squared snap distance / r^2. That is a
+cheap stand-in for how well the drawing will fit the map there.
+
+Returns:
+    embeddings - per bundle, the list of map vertices the critical vertices land on
+    snap_losses - (k,) float array, per bundle
+"""
+def snap_embeddings(ch_points_tree : KDTree, critical_vertices, params):
+    params = np.asarray(params, dtype=float).reshape(-1, 5)
+    if not critical_vertices:
+        return [[] for _ in params], np.zeros(len(params))
+    embedded = embed(critical_vertices, params).reshape(-1, 2)
+    indices, dists = ch_points_tree.closest_points(embedded)
+    points = list(map(tuple, ch_points_tree.points[indices].tolist()))
+    n = len(critical_vertices)
+    embeddings = [points[i:i + n] for i in range(0, len(points), n)]
+    snap_losses = (dists.reshape(len(params), n) ** 2).mean(axis=1) / params[:, 3] ** 2
+    return embeddings, snap_losses
+
+def get_embedding_params(rng=np.random):
+    x = 41.830 #+ 0.010 * rng.random()
+    y = -71.390 #- 0.010 * rng.random()
+    theta = 0#2 * math.pi * rng.random()
+    r = 0.02 + 0.01 * rng.random()
+    gamma = 0.8 + 0.4 * rng.random()
     return x, y, theta, r, gamma
 
 """
@@ -500,18 +674,259 @@ def lop2loe(path):
 
 """
 The big guy. Takes in a drawing, represented as a list of paths, and outputs
-an exstravaganza run as a list of edges.
+an exstravaganza run as a list of edges. ch_graph is a MapContext or a dict graph.
+pool, a DrawPool over ch_graph, draws the segments in parallel. With candidates
+> 1 the embedding is the best of that many (see best_embedding), and with a
+local_search_budget it is then improved for that many seconds, or with
+local_search_moves for that many proposed moves (see local_search).
+seed seeds every random choice. Time budgets still decide how much gets tried,
+so for a drawing that replays exactly from its seed pass time_budget=None and
+local_search_moves rather than local_search_budget.
 """
-def get_subgraph(ch_graph, ch_points_tree, paths):
+def get_subgraph(ch_graph, ch_points_tree, paths, tolerance=None, pool=None,
+                 candidates=CANDIDATES, time_budget=None, local_search_budget=None, seed=None,
+                 local_search_moves=None):
+    context = as_map_context(ch_graph)
+    rng = np.random.default_rng(seed)
     glued_graph = glue(paths)
     print(glued_graph)
-    segments = segmentize(glued_graph, ch_points_tree)
-    #print([segment.print() for segment in segments])
-    drawn_segments = list(map(lambda x: x.draw(ch_graph), segments))
-    answer = reduce(lambda x, y: x + y, drawn_segments, [])
+    critical_vertices, pieces = split_at_critical_vertices(glued_graph, tolerance)
+    answer = embed_and_draw(critical_vertices, pieces, context, ch_points_tree, pool, candidates,
+                            time_budget, local_search_budget, rng, local_search_moves)
     print("ANSWER:", answer)
     return answer
 
+"""
+get_subgraph's work once the drawing is split into pieces: embeds them, draws
+them and improves the embedding. Returns the drawn edges
+"""
+def embed_and_draw(critical_vertices, pieces, context, ch_points_tree, pool, candidates, time_budget,
+                   local_search_budget, rng, local_search_moves=None):
+    if candidates > 1:
+        embeddings, drawn_segments, params = best_embedding(critical_vertices, pieces, context, ch_points_tree,
+                                                            candidates, time_budget, pool, rng)
+    else:
+        params = get_embedding_params(rng)
+        embeddings = dict(zip(critical_vertices, get_embedding(ch_points_tree, critical_vertices, params), strict=True))
+        drawn_segments = draw_all(embed_segments(pieces, embeddings, ch_points_tree), context, pool)
+    if local_search_budget or local_search_moves:
+        _, drawn_segments, _ = local_search(pieces, embeddings, params, context, ch_points_tree,
+                                            local_search_budget, rng, local_search_moves)
+    return list(itertools.chain.from_iterable(drawn_segments))
+
+"""
+get_subgraph as a stream of progress events, for showing the route while it is
+still being drawn. Yields (kind, payload) pairs, in order:
+    ("glue", number of vertices in the glued graph)
+    ("segmentize", number of segments)
+    ("segment", drawn edges) - once per segment, as soon as it is drawn
+    ("replace", drawn edges) - the whole route, as get_subgraph would draw it
+Drawing has to start before any candidate is drawn in full, so the segments
+streamed are a provisional route: with candidates > 1 its embedding is just the
+one whose critical vertices snap best (see snap_embeddings), with no local
+search. The full pipeline then runs with the same candidates, and as the
+provisional embedding is the first of them best_embedding draws, it does so
+from the PathCache. Closing the generator stops the work at the next segment,
+or once the full pipeline is done. seed, an int or None, and local_search_moves
+are as for get_subgraph.
+"""
+def iter_subgraph(ch_graph, ch_points_tree, paths, tolerance=None, pool=None, candidates=CANDIDATES,
+                  time_budget=None, local_search_budget=None, seed=None, local_search_moves=None):
+    context = as_map_context(ch_graph)
+    glued_graph = glue(paths)
+    yield "glue", len(glued_graph)
+
+    critical_vertices, pieces = split_at_critical_vertices(glued_graph, tolerance)
+    seed = np.random.SeedSequence(seed) # so both passes draw the same candidates, even unseeded
+    rng = np.random.default_rng(seed)
+    params = [get_embedding_params(rng) for _ in range(max(candidates, 1))]
+    embeddings, snap_losses = snap_embeddings(ch_points_tree, critical_vertices, params)
+    best = int(np.argmin(snap_losses))
+    segments = embed_segments(pieces, dict(zip(critical_vertices, embeddings[best])), ch_points_tree)
+    yield "segmentize", len(segments)
+
+    for path in iter_draw_all(segments, context, pool):
+        yield "segment", path
+
+    yield "replace", embed_and_draw(critical_vertices, pieces, context, ch_points_tree, pool, candidates,
+                                    time_budget, local_search_budget, np.random.default_rng(seed),
+                                    local_search_moves)
+
+"""
+Random-restart search over embeddings. Tries candidates random embeddings,
+draws the ones whose critical vertices snap onto the map best (KEEP_FRACTION of
+them, best first) and keeps the drawing with the lowest loss, summed over its
+segments and scaled by 1/r^2 so differently sized embeddings compare fairly.
+Once time_budget seconds have passed no further candidate is started, but at
+least one always gets drawn.
+
+Params:
+    critical_vertices, pieces - as returned by split_at_critical_vertices
+    rng - a numpy Generator to draw the candidates with
+Returns:
+    embeddings - the best candidate, as a dict from critical vertex to map vertex
+    drawn - its drawn segments, a list of edge lists
+    params - the parameter bundle it was embedded with
+"""
+def best_embedding(critical_vertices, pieces, context, ch_points_tree, candidates, time_budget=None, pool=None,
+                   rng=np.random):
+    deadline = math.inf if time_budget is None else time.time() + time_budget
+    params = [get_embedding_params(rng) for _ in range(candidates)]
+    embeddings, snap_losses = snap_embeddings(ch_points_tree, critical_vertices, params)
+    shortlist = np.argsort(snap_losses, kind="stable")[:max(1, math.ceil(candidates * KEEP_FRACTION))]
+
+    best, best_drawn, best_params, best_loss, drawn_count = {}, [], params[0], math.inf, 0
+    for candidate in shortlist.tolist():
+        if drawn_count and time.time() > deadline:
+            break
+        embedding = dict(zip(critical_vertices, embeddings[candidate]))
+        segments = embed_segments(pieces, embedding, ch_points_tree)
+        drawn = draw_all(segments, context, pool)
+        loss = sum(segment.drawing_loss(path) for segment, path in zip(segments, drawn)) / params[candidate][3] ** 2
+        drawn_count += 1
+        if loss < best_loss:
+            best, best_drawn, best_params, best_loss = embedding, drawn, params[candidate], loss
+
+    print(f"[+] drew {drawn_count} of {candidates} candidate embeddings, best loss {best_loss:.4g}", file=sys.stderr)
+    return best, best_drawn, best_params
+
+"""
+The optional local optimization phase: simulated annealing over where the
+critical vertices sit on the map. A move shifts one critical vertex to a
+neighboring map vertex; only the pieces of the drawing ending at it are
+re-embedded and redrawn, and the loss is updated by their change alone, which
+keeps moves cheap enough to make hundreds of them. Worse moves are accepted
+with a probability that falls to zero as time_budget seconds run out, or as
+max_moves proposed moves are used up, whichever comes first, and the best
+embedding seen wins. Given max_moves and no time_budget, the result depends on
+seed alone.
+
+The loss is search_loss: best_embedding's, scaled by 1/r^2 of the bundle the
+drawing was embedded with, plus a penalty per piece for straying from that
+bundle's shape. Without it the cheapest drawing would be a shrunken one, whose
+short segments have small distance errors. For the same reason no move may put
+a critical vertex on a map vertex another one already sits on, which would
+collapse the pieces between them to nothing, or that shrinks the box the
+drawing spans. Moves those rules allow are the ones counted as tried.
+
+Params:
+    pieces - as returned by split_at_critical_vertices
+    embeddings - the starting embedding, dict from critical vertex to map vertex
+    params - the parameter bundle embeddings came from
+    time_budget - seconds to search for, or None for no limit
+    seed - for the random moves, an int or a numpy Generator
+    max_moves - moves to propose, whether or not the rules allow them, or None for no limit
+Returns:
+    best - the best embedding, dict from critical vertex to map vertex
+    best_drawn - its drawn segments, a list of edge lists
+    best_loss - its search_loss
+"""
+def local_search(pieces, embeddings, params, context, ch_points_tree, time_budget, seed=None, max_moves=None):
+    if time_budget is None and max_moves is None:
+        raise ValueError("local search needs a time_budget or max_moves to stop at")
+    rng = np.random.default_rng(seed)
+    start = time.time()
+    csr = context.csr
+    embeddings = dict(embeddings)
+
+    pieces = [piece for piece in pieces if embed_piece(piece, embeddings, ch_points_tree)]
+    start_shapes = [piece_shape(piece, embeddings, params) for piece in pieces]
+    draw_piece = lambda i: piece_loss(pieces[i], embeddings, params, start_shapes[i], context, ch_points_tree)
+    state = [draw_piece(i) for i in range(len(pieces))]
+    occupied = collections.Counter(embeddings.values())
+    def extent(state):
+        points = np.array([point for drawn, _ in state for path in drawn for edge in path for point in edge])
+        return points.max(axis=0) - points.min(axis=0) if len(points) else np.zeros(2)
+    touching = {}
+    for i, (vertex, current, _) in enumerate(pieces):
+        touching.setdefault(vertex, set()).add(i)
+        touching.setdefault(current, set()).add(i)
+    movable = list(touching)
+    loss = start_loss = sum(piece_state[1] for piece_state in state)
+    if not movable:
+        return embeddings, [path for drawn, _ in state for path in drawn], loss
+    start_extent = extent(state)
+
+    best_loss, best_state, best = loss, list(state), dict(embeddings)
+    proposed = tried = accepted = 0
+    while True:
+        # how much of the search is done, by the time or the moves, whichever is further along
+        elapsed = time.time() - start
+        done = max(0 if time_budget is None else elapsed / time_budget,
+                   0 if max_moves is None else proposed / max_moves)
+        if done >= 1:
+            break
+        proposed += 1
+        vertex = movable[rng.integers(len(movable))]
+        old_point = embeddings[vertex]
+        neighbors = csr.neighbors_of(csr.vertex_id(old_point))
+        if len(neighbors) == 0:
+            continue
+        new_point = csr.points[neighbors[rng.integers(len(neighbors))]]
+        if occupied[new_point]:
+            continue
+        embeddings[vertex] = new_point
+        affected = list(touching[vertex])
+        redrawn = [draw_piece(i) for i in affected]
+        moved = list(state)
+        for i, piece_state in zip(affected, redrawn):
+            moved[i] = piece_state
+        if (extent(moved) < start_extent).any():
+            embeddings[vertex] = old_point
+            continue
+        tried += 1
+
+        delta = sum(piece_state[1] for piece_state in redrawn) - sum(state[i][1] for i in affected)
+        temperature = ANNEALING_TEMPERATURE * loss * (1 - done)
+        if delta <= 0 or (temperature > 0 and rng.random() < math.exp(-delta / temperature)):
+            accepted += 1
+            occupied[old_point] -= 1
+            occupied[new_point] += 1
+            state = moved
+            loss += delta
+            if loss < best_loss:
+                best_loss, best_state, best = loss, list(state), dict(embeddings)
+        else:
+            embeddings[vertex] = old_point
+
+    print(f"[+] local search: {tried} moves tried, {accepted} accepted, loss {start_loss:.4g} -> "
+          f"{best_loss:.4g}", file=sys.stderr)
+    return best, [path for drawn, _ in best_state for path in drawn], best_loss
+
+"""
+local_search's loss for an embedding, computed from scratch: the sum of
+piece_loss over the pieces that make segments, with shapes measured against
+start_embeddings
+"""
+def search_loss(pieces, embeddings, start_embeddings, params, context, ch_points_tree):
+    pieces = [piece for piece in pieces if embed_piece(piece, embeddings, ch_points_tree)]
+    return sum(piece_loss(piece, embeddings, params, piece_shape(piece, start_embeddings, params),
+                          context, ch_points_tree)[1] for piece in pieces)
+
+"""
+One piece's drawn segments under embeddings, and its part of local_search's
+loss: the segments' drawing_loss scaled by 1/r^2 of params, plus SHAPE_WEIGHT
+times the squared log2 of the piece's scale relative to r and the squared angle
+it turned by since start_shape, both as recover_parameters sees its ends
+"""
+def piece_loss(piece, embeddings, params, start_shape, context, ch_points_tree):
+    segments = embed_piece(piece, embeddings, ch_points_tree)
+    drawn = draw_all(segments, context)
+    fit = sum(segment.drawing_loss(path) for segment, path in zip(segments, drawn)) / params[3] ** 2
+    if piece[0] == piece[1]: # a loop's ends don't say how it was embedded
+        return drawn, fit
+    (scale, theta), (start_scale, start_theta) = piece_shape(piece, embeddings, params), start_shape
+    penalty = math.log2(max(scale, MIN_SHAPE_SCALE)) ** 2
+    if scale > 0 and start_scale > 0: # ends on one map vertex have no angle
+        penalty += ((theta - start_theta + math.pi) % (2 * math.pi) - math.pi) ** 2
+    return drawn, fit + SHAPE_WEIGHT * penalty
+
+"""the scale relative to params' and the angle a piece's ends are embedded with, see recover_parameters"""
+def piece_shape(piece, embeddings, params):
+    vertex, current, _ = piece
+    _, _, theta, r, _ = recover_parameters((vertex, current), (embeddings[vertex], embeddings[current]))
+    return r / params[3], theta
+
 def main():
     graph = graph_from_edges(read_edges(f"{root}/data/edge_list.txt"))
     points_tree = KDTree(list(graph.keys()))
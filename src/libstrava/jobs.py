@@ -0,0 +1,301 @@
+"""
+An in-process job queue for route generation.
+
+Drawing a route takes long enough that running it inside the request thread
+ties up the server under a burst of users. Instead a request submits a job and
+gets its id back straight away, and the work runs on a bounded pool of worker
+processes (forked after the map is loaded, so they share it). The queue has a
+depth limit: past it submissions are refused rather than piling up, which is
+the caller's cue to back off. Submissions with the same content key as a job
+that is still pending, or finished recently, get that job instead of a new one.
+A worker that dies fails the jobs it took down with it, and the pool is started
+afresh for the next ones.
+
+A server running in several processes shares one queue between them, so that a
+job can be polled from any of them, identical submissions coalesce whichever
+process takes them, and the depth limit holds for the whole server:
+serve_job_queue runs the queue in a process of its own, and each server process
+reaches it through a JobQueueClient.
+"""
+import collections
+import concurrent.futures
+import multiprocessing
+import multiprocessing.util
+import os
+import sys
+import threading
+import time
+import uuid
+from multiprocessing.managers import BaseManager
+
+MAX_PENDING = 64 # jobs queued or running at once; more are refused
+KEEP_FINISHED = 256 # finished jobs remembered for polling and coalescing
+PARENT_POLL = 0.5 # seconds between a served queue's checks that the process serving it is still alive
+
+"""Raised by JobQueue.submit when the queue is full"""
+class QueueFull(Exception):
+    pass
+
+"""
+One submitted job. status is one of "queued", "running", "done" or "failed";
+once done, result holds the return value, once failed, error the exception text
+"""
+class Job:
+    def __init__(self, key, future):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.future = future
+        self.submitted = time.time()
+
+    @property
+    def status(self) -> str:
+        if not self.future.done():
+            return "running" if self.future.running() else "queued"
+        return "failed" if self.future.exception() is not None else "done"
+
+    @property
+    def result(self):
+        return self.future.result() if self.status == "done" else None
+
+    @property
+    def error(self):
+        return str(self.future.exception()) if self.status == "failed" else None
+
+    """Blocks until the job finishes or timeout seconds pass. Returns whether it finished"""
+    def wait(self, timeout=None) -> bool:
+        done, _ = concurrent.futures.wait([self.future], timeout)
+        return bool(done)
+
+"""
+How to start job workers: forked while this is the process's only thread, as
+forking is only safe then (see draw_pool.start_method), else from a forkserver
+(or spawned where there is none), which import run's module afresh
+"""
+def worker_context():
+    methods = multiprocessing.get_all_start_methods()
+    if "fork" in methods and threading.active_count() == 1:
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+"""
+Params:
+    run - the function a job runs, module level so workers can find it
+    processes - worker processes, defaults to one per core
+    max_pending - see MAX_PENDING
+    keep_finished - see KEEP_FINISHED
+"""
+class JobQueue:
+    def __init__(self, run, processes=None, max_pending=MAX_PENDING, keep_finished=KEEP_FINISHED):
+        self.run = run
+        self.max_pending = max_pending
+        self.keep_finished = keep_finished
+        self.processes = processes or os.cpu_count() or 1
+        self.executor = concurrent.futures.ProcessPoolExecutor(self.processes, mp_context=worker_context())
+        self.jobs = {} # id -> Job
+        self.by_key = {} # content key -> id of the latest job with it
+        self.finished = collections.deque() # ids of finished jobs, oldest first
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.coalesced = 0
+        self.refused = 0
+        self.restarts = 0
+        self.executor.submit(int).result() # fork the workers now, not from a request thread later
+
+    """
+    Queues run(*args) under key, or returns the pending or recently finished job
+    that already has key. Raises QueueFull if max_pending jobs are pending.
+    """
+    def submit(self, key, *args) -> Job:
+        with self.lock:
+            if (job := self.jobs.get(self.by_key.get(key))) is not None and job.status != "failed":
+                self.coalesced += 1
+                return job
+            if self.pending() >= self.max_pending:
+                self.refused += 1
+                raise QueueFull(f"queue full, {self.max_pending} jobs pending")
+            executor = self.executor
+            try:
+                future = executor.submit(self.run, *args)
+            except concurrent.futures.process.BrokenProcessPool:
+                executor = self.__restart(executor)
+                future = executor.submit(self.run, *args)
+            job = Job(key, future)
+            self.jobs[job.id] = job
+            self.by_key[key] = job.id
+            self.submitted += 1
+        job.future.add_done_callback(lambda _: self.__finish(job, executor))
+        return job
+
+    """
+    Replaces executor, whose pool broke as a worker died, with a fresh one, if it
+    is still the current one. The jobs it had were failed with BrokenProcessPool
+    as it broke. Call with self.lock held. Returns the current executor
+    """
+    def __restart(self, executor):
+        if executor is self.executor:
+            print("[-] Error: a job worker died, restarting the job workers", file=sys.stderr)
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.processes, mp_context=worker_context())
+            self.restarts += 1
+        return self.executor
+
+    """
+    Remembers job, run on executor, as finished, forgetting the oldest finished
+    jobs past keep_finished. A job failed by its worker dying restarts the pool
+    """
+    def __finish(self, job, executor):
+        with self.lock:
+            if not job.future.cancelled() and isinstance(job.future.exception(),
+                                                         concurrent.futures.process.BrokenProcessPool):
+                self.__restart(executor)
+            self.finished.append(job.id)
+            while len(self.finished) > self.keep_finished:
+                old = self.jobs.pop(self.finished.popleft(), None)
+                if old is not None and self.by_key.get(old.key) == old.id:
+                    del self.by_key[old.key]
+
+    """The job with id job_id, or None if there is none (or it was forgotten)"""
+    def get(self, job_id) -> Job:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    """jobs queued or running. Call with self.lock held"""
+    def pending(self) -> int:
+        return len(self.jobs) - len(self.finished)
+
+    """Counters for monitoring, e.g. the backend's /api/stats"""
+    def stats(self) -> dict:
+        with self.lock:
+            return {"pending": self.pending(),
+                    "max_pending": self.max_pending,
+                    "finished": len(self.finished),
+                    "submitted": self.submitted,
+                    "coalesced": self.coalesced,
+                    "refused": self.refused,
+                    "restarts": self.restarts}
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
+
+############################ SHARED QUEUE ###############################
+
+"""A job's id, status, and its result or error, as plain data that can cross processes"""
+def job_state(job) -> dict:
+    return {"id": job.id, "status": job.status, "result": job.result, "error": job.error}
+
+"""
+The JobQueue as served by serve_job_queue: the same calls, with jobs passed
+as job_state dicts
+"""
+class ServedQueue:
+    def __init__(self, queue):
+        self.queue = queue
+
+    def submit(self, key, *args) -> dict:
+        return job_state(self.queue.submit(key, *args))
+
+    def get(self, job_id) -> dict:
+        job = self.queue.get(job_id)
+        return None if job is None else job_state(job)
+
+    """Blocks until the job finishes or timeout seconds pass, then returns its state"""
+    def wait(self, job_id, timeout=None) -> dict:
+        job = self.queue.get(job_id)
+        if job is None:
+            return None
+        job.wait(timeout)
+        return job_state(job)
+
+    def stats(self) -> dict:
+        return self.queue.stats()
+
+"""the queue served from this process, see serve_job_queue"""
+served = None
+
+def served_queue():
+    return served
+
+class JobQueueManager(BaseManager):
+    pass
+
+JobQueueManager.register("queue", callable=served_queue)
+
+"""
+Initializer of the served queue's process: starts the queue before the manager
+starts its threads, so its workers can be forked. The queue is shut down with
+the manager, or if parent dies first
+"""
+def start_served_queue(parent, run, processes, max_pending, keep_finished):
+    global served
+    served = ServedQueue(JobQueue(run, processes, max_pending, keep_finished))
+    multiprocessing.util.Finalize(served, served.queue.shutdown, exitpriority=10) # as the manager shuts down
+    print(f"[+] serving the job queue from process {os.getpid()}", file=sys.stderr)
+
+    def watch_parent():
+        while os.getppid() == parent:
+            time.sleep(PARENT_POLL)
+        print(f"[-] Error: process {parent} serving the job queue died, stopping it", file=sys.stderr)
+        served.queue.shutdown()
+        os._exit(0)
+    threading.Thread(target=watch_parent, daemon=True).start()
+
+"""
+Starts a JobQueue, with JobQueue's params, in a process of its own, for the
+processes forked from this one afterwards to share through JobQueueClients on
+the returned manager's address. Call while this process has no other threads
+(so the queue process can be forked), and shut it down with manager.shutdown()
+"""
+def serve_job_queue(run, processes=None, max_pending=MAX_PENDING, keep_finished=KEEP_FINISHED) -> JobQueueManager:
+    manager = JobQueueManager(ctx=worker_context())
+    manager.start(start_served_queue, (os.getpid(), run, processes, max_pending, keep_finished))
+    return manager
+
+"""
+A job of a served queue, as a JobQueueClient returns it. Unlike a Job, its
+status, result and error are as of when it was fetched, or last waited on
+"""
+class RemoteJob:
+    def __init__(self, queue, state):
+        self.queue = queue
+        self.__update(state)
+
+    def __update(self, state):
+        if state is None: # forgotten while waited on
+            state = {"id": self.id, "status": "failed", "result": None, "error": "job forgotten"}
+        self.id = state["id"]
+        self.status = state["status"]
+        self.result = state["result"]
+        self.error = state["error"]
+
+    """Blocks until the job finishes or timeout seconds pass. Returns whether it finished"""
+    def wait(self, timeout=None) -> bool:
+        self.__update(self.queue.wait(self.id, timeout))
+        return self.status in ("done", "failed")
+
+"""
+A JobQueue served by serve_job_queue, used from a process forked after it
+started. Its connections are per thread, so it may be shared by threads.
+
+Params:
+    address - the serving manager's address
+"""
+class JobQueueClient:
+    def __init__(self, address):
+        manager = JobQueueManager(address)
+        manager.connect()
+        self.queue = manager.queue()
+
+    """As JobQueue.submit, raising QueueFull the same way"""
+    def submit(self, key, *args) -> RemoteJob:
+        return RemoteJob(self.queue, self.queue.submit(key, *args))
+
+    def get(self, job_id) -> RemoteJob:
+        state = self.queue.get(job_id)
+        return None if state is None else RemoteJob(self.queue, state)
+
+    def stats(self) -> dict:
+        return self.queue.stats()
+
+    """Nothing to shut down: the queue outlives its clients, see serve_job_queue"""
+    def shutdown(self):
+        pass
@@ -1,139 +1,284 @@
 import numpy as np
 
-"""A kd-tree used to find closest points. Written (mostly) by chat-GPT"""
+LEAF_SIZE = 8 # max points per leaf bucket
+QUERY_CHUNK = 4096 # queries answered per vectorized sweep, bounds memory use
+ARRAYS = ["points", "order", "split_axis", "split_value", "leaf_index", "leaf_points", "box_min", "box_max"]
+SIZES = ["depth", "first_leaf", "leaf_size"]
+
+"""
+A kd-tree used to find closest points.
+
+The tree lives in flat arrays instead of linked Node objects. It is a complete
+binary tree in implicit layout: node k has children 2k + 1 and 2k + 2, and the
+leaves on the bottom level each own a contiguous run of self.order (indices
+into self.points). Every node stores its split and its bounding box, so a batch
+of queries can walk the tree level by level as a handful of numpy operations
+rather than one Python recursion per query.
+"""
 class KDTree:
-    def __init__(self, points):
-        if isinstance(points, list):
-            points = np.array(points)
-        self.tree = self.build_tree(points)
-        
-    class Node:
-        def __init__(self, point, left, right):
-            self.point = point
-            self.left = left
-            self.right = right
-            
-    
-    def build_tree(self, points, depth=0):
-        if len(points) == 0:
-            return None
-        
-        axis = depth % 2
-        
-        sorted_points = points[points[:, axis].argsort()]
-        mid = len(points) // 2
-        
-        return self.Node(sorted_points[mid], 
-                          self.build_tree(sorted_points[:mid], depth + 1), 
-                          self.build_tree(sorted_points[mid+1:], depth + 1))
-        
+    def __init__(self, points, leaf_size=LEAF_SIZE):
+        points = np.asarray(points, dtype=float)
+        if points.size == 0:
+            points = points.reshape(0, 2)
+        self.points = points
+        self.leaf_size = leaf_size
+        self.__build()
+
+    """The arrays and sizes that make up the tree, e.g. for np.save. See from_arrays"""
+    def to_arrays(self) -> dict:
+        arrays = {name: getattr(self, name) for name in ARRAYS}
+        arrays.update({name: np.array(getattr(self, name)) for name in SIZES})
+        return arrays
+
+    """Rebuilds a tree from to_arrays output without redoing any work, e.g. from memory-mapped files"""
+    @classmethod
+    def from_arrays(cls, arrays):
+        tree = cls.__new__(cls)
+        for name in ARRAYS:
+            setattr(tree, name, arrays[name])
+        for name in SIZES:
+            setattr(tree, name, arrays[name].item())
+        tree.__leaves = None
+        return tree
+
+    """Sorts the points into leaf buckets and fills in the node arrays"""
+    def __build(self):
+        n, dims = self.points.shape
+        self.depth = 0
+        while n > self.leaf_size << self.depth:
+            self.depth += 1
+
+        num_internal = (1 << self.depth) - 1
+        num_nodes = 2 * num_internal + 1
+        self.first_leaf = num_internal
+
+        self.order = np.arange(n)
+        self.split_axis = np.zeros(num_internal, dtype=int)
+        self.split_value = np.zeros(num_internal)
+        starts = np.zeros(num_nodes, dtype=int)
+        ends = np.zeros(num_nodes, dtype=int)
+        ends[0] = n
+
+        # nodes are numbered breadth-first, so parents are always split before children
+        for node in range(num_internal):
+            start, end = starts[node], ends[node]
+            mid = (start + end) // 2
+            idx = self.order[start:end]
+            if end - start > 1:
+                pts = self.points[idx]
+                axis = np.argmax(pts.max(axis=0) - pts.min(axis=0))
+                self.order[start:end] = idx[np.argpartition(pts[:, axis], mid - start)]
+                self.split_axis[node] = axis
+                self.split_value[node] = self.points[self.order[mid], axis]
+            starts[2*node + 1], ends[2*node + 1] = start, mid
+            starts[2*node + 2], ends[2*node + 2] = mid, end
+
+        # pad leaves to a common size so a leaf scan is one (queries, leaf_size) array op
+        leaf_starts = starts[self.first_leaf:]
+        leaf_sizes = ends[self.first_leaf:] - leaf_starts
+        width = max(int(leaf_sizes.max()) if n else 0, 1)
+        slot = np.arange(width)
+        valid = slot[None, :] < leaf_sizes[:, None]
+        self.leaf_index = np.full((len(leaf_starts), width), -1)
+        self.leaf_index[valid] = self.order[(leaf_starts[:, None] + slot[None, :])[valid]]
+        self.leaf_points = np.full((len(leaf_starts), width, dims), np.inf)
+        self.leaf_points[valid] = self.points[self.leaf_index[valid]]
+
+        # bounding boxes, leaves first then merged upwards one level at a time
+        self.box_min = np.full((num_nodes, dims), np.inf)
+        self.box_max = np.full((num_nodes, dims), -np.inf)
+        masked = np.where(valid[:, :, None], self.leaf_points, np.nan)
+        if n:
+            self.box_min[self.first_leaf:] = np.nanmin(masked, axis=1)
+            self.box_max[self.first_leaf:] = np.nanmax(masked, axis=1)
+        for level in range(self.depth - 1, -1, -1):
+            nodes = np.arange((1 << level) - 1, (1 << (level + 1)) - 1)
+            self.box_min[nodes] = np.minimum(self.box_min[2*nodes + 1], self.box_min[2*nodes + 2])
+            self.box_max[nodes] = np.maximum(self.box_max[2*nodes + 1], self.box_max[2*nodes + 2])
+
+        self.__leaves = None
+
+    """
+    Plain-list mirrors of the arrays for single queries, where numpy call overhead
+    would dominate. Built on first use so loading a big tree stays cheap
+    """
+    def __mirror(self):
+        if self.__leaves is None:
+            self.__axes = self.split_axis.tolist()
+            self.__values = self.split_value.tolist()
+            self.__leaves = [[(i, tuple(p)) for i, p in zip(idx, pts) if i >= 0]
+                             for idx, pts in zip(self.leaf_index.tolist(), self.leaf_points.tolist())]
+
+    """squared distance from each query to the bounding box of its paired node"""
+    def __box_dist2(self, queries, nodes):
+        gap = np.maximum(self.box_min[nodes] - queries, 0) + np.maximum(queries - self.box_max[nodes], 0)
+        return (gap ** 2).sum(axis=1)
+
+    """
+    Walks the tree breadth-first for a batch of queries at once. Returns the
+    surviving (query, leaf) pairs, where a (query, node) pair survives as long as
+    keep(box distance squared, query indices) holds for it.
+    """
+    def __sweep(self, queries, keep):
+        query_ids = np.arange(len(queries))
+        nodes = np.zeros(len(queries), dtype=int)
+        for level in range(self.depth + 1):
+            alive = keep(self.__box_dist2(queries[query_ids], nodes), query_ids)
+            query_ids, nodes = query_ids[alive], nodes[alive]
+            if level < self.depth:
+                query_ids = np.repeat(query_ids, 2)
+                nodes = np.stack((2*nodes + 1, 2*nodes + 2), axis=1).ravel()
+        return query_ids, nodes - self.first_leaf
+
+    """
+    Finds the closest point in the tree for every row of queries.
+
+    Params:
+        queries - an (n, 2) array (or anything np.asarray turns into one)
+    Returns:
+        indices - (n,) int array of indices into the points the tree was built from
+        distances - (n,) float array of the euclidian distance to those points
+    """
+    def closest_points(self, queries):
+        queries = np.asarray(queries, dtype=float).reshape(-1, self.points.shape[1])
+        indices = np.full(len(queries), -1)
+        distances = np.full(len(queries), np.inf)
+        if len(self.points) == 0:
+            return indices, distances
+
+        for chunk in range(0, len(queries), QUERY_CHUNK):
+            rows = slice(chunk, chunk + QUERY_CHUNK)
+            indices[rows], distances[rows] = self.__closest_chunk(queries[rows])
+        return indices, distances
+
+    def __closest_chunk(self, queries):
+        num = len(queries)
+        everyone = np.arange(num)
+
+        # descend to each query's home leaf to get a good initial bound
+        nodes = np.zeros(num, dtype=int)
+        for _ in range(self.depth):
+            go_right = queries[everyone, self.split_axis[nodes]] >= self.split_value[nodes]
+            nodes = 2*nodes + 1 + go_right
+        leaves = nodes - self.first_leaf
+        dist2 = ((self.leaf_points[leaves] - queries[:, None, :]) ** 2).sum(axis=2)
+        slots = dist2.argmin(axis=1)
+        best_dist2 = dist2[everyone, slots]
+        best = self.leaf_index[leaves, slots]
+
+        # then visit every leaf whose box could still hold something closer
+        query_ids, leaves = self.__sweep(queries, lambda box, ids: box < best_dist2[ids])
+        if len(query_ids):
+            dist2 = ((self.leaf_points[leaves] - queries[query_ids, None, :]) ** 2).sum(axis=2)
+            slots = dist2.argmin(axis=1)
+            cand_dist2 = dist2[np.arange(len(query_ids)), slots]
+            cand = self.leaf_index[leaves, slots]
+            np.minimum.at(best_dist2, query_ids, cand_dist2)
+            won = cand_dist2 == best_dist2[query_ids]
+            best[query_ids[won]] = cand[won]
+
+        return best, np.sqrt(best_dist2)
+
+    """
+    Single-query search over the flat arrays in plain Python.
+    Returns (index, squared distance) of the closest point
+    """
+    def __closest_one(self, point):
+        self.__mirror()
+        point = tuple(float(coord) for coord in point)
+        best, best_dist2 = -1, np.inf
+        stack = [(0, 0.0)] # (node, squared distance to the far side of the splits above it)
+        while stack:
+            node, bound = stack.pop()
+            if bound >= best_dist2:
+                continue
+            if node >= self.first_leaf:
+                for i, leaf_point in self.__leaves[node - self.first_leaf]:
+                    dist2 = sum((a - b) ** 2 for a, b in zip(point, leaf_point))
+                    if dist2 < best_dist2:
+                        best, best_dist2 = i, dist2
+                continue
+            diff = point[self.__axes[node]] - self.__values[node]
+            near, far = (2*node + 2, 2*node + 1) if diff >= 0 else (2*node + 1, 2*node + 2)
+            stack.append((far, max(bound, diff * diff)))
+            stack.append((near, bound))
+        return best, best_dist2
+
     """returns the closest point in the tree to point in logarithmic time"""
     def closest_point(self, point) -> tuple[float]:
-        best_point = None
-        best_dist = np.inf
-        
-        def search(node, depth=0):
-            nonlocal best_point, best_dist
-            
-            if node is None:
-                return
-            
-            dist = np.linalg.norm(point - node.point)
-            
-            if dist < best_dist:
-                best_point = node.point
-                best_dist = dist
-            
-            axis = depth % 2
-            
-            if point[axis] < node.point[axis]:
-                search(node.left, depth + 1)
-                if point[axis] + best_dist >= node.point[axis]:
-                    search(node.right, depth + 1)
-            else:
-                search(node.right, depth + 1)
-                if point[axis] - best_dist <= node.point[axis]:
-                    search(node.left, depth + 1)
-            
-        search(self.tree)
-        return tuple(best_point)
-    
+        if len(self.points) == 0:
+            return None
+        index, _ = self.__closest_one(point)
+        return tuple(self.points[index].tolist())
+
+    """
+    Finds every (query, point) pair within radius of each other, for a batch of queries.
+
+    Returns:
+        query_indices - int array of rows of targets
+        point_indices - int array, same length, of indices into the tree's points
     """
-    returns all points within radius of target. 
+    def query_radius_pairs(self, targets, radius):
+        targets = np.asarray(targets, dtype=float).reshape(-1, self.points.shape[1])
+        if len(self.points) == 0 or len(targets) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+        radius2 = radius ** 2
+        query_chunks, point_chunks = [], []
+        for chunk in range(0, len(targets), QUERY_CHUNK):
+            queries = targets[chunk:chunk + QUERY_CHUNK]
+            query_ids, leaves = self.__sweep(queries, lambda box, ids: box <= radius2)
+            dist2 = ((self.leaf_points[leaves] - queries[query_ids, None, :]) ** 2).sum(axis=2)
+            pair, slot = np.nonzero(dist2 <= radius2)
+            query_chunks.append(query_ids[pair] + chunk)
+            point_chunks.append(self.leaf_index[leaves[pair], slot])
+        return np.concatenate(query_chunks), np.concatenate(point_chunks)
+
+    """
+    returns all points within radius of target.
     Worst-case linear but should be prtty good on average
     It's also impossible to have an alg for this that has worst-case runtime
     better than linear anyway so I'm happy with this
     """
     def query_radius(self, target, radius) -> list:
+        self.__mirror()
+        target = tuple(float(coord) for coord in target)
+        radius2 = radius ** 2
         results = []
-        self.__query_radius(self.tree, target, radius, results)
+        stack = [0] if len(self.points) else []
+        while stack:
+            node = stack.pop()
+            if node >= self.first_leaf:
+                for i, leaf_point in self.__leaves[node - self.first_leaf]:
+                    if sum((a - b) ** 2 for a, b in zip(target, leaf_point)) <= radius2:
+                        results.append(self.points[i])
+                continue
+            diff = target[self.__axes[node]] - self.__values[node]
+            if diff - radius < 0:
+                stack.append(2*node + 1)
+            if diff + radius >= 0:
+                stack.append(2*node + 2)
         return results
-    
-    def __query_radius(self, node, target, radius, results, depth=0):
-        if node is None:
-            return
-        
-        if np.linalg.norm(node.point - target) <= radius:
-            results.append(node.point)
-        
-        axis = depth % 2
-        if target[axis] - radius < node.point[axis]:
-            self.__query_radius(node.left, target, radius, results, depth + 1)
-        if target[axis] + radius > node.point[axis]:
-            self.__query_radius(node.right, target, radius, results, depth + 1)
 
+    """
+    Inserts a point. The flat layout has no room to grow in place, so this
+    rebuilds the tree - fine for the occasional edit, not for bulk loading.
+    """
     def add(self, point) -> None:
-        def insert(node, point, depth):
-            if node is None:
-                return self.Node(point, None, None)
-
-            axis = depth % 2
-
-            if point[axis] < node.point[axis]:
-                node.left = insert(node.left, point, depth + 1)
-            else:
-                node.right = insert(node.right, point, depth + 1)
-
-            return node
-        
-        if not isinstance(point, np.ndarray):
-            point = np.array(point)
-            
-        self.tree = insert(self.tree, point, 0)
+        point = np.asarray(point, dtype=float).reshape(1, -1)
+        self.points = np.concatenate((self.points.reshape(-1, point.shape[1]), point))
+        self.__build()
 
+    """Removes one copy of point, if present. Also rebuilds, see add"""
     def remove(self, point) -> None:
-        if not isinstance(point, np.ndarray):
-            point = np.array(point)
+        if len(self.points) == 0:
+            return
+        indices, distances = self.closest_points([point])
+        if distances[0] == 0:
+            self.points = np.delete(self.points, indices[0], axis=0)
+            self.__build()
 
-        self.tree = self.__remove(self.tree, point)
-        
-    def __remove(self, node, point):        
-        if node is None:
-            return None
-        elif np.array_equal(node.point, point):
-            if node.right:
-                right_min = self.__min(node.right, 0)
-                node.point = right_min
-                node.right = self.__remove(node.right, right_min)
-                return node
-            else:
-                return node.left
-        elif point[node.depth % 2] < node.point[node.depth % 2]:
-            node.left = self.__remove(node.left, point)
-            return node
-        else:
-            node.right = self.__remove(node.right, point)
-            return node
-        
-    def __min(self, node, depth):
-        if node is None:
-            return None
-        elif node.left is None:
-            return node.point
-        else:
-            return self.__min(node.left, depth + 1)
-        
     def pop_closest(self, point) -> tuple[float]:
         closest = self.closest_point(point)
         self.remove(closest)
-        return closest
\ No newline at end of file
+        return closest
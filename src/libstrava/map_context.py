@@ -0,0 +1,192 @@
+"""
+The map side of every request: the street graph plus the spatial indexes built
+over it. None of this depends on the drawing, so it is built once per process
+and shared by every request instead of being rebuilt per call.
+"""
+import hashlib
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+from .edges import read_edges
+from .kd_tree import KDTree
+from .fast_gradient_decent import build_edge_index
+from .csr_graph import CSRGraph
+from .map_file import compiled_path, is_current, load_map
+from .routing import Router, Landmarks
+from .path_cache import PathCache
+
+"""
+A loaded map and its indexes. Built either from a list of edges, or from the
+edge list file at path - via its compiled map (see map_file) when that is up to
+date. csr, if given with edges, is that same graph already built.
+
+Attributes:
+    path - the edge list file this was loaded from, or None if built from edges
+    source - the file or compiled map directory actually read, or None
+    edges - the list of edges, each a pair of (lat, long) tuples
+    csr - the graph as a CSRGraph
+    graph - the same graph as a dict, vertex -> list of neighboring vertices
+    vertex_tree - KDTree over the graph's vertices, so its indices are csr vertex ids
+    edge_index - SegmentIndex over the edges, for exact nearest-edge queries
+    landmarks - Landmarks for routing on csr. Read from the compiled map, or
+        computed with the router for maps loaded from a path; None otherwise
+    router - Router over csr, for shortest paths
+    version - identifies the map's contents, see the property
+    path_cache - PathCache of routes and drawings on this map, shared by every
+        request using the context
+"""
+class MapContext:
+    def __init__(self, edges=None, path=None, csr=None):
+        self.path = path
+        self.source = None
+        self.mtime = None
+        self.read_ms = 0.0
+        self.lock = threading.Lock()
+        if edges is None:
+            self.__read()
+        else:
+            self.__index(edges, csr)
+
+    """Builds the graph and spatial indexes over edges"""
+    def __index(self, edges, csr=None):
+        start = time.perf_counter()
+        if csr is None:
+            csr = CSRGraph.from_edges(edges)
+        self.__set(csr, KDTree(csr.coords), build_edge_index(edges))
+        self.index_ms = (time.perf_counter() - start) * 1000
+
+    def __set(self, csr, vertex_tree, edge_index, landmarks=None):
+        self.csr = csr
+        self.vertex_tree = vertex_tree
+        self.edge_index = edge_index
+        self.landmarks = landmarks
+        self.path_cache = PathCache()
+        self.__graph = None
+        self.__router = None
+        self.__version = None
+
+    """Reads the map at self.path, memory-mapping the compiled map if it is up to date"""
+    def __read(self):
+        mtime = os.path.getmtime(self.path)
+        compiled = compiled_path(self.path)
+        start = time.perf_counter()
+        if is_current(compiled, self.path):
+            self.__set(*load_map(compiled))
+            self.source = compiled
+            self.index_ms = 0.0
+            self.read_ms = (time.perf_counter() - start) * 1000
+        else:
+            edges = read_edges(self.path)
+            self.source = self.path
+            self.read_ms = (time.perf_counter() - start) * 1000
+            self.__index(edges)
+        self.mtime = mtime
+
+    @property
+    def edges(self):
+        return self.edge_index.edges
+
+    """
+    Identifies the map's contents, e.g. for keying cached results: the file and
+    its mtime for a map loaded from a path, otherwise a hash of the edges
+    """
+    @property
+    def version(self) -> str:
+        if self.path is not None:
+            return f"{self.path}@{self.mtime}"
+        if self.__version is None:
+            self.__version = edges_version(self.edges)
+        return self.__version
+
+    """The dict graph, converted from the CSR graph on first use"""
+    @property
+    def graph(self):
+        if self.__graph is None:
+            self.__graph = self.csr.to_dict()
+        return self.__graph
+
+    """
+    The Router over the graph, built on first use, once however many threads
+    ask for it at the same time. A map loaded from a path is long-lived, so it
+    gets landmark tables if the compiled map had none (compile it with map_file
+    to have them built ahead of time); a map built from edges for one request
+    only routes on straight-line distance
+    """
+    @property
+    def router(self):
+        if self.__router is None:
+            with self.lock:
+                if self.__router is None:
+                    if self.landmarks is None and self.path is not None:
+                        self.landmarks = Landmarks.build(self.csr)
+                    self.__router = Router(self.csr, self.landmarks)
+        return self.__router
+
+    """A context over a dict graph, vertex -> list of neighboring vertices"""
+    @classmethod
+    def from_graph(cls, graph):
+        csr = CSRGraph.from_dict(graph)
+        context = cls(csr.to_edges(), csr=csr)
+        context.__graph = graph
+        return context
+
+    """Loads the map at path, logging how long each part took"""
+    @classmethod
+    def load(cls, path, verb="loaded"):
+        context = cls(path=path)
+        context.log(verb)
+        return context
+
+    def log(self, verb):
+        print(f"[+] {verb} map {self.source}: {self.csr.num_vertices} vertices, {len(self.edge_index)} edges "
+              f"(read {self.read_ms:.1f} ms, index build {self.index_ms:.1f} ms)", file=sys.stderr)
+
+    """Whether the file this was loaded from changed on disk since"""
+    def is_stale(self) -> bool:
+        return self.path is not None and os.path.getmtime(self.path) != self.mtime
+
+"""A hash identifying a list of edges, see MapContext.version"""
+def edges_version(edges) -> str:
+    return hashlib.sha256(np.asarray(edges, dtype=float).tobytes()).hexdigest()
+
+"""
+The MapContext for graph, which may already be one. A dict graph gets indexed
+on the spot, so callers drawing many segments should convert once up front
+"""
+def as_map_context(graph) -> MapContext:
+    if isinstance(graph, MapContext):
+        return graph
+    return MapContext.from_graph(graph)
+
+"""process-wide contexts, keyed by the path they were loaded from"""
+contexts = {}
+loading_lock = threading.Lock() # held while a map is being (re)loaded
+
+"""
+Returns the shared context for the edge list at path, loading it on first use.
+With watch set, the file's mtime is checked on every call and, if it changed,
+a new context is loaded and swapped in for later calls. A context is never
+changed once loaded, so a request keeps a consistent map for its whole run by
+holding on to the one it got; while the new one loads, callers keep getting
+the old one.
+"""
+def get_map_context(path, watch=True) -> MapContext:
+    path = os.path.abspath(path)
+    context = contexts.get(path)
+    if context is not None and not (watch and context.is_stale()):
+        return context
+    if not loading_lock.acquire(blocking=context is None):
+        return context # another thread is reloading it
+    try:
+        context = contexts.get(path)
+        if context is None:
+            context = contexts[path] = MapContext.load(path)
+        elif watch and context.is_stale():
+            context = contexts[path] = MapContext.load(path, "reloaded")
+        return context
+    finally:
+        loading_lock.release()
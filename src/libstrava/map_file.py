@@ -0,0 +1,116 @@
+"""
+A compiled map format that loads without parsing anything.
+
+Parsing data/edge_list.txt and rebuilding the indexes over it is the bulk of a
+cold start. A compiled map is a directory (edge_list.txt compiles to
+edge_list.map/) of raw .npy arrays - the CSR graph, the vertex kd-tree, the
+edge index and the routing landmark tables - plus a small meta.json. Loading memory-maps every array, so it
+takes the same few milliseconds however big the map is, pages are only read
+in as queries touch them, and processes that map the same files share one copy
+in the page cache.
+
+Compile a map with
+    python -m libstrava.map_file [edge_list.txt ...]
+MapContext.load picks the compiled map up automatically while it is newer than
+the text file it came from.
+"""
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+
+from .edges import read_edges, root
+from .csr_graph import CSRGraph
+from .kd_tree import KDTree
+from .segment_index import SegmentIndex
+from .routing import Landmarks
+
+FORMAT_VERSION = 3
+PARTS = {"csr": CSRGraph, "kd": KDTree, "seg": SegmentIndex, "alt": Landmarks} # file name prefix -> class
+
+"""The compiled map directory that goes with an edge list file"""
+def compiled_path(filename) -> str:
+    return os.path.splitext(filename)[0] + ".map"
+
+def read_meta(directory) -> dict:
+    with open(os.path.join(directory, "meta.json")) as f:
+        return json.load(f)
+
+"""
+Whether directory holds a compiled map of the current version, built from
+source as it is on disk right now
+"""
+def is_current(directory, source) -> bool:
+    try:
+        meta = read_meta(directory)
+    except (OSError, ValueError):
+        return False
+    return meta.get("version") == FORMAT_VERSION and meta.get("source_mtime") == os.path.getmtime(source)
+
+"""
+Writes a map's graph and indexes to directory. The files are written next to it
+first and swapped in at the end, so a process loading the map concurrently
+sees either the old map or the new one, never half of each.
+"""
+def save_map(directory, csr, vertex_tree, edge_index, landmarks, source=None):
+    staging = directory + ".tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    for prefix, part in zip(PARTS, (csr, vertex_tree, edge_index, landmarks)):
+        for name, array in part.to_arrays().items():
+            np.save(os.path.join(staging, f"{prefix}.{name}.npy"), np.ascontiguousarray(array))
+
+    meta = {"version": FORMAT_VERSION,
+            "vertices": int(csr.num_vertices),
+            "edges": len(edge_index),
+            "landmarks": len(landmarks),
+            "source": None if source is None else os.path.abspath(source),
+            "source_mtime": None if source is None else os.path.getmtime(source)}
+    with open(os.path.join(staging, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.rename(staging, directory)
+
+"""
+Memory-maps a compiled map.
+
+Returns:
+    csr - the graph as a CSRGraph
+    vertex_tree - KDTree over csr.coords
+    edge_index - SegmentIndex over the edges
+    landmarks - Landmarks for routing on csr
+"""
+def load_map(directory) -> tuple[CSRGraph, KDTree, SegmentIndex, Landmarks]:
+    meta = read_meta(directory)
+    if meta.get("version") != FORMAT_VERSION:
+        raise ValueError(f"{directory} is compiled map version {meta.get('version')}, expected {FORMAT_VERSION}")
+
+    arrays = {prefix: {} for prefix in PARTS}
+    for filename in os.listdir(directory):
+        prefix, name, ext = filename.split(".", 2) if filename.count(".") == 2 else (None, None, None)
+        if prefix in arrays and ext == "npy":
+            arrays[prefix][name] = np.load(os.path.join(directory, filename), mmap_mode="r")
+    return tuple(cls.from_arrays(arrays[prefix]) for prefix, cls in PARTS.items())
+
+"""Compiles an edge list file into a map directory, by default compiled_path(filename)"""
+def compile_map(filename, directory=None) -> str:
+    directory = directory or compiled_path(filename)
+    start = time.perf_counter()
+    edges = read_edges(filename)
+    csr = CSRGraph.from_edges(edges)
+    save_map(directory, csr, KDTree(csr.coords), SegmentIndex(edges), Landmarks.build(csr), source=filename)
+    print(f"[+] compiled {filename} to {directory}: {csr.num_vertices} vertices, {len(edges)} edges "
+          f"({(time.perf_counter() - start) * 1000:.1f} ms)", file=sys.stderr)
+    return directory
+
+def main():
+    filenames = sys.argv[1:] or [f"{root}/data/edge_list.txt"]
+    for filename in filenames:
+        compile_map(filename)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Multi-start optimizer for the point cloud embedding.
+
+A single random start tends to land in a poor local minimum, so this runs
+gradient descent from many random starts in parallel and keeps the best. The
+starts run on a long-lived DrawPool's workers rather than a pool of their own,
+so a call pays no process startup and forks nothing while the server's other
+threads are running.
+"""
+import numpy as np
+import time
+
+from .fast_gradient_decent import loss_and_gradient, apply_gradient, random_init, \
+                                  representative_subgraph, build_edge_index
+
+################ HYPERPARAMETERS ####################
+NUM_STARTS = 8
+MAX_ITERS = 200
+TIME_BUDGET = 5 # seconds, per call
+CONVERGENCE_TOL = 0.001 # stop once a step improves the loss by less than this fraction
+
+"""
+Runs gradient descent from parameters until the loss stops improving,
+max_iters steps pass, or the deadline (a time.time() value) is reached.
+Returns (best parameters, best loss, loss at every step)
+"""
+def descend(points, graph, graph_index, parameters, max_iters=MAX_ITERS, deadline=np.inf):
+    losses = []
+    best_parameters, best_loss = parameters, np.inf
+    for _ in range(max_iters):
+        loss, grad = loss_and_gradient(points, graph, parameters, graph_index)
+        losses.append(loss)
+        if loss < best_loss:
+            best_parameters, best_loss = parameters, loss
+
+        converged = len(losses) > 1 and abs(losses[-2] - loss) <= CONVERGENCE_TOL * losses[-2]
+        if converged or time.time() > deadline:
+            break
+        parameters = apply_gradient(parameters, grad)
+
+    return best_parameters, best_loss, losses
+
+"""
+One start, as run by DrawPool.map. seed fixes its random initialization. The
+start runs on the job's graph and graph index, or if they are None on context,
+the map the pool's workers already hold
+"""
+def run_start(job, context=None):
+    points, seed, max_iters, deadline, graph, graph_index = job
+    if graph is None:
+        graph, graph_index = context.edges, context.edge_index
+    parameters = random_init(np.random.default_rng(seed))
+    return descend(points, graph, graph_index, parameters, max_iters, deadline)
+
+"""
+Finds a good embedding by running gradient descent from starts random
+initializations across a DrawPool's workers.
+
+Params:
+    points, graph - as for gradient_decend
+    starts - how many random initializations to try
+    max_iters - step limit per start
+    time_budget - seconds the whole call may take, or None for no limit; starts
+           still running are stopped early
+    seed - makes the starts reproducible. Results are deterministic as long as
+           no start is cut off by the time budget, so always without one
+    graph_index - as for gradient_decend
+    pool - the DrawPool to run the starts on, or None to run them in-process.
+           When graph_index is its map's, the workers use the map they hold;
+           any other graph is sent to them with each start
+Returns:
+    parameters - the best bundle found
+    subgraph - its representative_subgraph
+    curves - list, per start, of the loss at every step
+"""
+def optimize(points, graph, starts=NUM_STARTS, max_iters=MAX_ITERS, time_budget=TIME_BUDGET,
+             seed=None, graph_index=None, pool=None):
+    if graph_index is None:
+        graph_index = build_edge_index(graph)
+    seeds = np.random.SeedSequence(seed).spawn(starts)
+    deadline = np.inf if time_budget is None else time.time() + time_budget
+
+    if pool is None:
+        results = [run_start((points, start_seed, max_iters, deadline, graph, graph_index))
+                   for start_seed in seeds]
+    else:
+        on_pool_map = graph_index is pool.context.edge_index
+        sent = (None, None) if on_pool_map else (graph, graph_index)
+        results = pool.map(run_start, [(points, start_seed, max_iters, deadline, *sent) for start_seed in seeds])
+
+    best_parameters, _, _ = min(results, key=lambda result: result[1])
+    subgraph = representative_subgraph(points, graph, best_parameters, graph_index)
+    return best_parameters, subgraph, [losses for _, _, losses in results]
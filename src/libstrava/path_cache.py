@@ -0,0 +1,104 @@
+"""
+A bounded least-recently-used cache of drawn paths over one map.
+
+Requests over the same map keep asking for the same routes between popular
+intersections, so each MapContext keeps one of these for its whole life (a
+reloaded map gets a new context, and so a new cache). Keys start with what kind
+of path they hold and the (start vertex, end vertex) ids it connects:
+    ("route", start, end) - a shortest path, as a list of vertex ids
+    ("draw", start, end, shape) - a segment drawn along shape (see
+        Segment.shape_signature), as an edge list
+Cached values are shared between requests, so they must not be mutated.
+
+One route can be a handful of vertices or thousands, so the cache is bounded by
+the approximate memory its values take rather than by how many there are, and
+values too big to be worth a slot aren't cached at all.
+"""
+import collections
+import threading
+
+PATH_CACHE_BYTES = 64 * 1024 * 1024 # approximate memory kept per map
+ENTRY_BYTES = 256 # per entry: its key and the bookkeeping around it
+ITEM_BYTES = 64 # per vertex id or edge in a value
+MAX_ENTRY_FRACTION = 1 / 64 # values taking more of the budget than this aren't cached
+
+"""the approximate memory a cached list of vertex ids or edges takes"""
+def entry_bytes(value) -> int:
+    return ENTRY_BYTES + ITEM_BYTES * len(value)
+
+class PathCache:
+    def __init__(self, max_bytes=PATH_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict() # key -> (value, its bytes), least recently used first
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.too_big = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    """The value cached under key, or default. Counts as a use of key"""
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+            self.misses += 1
+            return default
+
+    """
+    Caches value under key, evicting the least recently used entries past
+    max_bytes. A value taking more than MAX_ENTRY_FRACTION of it is skipped
+    """
+    def put(self, key, value):
+        size = entry_bytes(value)
+        with self.lock:
+            if size > self.max_bytes * MAX_ENTRY_FRACTION:
+                self.too_big += 1
+                return
+            if key in self.entries:
+                self.bytes -= self.entries[key][1]
+            self.entries[key] = (value, size)
+            self.entries.move_to_end(key)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    """
+    The value cached under key, computing and caching it on a miss. compute runs
+    outside the lock, so two threads missing at once may both compute it
+    """
+    def get_or_compute(self, key, compute):
+        sentinel = object()
+        if (value := self.get(key, sentinel)) is not sentinel:
+            return value
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    """Counters for monitoring, e.g. the backend's /api/stats"""
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self.entries),
+                    "bytes": self.bytes,
+                    "max_bytes": self.max_bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "too_big": self.too_big,
+                    "hit_ratio": self.hits / lookups if lookups else 0.0}
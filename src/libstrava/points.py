@@ -1,6 +1,8 @@
 import matplotlib.pyplot as plt
 from PIL import Image
 import numpy as np
+import itertools
+import math
 from matplotlib.widgets import Slider, Button
 import pathlib
 
@@ -75,24 +77,80 @@ def pixel2gps(pixel, corners, imageconf):
     # return (x,y)
 
 """
-Removes duplicates from list of points
+A set of points, or of tuples of points like edges, that treats two entries as
+the same when every coordinate is within tol of the other's - the test
+edges.already_included does with a scan, done with hashed lookups instead.
+
+Entries are bucketed by their coordinates quantized to cells CELL_TOLS * tol
+wide, so a lookup only has to check the neighboring cell along the coordinates
+that sit within tol of a cell boundary. With tol = 0 entries must match exactly.
+"""
+CELL_TOLS = 4
+class ToleranceSet:
+    def __init__(self, tol=0, entries=()):
+        self.tol = tol
+        self.buckets = {}
+        for entry in entries:
+            self.add(entry)
+
+    """the flat tuple of coordinates of a point, or of a tuple of points"""
+    def __coords(self, entry):
+        if isinstance(entry[0], (tuple, list, np.ndarray)):
+            return tuple(float(coord) for point in entry for coord in point)
+        return tuple(float(coord) for coord in entry)
+
+    """every bucket key that could hold an entry within tol of coords"""
+    def __keys(self, coords):
+        if self.tol == 0:
+            return [coords]
+        width = CELL_TOLS * self.tol
+        options = []
+        for coord in coords:
+            cell = math.floor(coord / width)
+            offset = coord - cell * width
+            near = [cell]
+            if offset < self.tol:
+                near.append(cell - 1)
+            elif width - offset <= self.tol:
+                near.append(cell + 1)
+            options.append(near)
+        return list(itertools.product(*options))
+
+    """returns the stored entry matching entry, or None"""
+    def find(self, entry):
+        coords = self.__coords(entry)
+        for key in self.__keys(coords):
+            for stored_coords, stored in self.buckets.get(key, ()):
+                if all(abs(a - b) < self.tol or a == b for a, b in zip(coords, stored_coords)):
+                    return stored
+        return None
+
+    def __contains__(self, entry):
+        return self.find(entry) is not None
+
+    """Adds entry unless a matching one is already in the set. Returns whether it was added"""
+    def add(self, entry) -> bool:
+        if entry in self:
+            return False
+        coords = self.__coords(entry)
+        key = self.__keys(coords)[0]
+        self.buckets.setdefault(key, []).append((coords, entry))
+        return True
+
+"""
+Removes duplicates from list of points, keeping the first of each
 
 Params:
     points - a list of 2tuples of floats
+    tol - points whose coordinates are all within tol of each other count as duplicates.
+          The default only removes exact duplicates
 Returns: list of 2tuples of floats, each tuple distinct
 """
-def remove_duplicate_points(points):
-    unique_points = []
-    for point in points:
-        is_a_duplicate = False
-        nx, ny = point
-        for unique_point in unique_points:
-            ux, uy = unique_point
-            if nx == ux and ny == uy:
-                is_a_duplicate = True
-        if not is_a_duplicate:
-            unique_points.append(point)
-    return unique_points
+def remove_duplicate_points(points, tol=0):
+    if tol == 0:
+        return list(dict.fromkeys(points))
+    seen = ToleranceSet(tol)
+    return [point for point in points if seen.add(point)]
 
 
 def read_gps(fname):
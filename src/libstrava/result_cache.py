@@ -0,0 +1,185 @@
+"""
+A content-addressed cache of whole API results.
+
+Users replay the same drawing, or ask for the loss of the same points and
+parameter bundle, over and over. Results are keyed on a hash of the parsed
+request (see result_key), so the same request hits however it was formatted on
+the wire. Recently used results are kept in memory; with a directory given
+they are also written there, so they survive restarts and are shared between
+processes, and the least recently used files are evicted once the directory
+outgrows its byte budget - counting every process's files, as each rescans the
+directory before it evicts. Results are strings - response bodies.
+
+Along with hits and misses, the cache counts how long each result took to
+compute, so its stats can say how much time the hits saved.
+"""
+import collections
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+RESULT_CACHE_SIZE = 1024 # results kept in memory
+RESULT_CACHE_BYTES = 256 * 1024 * 1024 # size of the disk tier, in bytes
+
+"""
+The cache key for a request made of parts: a hex sha256 of their canonical JSON.
+Tuples hash like lists, and dicts regardless of their order
+"""
+def result_key(*parts) -> str:
+    canonical = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+"""
+Params:
+    maxsize - results kept in memory
+    directory - where to keep results on disk, or None for memory only
+    max_bytes - how large the files in directory may grow in total
+"""
+class ResultCache:
+    def __init__(self, maxsize=RESULT_CACHE_SIZE, directory=None, max_bytes=RESULT_CACHE_BYTES):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict() # key -> (result, seconds to compute), least recently used first
+        self.files = collections.OrderedDict() # key -> file size, least recently used first
+        self.disk_bytes = 0
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+        self.seconds_computing = 0.0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.__scan()
+
+    """
+    (Re)indexes the results on disk, whichever process wrote them, oldest first
+    by mtime, then evicts past max_bytes
+    """
+    def __scan(self):
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".json"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue # another process evicted it
+                found.append((stat.st_mtime, entry.name[:-len(".json")], stat.st_size))
+        with self.lock:
+            self.files.clear()
+            self.disk_bytes = 0
+            for _, key, size in sorted(found):
+                self.files[key] = size
+                self.disk_bytes += size
+            self.__evict_files()
+
+    def __file(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    """
+    The result cached under key, computing and caching it on a miss. compute
+    runs outside the lock, so two threads missing at once may both compute it
+    """
+    def get_or_compute(self, key, compute) -> str:
+        if (entry := self.__get(key)) is not None:
+            return entry
+        start = time.perf_counter()
+        result = compute()
+        seconds = time.perf_counter() - start
+        with self.lock:
+            self.seconds_computing += seconds
+            self.__remember(key, result, seconds)
+        if self.directory is not None:
+            self.__write(key, result, seconds)
+        return result
+
+    """The result under key from memory or disk, or None. Counts the hit or miss"""
+    def __get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                result, seconds = self.entries[key]
+                self.memory_hits += 1
+                self.seconds_saved += seconds
+                return result
+        if self.directory is not None and (entry := self.__read(key)) is not None:
+            result, seconds = entry
+            with self.lock:
+                self.__remember(key, result, seconds)
+                self.disk_hits += 1
+                self.seconds_saved += seconds
+            return result
+        with self.lock:
+            self.misses += 1
+        return None
+
+    """Keeps a result in memory, evicting past maxsize. Call with self.lock held"""
+    def __remember(self, key, result, seconds):
+        self.entries[key] = (result, seconds)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    """(result, seconds) from key's file, or None if there is none or it is unreadable"""
+    def __read(self, key):
+        path = self.__file(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            os.utime(path) # the mtime is the recency other processes see
+            size = os.path.getsize(path)
+        except (OSError, ValueError):
+            return None
+        with self.lock: # another process may have written it, so (re)count it
+            self.disk_bytes += size - self.files.pop(key, 0)
+            self.files[key] = size
+        return entry["result"], entry["seconds"]
+
+    """
+    Writes key's file atomically, then evicts files past max_bytes. Other
+    processes write to the directory too, so the directory is rescanned for its
+    total first; that is a listing per result computed, small next to computing it
+    """
+    def __write(self, key, result, seconds):
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"result": result, "seconds": seconds}, f)
+            os.replace(temp, self.__file(key))
+        except OSError as e:
+            print(f"[-] Error: could not cache result {key}: {e}", file=sys.stderr)
+            if os.path.exists(temp):
+                os.remove(temp)
+            return
+        self.__scan()
+
+    """Deletes the least recently used files past max_bytes. Call with self.lock held"""
+    def __evict_files(self):
+        while self.disk_bytes > self.max_bytes and self.files:
+            key, size = self.files.popitem(last=False)
+            self.disk_bytes -= size
+            try:
+                os.remove(self.__file(key))
+            except FileNotFoundError:
+                pass # another process evicted it first
+
+    """Counters for monitoring, e.g. the backend's /api/stats"""
+    def stats(self) -> dict:
+        with self.lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {"size": len(self.entries),
+                    "maxsize": self.maxsize,
+                    "disk_files": len(self.files),
+                    "disk_bytes": self.disk_bytes,
+                    "memory_hits": self.memory_hits,
+                    "disk_hits": self.disk_hits,
+                    "misses": self.misses,
+                    "hit_ratio": hits / lookups if lookups else 0.0,
+                    "seconds_saved": self.seconds_saved,
+                    "seconds_computing": self.seconds_computing}
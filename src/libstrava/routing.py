@@ -0,0 +1,294 @@
+"""
+Shortest paths over the map graph, on CSR vertex ids.
+
+A Router keeps one set of flat per-vertex scratch lists (distance, predecessor,
+and the generation each was last written in) for the life of the map. Starting
+a query just bumps the generation, which marks every entry stale at once, so a
+query only ever touches the vertices it actually visits - nothing is allocated
+or cleared per vertex of the map. Edges are weighted by their real length, and
+the A* heuristic is the straight-line distance to the goal, which never
+overestimates a path made of straight edges.
+
+With Landmarks (ALT), the heuristic also uses precomputed road distances from a
+few landmark vertices: by the triangle inequality |d(L, goal) - d(L, v)| never
+overestimates d(v, goal) either, and along roads it is usually far tighter
+than the straight line, so A* barely strays off the shortest path, and a goal
+the tables show is unconnected is given up on without searching. The tables
+are computed once per map and saved with the compiled map (see map_file).
+
+A query still settles every vertex along its path, so its time grows with the
+route's length rather than the map's size. Routes across a 90k vertex grid map
+are 3 to 5 times faster with the tables (about 10 ms against 35 ms). The short routes
+between a drawing's neighboring critical vertices take about 0.1 ms on any map
+size either way (see benchmarks/routing.py): plain A* already settles little
+more than the path on those, so the tables don't make them any faster.
+"""
+import heapq
+import math
+import threading
+
+import numpy as np
+
+LANDMARKS = 32 # landmarks picked per map
+ACTIVE_LANDMARKS = 4 # landmarks used by each query, the ones giving the best bound for it
+ARRAYS = ["vertices", "distances"]
+
+"""
+Distances from every vertex of a map to a handful of landmark vertices, picked
+spread out by farthest-point selection.
+
+Attributes:
+    vertices - (k,) int array of landmark vertex ids
+    distances - (k, n) float array, distances[i, v] the road distance from
+        landmark i to vertex v, inf if v is not connected to it
+"""
+class Landmarks:
+    def __init__(self, vertices, distances):
+        self.vertices = np.asarray(vertices)
+        self.distances = np.asarray(distances, dtype=float)
+
+    """Picks count landmarks on csr and computes their distance tables"""
+    @classmethod
+    def build(cls, csr, count=LANDMARKS):
+        n = csr.num_vertices
+        if n == 0:
+            return cls(np.zeros(0, dtype=int), np.zeros((0, 0)))
+        router = Router(csr)
+        # the first landmark is the vertex farthest from one in the largest component,
+        # every next one the vertex farthest from all landmarks so far. Landmarks
+        # stay in that component: one on an island of a few vertices says nothing
+        # about the rest of the map, and islands, being unreachable, look farthest
+        nearest = largest_component_distances(router, n)
+        vertices, distances = [], []
+        for _ in range(min(count, n)):
+            vertex = int(np.argmax(nearest))
+            if vertices and nearest[vertex] == 0:
+                break # every vertex is a landmark already
+            vertices.append(vertex)
+            distances.append(router.distances_from(vertex))
+            nearest = np.minimum(nearest, distances[-1])
+        return cls(np.array(vertices), np.array(distances))
+
+    """The arrays that make up the tables, e.g. for np.save. See from_arrays"""
+    def to_arrays(self) -> dict:
+        return {name: getattr(self, name) for name in ARRAYS}
+
+    """Rebuilds the tables from to_arrays output, e.g. from memory-mapped files"""
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(*(arrays[name] for name in ARRAYS))
+
+    def __len__(self):
+        return len(self.vertices)
+
+"""
+Distances from a vertex of the largest connected component to every vertex,
+-inf outside the component. Searches from vertices not reached yet until no
+component left could be larger than the largest found
+"""
+def largest_component_distances(router, n):
+    unreached = np.ones(n, dtype=bool)
+    best, best_size = None, 0
+    while unreached.sum() > best_size:
+        distances = np.array(router.distances_from(int(np.argmax(unreached))))
+        reached = np.isfinite(distances)
+        unreached &= ~reached
+        if reached.sum() > best_size:
+            best, best_size = np.where(reached, distances, -np.inf), reached.sum()
+    return best
+
+"""
+Params:
+    csr - the map as a CSRGraph
+    landmarks - Landmarks for csr, or None to route on straight-line distance alone
+"""
+class Router:
+    def __init__(self, csr, landmarks=None):
+        self.csr = csr
+        self.points = csr.points
+        self.offsets, self.neighbors = csr.adjacency()
+        self.lengths = csr.lengths.tolist()
+        n = csr.num_vertices
+        self.dist = [0.0] * n
+        self.parent = [-1] * n
+        self.seen = [0] * n # generation in which dist and parent were last set
+        self.done = [0] * n # generation in which the vertex was settled
+        self.generation = 0
+        self.lock = threading.Lock() # queries share the scratch lists
+        # one memoryview per table row reads single floats fast, without copying
+        # (or, for a memory-mapped map, even reading) the tables up front
+        self.landmarks = landmarks
+        self.tables = [] if landmarks is None else \
+            [memoryview(np.ascontiguousarray(row)) for row in landmarks.distances]
+
+    """
+    The landmark tables worth using from start to goal, each with the goal's
+    distance: the ACTIVE_LANDMARKS giving the largest lower bound at start
+    """
+    def __active(self, start, goal):
+        bounds = []
+        for table in self.tables:
+            to_start, to_goal = table[start], table[goal]
+            if to_start != math.inf and to_goal != math.inf:
+                bounds.append((abs(to_start - to_goal), to_goal, table))
+        bounds.sort(key=lambda bound: bound[0], reverse=True)
+        return [(table, to_goal) for _, to_goal, table in bounds[:ACTIVE_LANDMARKS]]
+
+    """
+    A lower bound on the road distance between vertex ids a and b, in constant
+    time. inf if the landmarks show they are not connected
+    """
+    def lower_bound(self, a, b) -> float:
+        (ax, ay), (bx, by) = self.points[a], self.points[b]
+        bound = math.hypot(ax - bx, ay - by)
+        for table in self.tables:
+            to_a, to_b = table[a], table[b]
+            if to_a == math.inf or to_b == math.inf:
+                if to_a != to_b: # one of them is connected to the landmark, the other isn't
+                    return math.inf
+                continue
+            bound = max(bound, abs(to_a - to_b))
+        return bound
+
+    """Marks every vertex unvisited, in constant time"""
+    def __reset(self):
+        self.generation += 1
+        return self.generation
+
+    """
+    A* from start to goal, both vertex ids.
+    Returns the list of vertex ids from start to goal, or None if goal is unreachable
+    """
+    def shortest_path(self, start, goal) -> list[int]:
+        with self.lock:
+            return self.__path_to(goal) if self.__a_star(start, goal) else None
+
+    """The road distance between vertex ids start and goal, inf if unconnected"""
+    def distance(self, start, goal) -> float:
+        with self.lock:
+            return self.dist[goal] if self.__a_star(start, goal) else math.inf
+
+    """A* from start to goal, leaving the path in the scratch lists. Returns whether goal was reached"""
+    def __a_star(self, start, goal) -> bool:
+        gen = self.__reset()
+        points, offsets, neighbors, lengths = self.points, self.offsets, self.neighbors, self.lengths
+        dist, parent, seen, done = self.dist, self.parent, self.seen, self.done
+        goal_x, goal_y = points[goal]
+        if self.tables and self.lower_bound(start, goal) == math.inf:
+            return False # the landmarks show goal can't be reached, no need to search the whole component
+        active = self.__active(start, goal)
+
+        dist[start], parent[start], seen[start] = 0.0, -1, gen
+        open_set = [(0.0, start)]
+        while open_set:
+            _, current = heapq.heappop(open_set)
+            if done[current] == gen:
+                continue
+            if current == goal:
+                return True
+            done[current] = gen
+            base = dist[current]
+            for arc in range(offsets[current], offsets[current + 1]):
+                neighbor = neighbors[arc]
+                tentative = base + lengths[arc]
+                if seen[neighbor] != gen or tentative < dist[neighbor]:
+                    dist[neighbor], parent[neighbor], seen[neighbor] = tentative, current, gen
+                    x, y = points[neighbor]
+                    estimate = math.hypot(x - goal_x, y - goal_y)
+                    for table, to_goal in active:
+                        bound = table[neighbor] - to_goal
+                        if bound < 0:
+                            bound = -bound
+                        if bound > estimate:
+                            estimate = bound
+                    heapq.heappush(open_set, (tentative + estimate, neighbor))
+        return False
+
+    """
+    Dijkstra from start over the whole graph.
+    Returns a list of the distance to every vertex, inf where unreachable
+    """
+    def distances_from(self, start) -> list[float]:
+        with self.lock:
+            gen = self.__reset()
+            offsets, neighbors, lengths = self.offsets, self.neighbors, self.lengths
+            dist, seen, done = self.dist, self.seen, self.done
+
+            dist[start], seen[start] = 0.0, gen
+            open_set = [(0.0, start)]
+            while open_set:
+                base, current = heapq.heappop(open_set)
+                if done[current] == gen:
+                    continue
+                done[current] = gen
+                for arc in range(offsets[current], offsets[current + 1]):
+                    neighbor = neighbors[arc]
+                    tentative = base + lengths[arc]
+                    if seen[neighbor] != gen or tentative < dist[neighbor]:
+                        dist[neighbor], seen[neighbor] = tentative, gen
+                        heapq.heappush(open_set, (tentative, neighbor))
+            return [dist[v] if seen[v] == gen else math.inf for v in range(len(dist))]
+
+    """
+    Dijkstra from start until every one of goals is settled (or nothing more is
+    reachable). One search answers them all.
+    Returns {goal: list of vertex ids from start to goal, or None}
+    """
+    def shortest_paths_from(self, start, goals) -> dict[int, list[int]]:
+        with self.lock:
+            gen = self.__reset()
+            offsets, neighbors, lengths = self.offsets, self.neighbors, self.lengths
+            dist, parent, seen, done = self.dist, self.parent, self.seen, self.done
+            remaining = set(goals)
+            paths = dict.fromkeys(remaining)
+
+            dist[start], parent[start], seen[start] = 0.0, -1, gen
+            open_set = [(0.0, start)]
+            while open_set and remaining:
+                base, current = heapq.heappop(open_set)
+                if done[current] == gen:
+                    continue
+                done[current] = gen
+                if current in remaining:
+                    remaining.discard(current)
+                    paths[current] = self.__path_to(current)
+                for arc in range(offsets[current], offsets[current + 1]):
+                    neighbor = neighbors[arc]
+                    tentative = base + lengths[arc]
+                    if seen[neighbor] != gen or tentative < dist[neighbor]:
+                        dist[neighbor], parent[neighbor], seen[neighbor] = tentative, current, gen
+                        heapq.heappush(open_set, (tentative, neighbor))
+            return paths
+
+    """
+    Shortest paths for a batch of (start, goal) vertex id pairs, in order.
+    Pairs sharing a start are answered by a single search from it.
+    """
+    def shortest_paths(self, pairs) -> list[list[int]]:
+        goals_by_start = {}
+        for start, goal in pairs:
+            goals_by_start.setdefault(start, []).append(goal)
+        found = {}
+        for start, goals in goals_by_start.items():
+            if len(goals) == 1:
+                found[start, goals[0]] = self.shortest_path(start, goals[0])
+            else:
+                for goal, path in self.shortest_paths_from(start, goals).items():
+                    found[start, goal] = path
+        return [found[pair] for pair in pairs]
+
+    """The path to vertex v found by the current search, following predecessors back"""
+    def __path_to(self, v):
+        path = []
+        while v != -1:
+            path.append(v)
+            v = self.parent[v]
+        return path[::-1]
+
+    """
+    A vertex id path as the edge list Segment.a_star has always returned:
+    (later point, earlier point) for each step, in order from the start
+    """
+    def to_edges(self, path) -> list[tuple[tuple]]:
+        points = self.points
+        return [(points[b], points[a]) for a, b in zip(path, path[1:])]
@@ -1,11 +1,16 @@
 import numpy as np
-import heapq
 import math
+import sys
 
-from .fast_gradient_decent import edges_as_points, point_point_dist
-from .kd_tree import KDTree
+from .fast_gradient_decent import point_point_dist
+from .segment_index import SegmentIndex
+from .map_context import as_map_context
 
 STABILITY = 4 # controls how stringently the walk tries to stick to the path
+REACH = 0.5 # the field is precomputed at map vertices within REACH * size of the segment
+SAMPLES = 50 # points sampled along a path to score it
+SHAPE_SAMPLES = 8 # points sampled along a segment for its cache key
+SHAPE_QUANTUM = 1 / 16 # the cache key's shape is snapped to a grid this fine, relative to the segment's size
 
 """
 A segment is a path in the drawing connecting two critical points.
@@ -18,8 +23,10 @@ class Segment:
         self.path = path
         self.size = point_point_dist(path[0], path[-1])
         self.edges = self.__edges_from_path()
-        self.points2edges = {}
-        self.kdtree = KDTree(edges_as_points(self.edges, self.points2edges))
+        self.index = SegmentIndex(self.edges)
+        self.progress = self.__progress_vecs()
+        self.field = {}
+        self.field_map = None # the CSRGraph self.field was sampled on
 
     """Fills in the edge list according to the path"""
     def __edges_from_path(self):
@@ -28,61 +35,142 @@ class Segment:
             edges.append((self.path[i], self.path[i+1]))
         return edges
     
+    """
+    The unit direction the walk should make progress in along each edge,
+    (0, 0) for a zero length edge
+    """
+    def __progress_vecs(self):
+        ends = np.asarray(self.edges, dtype=float).reshape(-1, 2, 2)
+        vecs = ends[:, 0] - ends[:, 1]
+        lengths = np.linalg.norm(vecs, axis=1)
+        return vecs / np.where(lengths == 0, 1, lengths)[:, None]
+
     """a to-string for segment"""
     def print(self):
         print(self.path)
 
     """
     Returns a list of edges in the graph which form a path from start to end 
-    and which resembles the segement in shape
+    and which resembles the segement in shape. graph is a MapContext, or a dict
+    graph (which then gets indexed first - convert once when drawing many segments)
     """
     def draw(self, graph) -> list[tuple[tuple]]:
+        context = as_map_context(graph)
+        return list(context.path_cache.get_or_compute(self.cache_key(context.csr), lambda: self.__draw(context)))
+
+    def __draw(self, context):
+        path, arrived = self.walk(context)
+        if arrived:
+            return path
+        print("No path found; finishing with A*")
+        path, start = self.finish_start(path)
+        return path + (self.a_star(context, start) or [])
+
+    """
+    The key drawings of this segment on the map csr are cached under, see
+    PathCache: its end vertices and its shape_signature, so near enough the
+    same segment drawn by another request hits too
+    """
+    def cache_key(self, csr):
+        return ("draw", csr.vertex_id(self.path[0]), csr.vertex_id(self.path[-1]), self.shape_signature())
+
+    """
+    The segment's shape, independent of where, how big and which way round it
+    was embedded: SHAPE_SAMPLES points resampled along it, in the frame where
+    it runs from (0, 0) to (1, 0), snapped to a SHAPE_QUANTUM grid. A segment
+    ending where it starts has no such frame, so its points are taken relative
+    to its start, in units of its reach from there, plus that reach snapped on
+    a log scale. Returns a tuple of ints
+    """
+    def shape_signature(self) -> tuple[int]:
+        samples, _, _ = resample([self.path], SHAPE_SAMPLES)
+        if len(samples) == 0:
+            return ()
+        offsets = samples - samples[0]
+        if self.size > 0:
+            dx, dy = samples[-1] - samples[0]
+            scale = self.size ** 2
+            frame = np.stack((offsets @ [dx, dy], offsets @ [-dy, dx]), axis=1) / scale
+            extra = []
+        else:
+            reach = np.linalg.norm(offsets, axis=1).max()
+            frame = offsets / reach
+            extra = [round(math.log2(reach) / SHAPE_QUANTUM)]
+        return tuple(extra + np.rint(frame / SHAPE_QUANTUM).astype(int).ravel().tolist())
+
+    """
+    The greedy part of draw: follows the vector field from the start for as long
+    as some unused neighbor points the right way.
+    Returns the edges walked, and whether they reach the end of the segment
+    """
+    def walk(self, context) -> tuple[list[tuple[tuple]], bool]:
+        csr = context.csr
+        current, end = csr.vertex_id(self.path[0]), csr.vertex_id(self.path[-1])
+        if current is None or end is None:
+            raise ValueError("segment endpoints must be vertices of the map")
+        if current != end:
+            self.__precompute_field(context)
+
+        # the walk itself only touches plain lists, one vertex at a time
+        points = csr.points
+        offsets, neighbors = csr.adjacency()
+        arc_x, arc_y = csr.arc_directions()
+        field = self.field
         path = []
-        used = set()
-        current = self.path[0]
-        used.add(current)
-        while current != self.path[-1]:
-            if (next := self.__continue_path(current, graph, used)) is not None:
-                path.append((current, next))
-                used.add(next)
-                current = next
-            else:
-                return self.__finish(path, graph)
+        used = {current}
+        while current != end:
+            if current not in field:
+                field[current] = self.__get_vec(points[current])
+            goal_x, goal_y = field[current]
+            best_candidate = None
+            greatest_alignment = 0
+            for arc in range(offsets[current], offsets[current + 1]):
+                cand = neighbors[arc]
+                if cand in used:
+                    continue
+                if (cand_alignment := goal_x * arc_x[arc] + goal_y * arc_y[arc]) > greatest_alignment:
+                    best_candidate = cand
+                    greatest_alignment = cand_alignment
+            if best_candidate is None:
+                return path, False
+            path.append((points[current], points[best_candidate]))
+            used.add(best_candidate)
+            current = best_candidate
         print("path found :)")
-        return path
-                
-    """returns the best next step in the drawing, or None if we should give up"""
-    def __continue_path(self, current, graph, used):
-        candidates = graph[current]
-        candidates = filter(lambda x: x not in used, candidates)
-        best_candidate = None
-        greatest_alignment = 0
-        for cand in candidates:
-            if (cand_alignment := self.__alignment(current, cand)) > greatest_alignment:
-                best_candidate = cand
-                greatest_alignment = cand_alignment
-        return best_candidate
-    
-    """Determines how good a next step candidate is"""
-    def __alignment(self, current, candidate):
-        goal_vec = self.__get_vec(current)
-        cand_vec = (np.array(candidate) - np.array(current)) / point_point_dist(current, candidate)
-        return np.dot(goal_vec, cand_vec)
+        return path, True
+
+    """
+    Samples the vector field at every map vertex within REACH * size of the
+    segment in one batch, into self.field (vertex id -> vector). Vertices the
+    walk strays to beyond that are filled in as it reaches them. The field only
+    depends on the segment and the map, so redrawing on the same map reuses it.
+    """
+    def __precompute_field(self, context):
+        if self.field_map is context.csr:
+            return
+        _, vertex_ids = context.vertex_tree.query_radius_pairs(self.path, REACH * self.size)
+        self.field_vertices = np.unique(vertex_ids)
+        self.field_vectors = self.__field_at(context.csr.coords[self.field_vertices])
+        self.field = dict(zip(self.field_vertices.tolist(), map(tuple, self.field_vectors.tolist())))
+        self.field_map = context.csr
+
+    """queries the segment's vector field at every row of points, an (n, 2) array"""
+    def __field_at(self, points):
+        edge_ids, _ = self.index.nearest(points)
+        nearest_points = self.index.project(points, edge_ids)
+        correction_vecs = (nearest_points - points) / self.size
+        return STABILITY * correction_vecs + self.progress[edge_ids]
 
     """queries the segment's vector field at point"""
     def __get_vec(self, point):
-        nearest_point = self.kdtree.closest_point(point)
-        correction_vec = (np.array(nearest_point) - np.array(point)) / self.size
-
-        nearest_edge = self.points2edges[nearest_point]
-        edge_start, edge_end = np.array(nearest_edge[1]), np.array(nearest_edge[0])
-        progress_vec = (edge_end - edge_start) / point_point_dist(edge_start, edge_end)
+        return tuple(self.__field_at(np.array([point], dtype=float))[0].tolist())
 
-        return STABILITY * correction_vec + progress_vec
-    
-    """Takes a partially-drawn path and finishes it with A*"""
-    def __finish(self, path : list[tuple[tuple]], graph) -> list[tuple[tuple]]:
-        print("No path found; finishing with A*")
+    """
+    Takes a partially-drawn path that got stuck, and cuts it back to the point
+    closest to the end, from where A* should take over.
+    Returns the edges to keep and the point to finish from
+    """
+    def finish_start(self, path : list[tuple[tuple]]) -> tuple[list[tuple[tuple]], tuple]:
         points = [edge[0] for edge in path] # first point in each edge
         try:
             points.append(path[-1][1]) # include very last point
@@ -96,162 +184,202 @@ class Segment:
             if (new_dist := point_point_dist(point, end)) < closest_dist:
                 closest_dist = new_dist
                 closest_index = i
-        
-        # do A* from closest point to end
-        return path[:closest_index] + self.a_star(graph, start=points[closest_index])
+        return path[:closest_index], points[closest_index]
 
     """
     Computes a path connecting this segment's endpoints without regard for the 
-    shape of the segment. In particular, implements A* algorithm. Written by chat-GPT.
+    shape of the segment, by A* over real edge lengths (see routing).
 
-    Params: graph is the graph of college hill in dict of neighbors form
-    Returns: a list of points giving a directish path between the segment endpoints
+    Params: graph is the map as a MapContext, or a dict graph
+    Returns: a list of edges giving the shortest path between the segment
+    endpoints, each as (later point, earlier point), or None if there is none
     """
     def a_star(self, graph, start=None) -> list[tuple[tuple]]:
         if start == None:
             start = self.path[0]
-        end = self.path[-1]
-        # Open set to keep track of nodes to be explored
-        open_set = []
-        # Set to store visited nodes
-        closed_set = set()
-        # Dictionary to store the node the current node came from
-        came_from = {}
-        # Dictionary to store the cost of reaching a node from the start node
-        g_score = {start: 0}
-        # Dictionary to store the estimated total cost of reaching the end node from the start node
-        f_score = {start: point_point_dist(start, end)}
-
-        # Push the start node into the open set with its estimated total cost
-        heapq.heappush(open_set, (f_score[start], start))
-
-        while open_set:
-            # Pop the node with the lowest total cost from the open set
-            current = heapq.heappop(open_set)[1]
-
-            # Check if the current node is the end node
-            if current == end:
-                # Path found, reconstruct and return the path
-                return self.__reconstruct_path(came_from, current)
-
-            # Add the current node to the closed set
-            closed_set.add(current)
-
-            # Explore the neighbors of the current node
-            for neighbor in graph[current]:
-                # The cost for each edge is assumed to be 1
-                tentative_g_score = g_score[current] + 1
-
-                if neighbor in closed_set and tentative_g_score >= g_score.get(neighbor, float('inf')):
-                    # Ignore this neighbor if it has already been visited and a better path has been found
-                    continue
+        context = as_map_context(graph)
+        route, = cached_routes(context, [(context.csr.vertex_id(start), context.csr.vertex_id(self.path[-1]))])
+        return None if route is None else context.router.to_edges(route)
 
-                if tentative_g_score < g_score.get(neighbor, float('inf')):
-                    # Update the best path to reach the neighbor
-                    came_from[neighbor] = current
-                    # Update the cost to reach the neighbor from the start node
-                    g_score[neighbor] = tentative_g_score
-                    # Update the estimated total cost of reaching the end node from the start node
-                    f_score[neighbor] = tentative_g_score + point_point_dist(neighbor, end)
-                    if neighbor not in closed_set:
-                        # Add the neighbor to the open set if it hasn't been visited yet
-                        heapq.heappush(open_set, (f_score[neighbor], neighbor))
-
-        # No path found
-        return None
-
-    """Reconstructs the path from the start node to the current node"""
-    def __reconstruct_path(self, came_from, current) -> list[tuple[tuple]]:
-        path = []
-        while current in came_from:
-            try:
-                path.append((current, came_from[current]))
-            except IndexError:
-                pass
-            current = came_from[current]
-        return path[::-1]
-    
     """
     the loss of a path through the graph with respect to this segment
     In the distant future we would learn this from user input
     For now it will be a combination of location and direction error
     """
     def loss(self, path):
-        points, points_to_edges = self.__sample_points(path)
+        return float(self.losses([path])[0])
 
-        sum_of_squared_errors = 0
-        for point in points:
-            dist_err = point_point_dist(self.kdtree.closest_point(point), point)
-            angle_err = self.__angle_err(point, points_to_edges(point))
-            sum_of_squared_errors += (dist_err * angle_err) ** 2
-
-        return sum_of_squared_errors
+    """
+    loss for each of a batch of paths (lists of points), all at once: every
+    path is resampled together, and every sample's nearest segment edge comes
+    from one query. Scoring thousands of candidate routes costs a few array ops.
+    Returns a (len(paths),) float array
+    """
+    def losses(self, paths, num_points=SAMPLES) -> np.ndarray:
+        samples, sample_vecs, path_ids = resample(paths, num_points)
+        if len(samples) == 0:
+            return np.zeros(len(paths))
+        edge_ids, dist_errs = self.index.nearest(samples)
+        angle_errs = misalignments(sample_vecs, self.index.starts[edge_ids] - self.index.ends[edge_ids])
+        return np.bincount(path_ids, weights=(dist_errs * angle_errs) ** 2, minlength=len(paths))
 
     """
-    Samples points from consumed path to be evaluated for loss. Written by chat-GPT.
-    
-    Params:
-        path - the path to sample from, as a list of points
-        num_points - the number of points to sample. Defaults to 50
-    Returns:
-        sampled_points - a list of points that we sampled
-        points_to_edges_dict - a dictionary from the elements of sampled points to the
-                            edges on which they live
+    The loss of a drawn path, as returned by draw - a list of edges from the
+    start of the segment to its end, each in either orientation
     """
-    def __sample_points(self, path, num_points=50):
-        total_length = 0.0
-        lengths = []
-
-        # Calculate the total length of the path and the lengths between consecutive vertices
-        for i in range(len(path) - 1):
-            length = point_point_dist(path[i], path[i+1])
-            total_length += length
-            lengths.append(length)
-
-        # Calculate the distance between each sample point
-        distance_between_points = total_length / (num_points - 1)
-
-        sampled_points = []
-        current_distance = 0.0
-        points_to_edges_dict = {}
-
-        # Sample the points along the path
-        for i in range(len(lengths)):
-            length = lengths[i]
-            while current_distance <= length and len(sampled_points) < num_points:
-                ratio = current_distance / length
-                x1, y1 = path[i]
-                x2, y2 = path[i + 1]
-                x = x1 + (x2 - x1) * ratio
-                y = y1 + (y2 - y1) * ratio
-                sampled_points.append((x, y))
-                points_to_edges_dict[(x, y)] = (path[i], path[i+1])
-                current_distance += distance_between_points
-
-            current_distance -= length
-
-        return sampled_points, points_to_edges_dict
-    
-    """how far off a point is from the user-drawn curve"""
-    def __angle_err(self, point, edge):
-        nearest_edge = self.points2edges[self.kdtree.closest_point(point)]
+    def drawing_loss(self, drawn) -> float:
+        return self.loss(route_points(self.path[0], drawn))
 
-        a, b = np.array(edge[0]), np.array(edge[1])
-        c, d = np.array(nearest_edge[0]), np.array(nearest_edge[1])
-        point_vec = a - b
-        nearest_edge_vec = c - d
+"""
+Shortest paths for a batch of (start, end) vertex id pairs, from the context's
+PathCache where possible, with the rest found in one batch and cached - and
+also put in found, if given, as {(start, end): route}
+"""
+def cached_routes(context, pairs, found=None) -> list[list[int]]:
+    cache = context.path_cache
+    routes = [cache.get(("route", start, end)) for start, end in pairs]
+    missing = [i for i, route in enumerate(routes) if route is None]
+    new_routes = context.router.shortest_paths([pairs[i] for i in missing])
+    for i, route in zip(missing, new_routes):
+        routes[i] = route
+        if route is not None:
+            cache.put(("route", *pairs[i]), route)
+            if found is not None:
+                found[pairs[i]] = route
+    return routes
+
+"""
+Draws every segment on the map. Equivalent to drawing them one by one, except
+that drawings come from the context's PathCache where possible, and the rest
+are drawn by pool (a DrawPool) if given, else by draw_uncached in-process.
+graph is a MapContext or a dict graph.
+Returns a list of drawn paths, one per segment
+"""
+def draw_all(segments : list[Segment], graph, pool=None) -> list[list[tuple[tuple]]]:
+    context = as_map_context(graph)
+    cache = context.path_cache
+    keys = [segment.cache_key(context.csr) for segment in segments]
+    drawn = [cache.get(key) for key in keys]
+    missing = [i for i, path in enumerate(drawn) if path is None]
+    for i, path in enumerate(drawn):
+        if path is not None:
+            drawn[i] = list(path)
+
+    to_draw = [segments[i] for i in missing]
+    if pool is not None:
+        new_paths = pool.draw(to_draw, context)
+    else:
+        new_paths = draw_uncached(to_draw, context)
+    for i, path in zip(missing, new_paths):
+        drawn[i] = path
+        cache.put(keys[i], list(path))
+    return drawn
+
+"""
+draw_all as a generator, yielding each segment's drawn path, in order, as soon
+as it is drawn, for streaming a drawing out. Segments that aren't cached are
+drawn one at a time, by pool's workers if given (see DrawPool.iter_draw).
+"""
+def iter_draw_all(segments : list[Segment], graph, pool=None):
+    context = as_map_context(graph)
+    cache = context.path_cache
+    keys = [segment.cache_key(context.csr) for segment in segments]
+    drawn = [cache.get(key) for key in keys]
+    missing = [segment for segment, path in zip(segments, drawn) if path is None]
+    if pool is not None:
+        new_paths = pool.iter_draw(missing, context)
+    else:
+        new_paths = (draw_uncached([segment], context)[0] for segment in missing)
+    for key, path in zip(keys, drawn):
+        if path is None:
+            path = next(new_paths)
+            cache.put(key, list(path))
+        yield list(path)
+
+"""
+Draws segments on the map, walking each and then finishing the walks which got
+stuck together in one batch of shortest path queries. Routes it had to find are
+also put in found_routes if given, see cached_routes
+"""
+def draw_uncached(segments : list[Segment], context, found_routes=None) -> list[list[tuple[tuple]]]:
+    csr = context.csr
+    drawn = []
+    stuck = []
+    for i, segment in enumerate(segments):
+        path, arrived = segment.walk(context)
+        if not arrived:
+            path, start = segment.finish_start(path)
+            stuck.append((i, csr.vertex_id(start), csr.vertex_id(segment.path[-1])))
+        drawn.append(path)
+
+    if stuck:
+        print(f"[-] No path found for {len(stuck)} segments; finishing with A*", file=sys.stderr)
+    routes = cached_routes(context, [(start, end) for _, start, end in stuck], found_routes)
+    for (i, _, _), route in zip(stuck, routes):
+        if route is not None:
+            drawn[i] = drawn[i] + context.router.to_edges(route)
+    return drawn
+
+"""
+Samples num_points points evenly spaced by arc length along each of paths
+(lists of points), both ends included. Paths of zero length give no samples.
+
+Returns:
+    samples - (k, 2) float array of the sampled points, path by path
+    sample_vecs - (k, 2) float array, for each sample the vector from the end of
+        the path edge it lies on back to its start (a sample exactly on a
+        vertex belongs to the edge before it)
+    path_ids - (k,) int array, which path each sample came from
+"""
+def resample(paths, num_points=SAMPLES):
+    points = [np.asarray(path, dtype=float).reshape(-1, 2) for path in paths]
+    starts = np.concatenate([path[:-1] for path in points] + [np.zeros((0, 2))])
+    ends = np.concatenate([path[1:] for path in points] + [np.zeros((0, 2))])
+    edge_counts = np.array([max(len(path) - 1, 0) for path in points], dtype=int)
+    lengths = np.linalg.norm(ends - starts, axis=1)
+
+    # one running arc length over every path's edges back to back
+    edge_ends = np.cumsum(lengths)
+    first_edge = np.cumsum(edge_counts) - edge_counts
+    path_starts = np.concatenate(([0.0], edge_ends))[first_edge]
+    totals = np.bincount(np.repeat(np.arange(len(paths)), edge_counts), weights=lengths, minlength=len(paths))
+    path_ids = np.flatnonzero(totals > 0)
+
+    targets = path_starts[path_ids, None] + totals[path_ids, None] * np.linspace(0, 1, num_points)
+    edge_ids = np.searchsorted(edge_ends, targets, side="left")
+    # keep each sample on its own path's edges, past any zero length edges at its start
+    edge_ids = np.clip(edge_ids, first_edge[path_ids, None], (first_edge + edge_counts - 1)[path_ids, None]).ravel()
+    edge_starts = edge_ends[edge_ids] - lengths[edge_ids]
+    ratios = (targets.ravel() - edge_starts) / np.where(lengths[edge_ids] == 0, 1, lengths[edge_ids])
+    ratios = np.clip(ratios, 0, 1)[:, None]
+
+    samples = starts[edge_ids] + ratios * (ends[edge_ids] - starts[edge_ids])
+    return samples, starts[edge_ids] - ends[edge_ids], np.repeat(path_ids, num_points)
+
+"""
+The points a drawn path visits, in order from start. Each edge is in either
+orientation - the walk gives (earlier, later) and A* (later, earlier)
+"""
+def route_points(start, drawn) -> list[tuple]:
+    points = [start]
+    for a, b in drawn:
+        points.append(b if a == points[-1] else a)
+    return points
+
+"""Angle between the vectors in each pair of rows of v1 and v2, 0 where either is zero"""
+def misalignments(v1 : np.ndarray, v2 : np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(v1, axis=1) * np.linalg.norm(v2, axis=1)
+    cosine_angles = (v1 * v2).sum(axis=1) / np.where(norms == 0, 1, norms)
+    return np.where(norms == 0, 0, np.arccos(np.clip(cosine_angles, -1, 1)))
 
-        return misalignment(point_vec, nearest_edge_vec)
-    
 """Angle between vectors"""
 def misalignment(v1 : np.ndarray, v2 : np.ndarray):
     cosine_angle = np.dot(v1, v2) / (np.linalg.norm(v1) * np.linalg.norm(v2))
-    return np.arccos(cosine_angle)
+    return np.arccos(np.clip(cosine_angle, -1, 1))
 
 def main():
-    seg = Segment([(7, 7)])
-    sampling = seg.sample_points([(0, 0), (0, 10), (12, 15), (0, 24), (11, 24)])
-    print(sampling)
+    samples, _, _ = resample([[(0, 0), (0, 10), (12, 15), (0, 24), (11, 24)]])
+    print(samples)
     
 if __name__ == "__main__":
     main()
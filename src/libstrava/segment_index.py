@@ -0,0 +1,195 @@
+"""
+An exact nearest-edge index over a list of line segments.
+
+Segments are bucketed into a uniform grid by their bounding boxes, stored as
+flat numpy arrays (compressed-sparse-row style: cell_start[c] to cell_start[c+1]
+are the slots of cell_segments belonging to cell c). A batch query scans rings
+of cells outward from each point's cell, and stops for a point as soon as no
+unscanned cell could hold anything closer than what it already found. A point
+off the grid starts from the nearest cell on it, and counts its distance to the
+grid towards that bound, so it stops as quickly as a point on the grid would.
+"""
+import numpy as np
+
+BRUTE_FORCE_PAIRS = 4096 # below this many (point, edge) pairs, skip the grid and compare everything
+BRUTE_FORCE_EDGES = 32 # with this few edges, comparing everything beats the grid for any number of points
+BRUTE_FORCE_CHUNK = 1 << 18 # (point, edge) pairs compared at once, bounds memory use
+ARRAYS = ["starts", "ends", "origin", "cell_start", "cell_segments"]
+
+"""
+The closest point to each of points on the segment from the matching row of
+starts to the matching row of ends. All three are (n, 2) arrays
+"""
+def closest_on_segments(points, starts, ends):
+    seg_vecs = ends - starts
+    seg_len2 = (seg_vecs ** 2).sum(axis=1)
+    # a zero length edge is just its start point
+    param = ((points - starts) * seg_vecs).sum(axis=1) / np.where(seg_len2 == 0, 1, seg_len2)
+    param = np.clip(param, 0, 1)
+    return starts + param[:, None] * seg_vecs
+
+"""the cell offsets at chebyshev distance exactly k from the center, as a (m, 2) int array"""
+def ring_offsets(k):
+    if k == 0:
+        return np.zeros((1, 2), dtype=int)
+    side = np.arange(-k, k + 1)
+    edge = np.arange(-k + 1, k)
+    return np.concatenate((np.stack((side, np.full_like(side, -k)), axis=1),
+                           np.stack((side, np.full_like(side, k)), axis=1),
+                           np.stack((np.full_like(edge, -k), edge), axis=1),
+                           np.stack((np.full_like(edge, k), edge), axis=1)))
+
+"""
+Params:
+    edges - list of edges, each a pair of points, or an (m, 2, 2) array of them
+    cell_size - grid spacing; defaults to the median edge length
+"""
+class SegmentIndex:
+    def __init__(self, edges, cell_size=None):
+        if isinstance(edges, np.ndarray):
+            self.__edges = None
+        else:
+            self.__edges = edges = list(edges)
+        ends = np.asarray(edges, dtype=float).reshape(-1, 2, 2)
+        self.starts, self.ends = ends[:, 0], ends[:, 1]
+
+        if len(ends) == 0:
+            self.origin, self.cell_size, self.shape = np.zeros(2), 1.0, (1, 1)
+            self.cell_start = np.zeros(2, dtype=int)
+            self.cell_segments = np.zeros(0, dtype=int)
+            return
+
+        lengths = np.linalg.norm(self.ends - self.starts, axis=1)
+        if cell_size is None:
+            cell_size = np.median(lengths[lengths > 0]) if np.any(lengths > 0) else 1.0
+        self.cell_size = float(cell_size)
+        self.origin = np.minimum(self.starts, self.ends).min(axis=0)
+        extent = np.maximum(self.starts, self.ends).max(axis=0) - self.origin
+        self.shape = tuple(int(cells) + 1 for cells in extent // self.cell_size)
+
+        # register every segment in every cell its bounding box touches
+        low = self.__cells(np.minimum(self.starts, self.ends))
+        high = self.__cells(np.maximum(self.starts, self.ends))
+        spans = high - low + 1
+        counts = spans[:, 0] * spans[:, 1]
+        segments = np.repeat(np.arange(len(ends)), counts)
+        slot = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cell_x = low[segments, 0] + slot % spans[segments, 0]
+        cell_y = low[segments, 1] + slot // spans[segments, 0]
+        cells = cell_y * self.shape[0] + cell_x
+
+        order = np.argsort(cells, kind="stable")
+        self.cell_segments = segments[order]
+        self.cell_start = np.zeros(self.shape[0] * self.shape[1] + 1, dtype=int)
+        np.cumsum(np.bincount(cells, minlength=self.shape[0] * self.shape[1]), out=self.cell_start[1:])
+
+    """The arrays and sizes that make up the index, e.g. for np.save. See from_arrays"""
+    def to_arrays(self) -> dict:
+        arrays = {name: getattr(self, name) for name in ARRAYS}
+        arrays["cell_size"] = np.array(self.cell_size)
+        arrays["shape"] = np.array(self.shape)
+        return arrays
+
+    """Rebuilds an index from to_arrays output without redoing any work, e.g. from memory-mapped files"""
+    @classmethod
+    def from_arrays(cls, arrays):
+        index = cls.__new__(cls)
+        for name in ARRAYS:
+            setattr(index, name, arrays[name])
+        index.cell_size = arrays["cell_size"].item()
+        index.shape = tuple(int(cells) for cells in arrays["shape"])
+        index.__edges = None
+        return index
+
+    """The edges as a list of pairs of points, converted from the arrays on first use"""
+    @property
+    def edges(self):
+        if self.__edges is None:
+            self.__edges = [(tuple(a), tuple(b)) for a, b in
+                            zip(self.starts.tolist(), self.ends.tolist())]
+        return self.__edges
+
+    def __len__(self):
+        return len(self.starts)
+
+    """integer grid coordinates of points, clamped onto the grid"""
+    def __cells(self, points):
+        cells = ((points - self.origin) // self.cell_size).astype(int)
+        return np.clip(cells, 0, np.array(self.shape) - 1)
+
+    """
+    Finds the closest edge to each of points, exactly.
+
+    Returns:
+        edge_ids - (n,) int array of indices into self.edges, -1 if there are no edges
+        distances - (n,) float array of euclidian distances to those edges
+    """
+    def nearest(self, points):
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        best = np.full(len(points), -1)
+        best_dist2 = np.full(len(points), np.inf)
+        if len(self) == 0:
+            return best, best_dist2
+        if len(points) * len(self) <= BRUTE_FORCE_PAIRS or len(self) <= BRUTE_FORCE_EDGES:
+            rows = max(1, BRUTE_FORCE_CHUNK // len(self))
+            for chunk in range(0, len(points), rows):
+                best[chunk:chunk + rows], best_dist2[chunk:chunk + rows] = \
+                    self.__nearest_brute_force(points[chunk:chunk + rows])
+            return best, best_dist2
+
+        home = self.__cells(points)
+        # how far off the grid each point is, which every edge is at least
+        grid_end = self.origin + np.array(self.shape) * self.cell_size
+        off_grid2 = ((points - np.clip(points, self.origin, grid_end)) ** 2).sum(axis=1)
+        active = np.arange(len(points))
+        ring = 0
+        while len(active) and ring <= max(self.shape):
+            offsets = ring_offsets(ring)
+            cell_x = home[active, 0][:, None] + offsets[:, 0]
+            cell_y = home[active, 1][:, None] + offsets[:, 1]
+            on_grid = (cell_x >= 0) & (cell_x < self.shape[0]) & (cell_y >= 0) & (cell_y < self.shape[1])
+            query_ids = np.broadcast_to(active[:, None], on_grid.shape)[on_grid]
+            cells = (cell_y * self.shape[0] + cell_x)[on_grid]
+
+            # expand each (query, cell) pair into a (query, segment) pair per segment in the cell
+            counts = self.cell_start[cells + 1] - self.cell_start[cells]
+            query_ids = np.repeat(query_ids, counts)
+            slots = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) \
+                    + np.repeat(self.cell_start[cells], counts)
+            segments = self.cell_segments[slots]
+
+            if len(segments):
+                probes = points[query_ids]
+                nearest = closest_on_segments(probes, self.starts[segments], self.ends[segments])
+                dist2 = ((probes - nearest) ** 2).sum(axis=1)
+                before = best_dist2[query_ids]
+                np.minimum.at(best_dist2, query_ids, dist2)
+                won = dist2 == best_dist2[query_ids]
+                # among equally close edges keep the lowest id, like the brute force search
+                improved = won & (dist2 < before)
+                best[query_ids[improved]] = len(self)
+                np.minimum.at(best, query_ids[won], segments[won])
+
+            # every cell past this ring is at least ring cells away, on top of the distance to the grid
+            active = active[best_dist2[active] > (ring * self.cell_size) ** 2 + off_grid2[active]]
+            ring += 1
+
+        return best, np.sqrt(best_dist2)
+
+    def __nearest_brute_force(self, points):
+        probes = np.repeat(points, len(self), axis=0)
+        starts = np.tile(self.starts, (len(points), 1))
+        ends = np.tile(self.ends, (len(points), 1))
+        dist2 = ((probes - closest_on_segments(probes, starts, ends)) ** 2).sum(axis=1)
+        dist2 = dist2.reshape(len(points), len(self))
+        best = dist2.argmin(axis=1)
+        return best, np.sqrt(dist2[np.arange(len(points)), best])
+
+    """The closest point on edge edge_ids[i] to points[i], for every i"""
+    def project(self, points, edge_ids):
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        return closest_on_segments(points, self.starts[edge_ids], self.ends[edge_ids])
+
+    """A new index over just the edges with the given ids"""
+    def subset(self, edge_ids):
+        return SegmentIndex(np.stack((self.starts[edge_ids], self.ends[edge_ids]), axis=1))
@@ -0,0 +1,150 @@
+"""
+How drawings and routes travel between the website and the backend.
+
+/api/v1 and /api/v2 speak a line-based text protocol: counts and coordinates,
+one per line, in a URL-encoded form field. /api/v3 speaks either of two compact
+formats instead, picked by the request's Content-Type and answered in kind.
+
+Packed (application/octet-stream), all little-endian:
+    header - b"FR", the format version (u8), the float type (b"f" float32 or
+        b"d" float64), and a count (u32)
+    a drawing - count path lengths (u32), then every path's points in order,
+        x y interleaved, as floats
+    a route - count edges, each x1 y1 x2 y2 as floats
+JSON (application/json), coordinates flattened the same way:
+    a drawing - {"paths": [[x0, y0, x1, y1, ...], ...]}
+    a route - {"edges": [x1, y1, x2, y2, ...]}
+
+Both parse straight into numpy arrays, with no per-point work for packed input.
+"""
+import itertools
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b"FR"
+WIRE_VERSION = 1
+HEADER = struct.Struct("<2sBcI")
+FLOATS = {b"f": np.dtype("<f4"), b"d": np.dtype("<f8")}
+COUNTS = np.dtype("<u4")
+
+############################# TEXT PROTOCOL #############################
+
+"""
+Reads in a drawing, which will be turned into a list of lists of points,
+where each inner list represents a path the user drew. The drawing data
+itself looks like a series of inner list strings, where each inner list
+string is the length n of the list on a line, then x y on the next n lines
+
+Returns the list of paths
+"""
+def read_in_data_new_api(lines) -> list[list[tuple[float, float]]]:
+    paths = []
+    while True:
+        try:
+            path_len = int(next(lines))
+        except StopIteration:
+            break
+        path = []
+        paths.append(path)
+        for _ in range(path_len):
+            x, y = next(lines).split()
+            point = float(x), float(y)
+            path.append(point)
+    return paths
+
+"""Writes a list of edges (aka a subgraph) as a count, then `x1 y1 x2 y2` lines"""
+def write_edge_list(edges) -> str:
+    return f"{len(edges)}\n" + "".join(f"{a} {b} {c} {d}\n" for (a, b), (c, d) in edges)
+
+"""Writes a list of points as a count, then `x y` lines"""
+def write_points(points) -> str:
+    return f"{len(points)}\n" + "".join(f"{x} {y}\n" for x, y in points)
+
+############################ PACKED PROTOCOL ############################
+
+"""
+Splits packed data into its header and the rest.
+Returns (float dtype, float code, count, the bytes after the header)
+"""
+def unpack_header(data):
+    if len(data) < HEADER.size:
+        raise ValueError("packed data is shorter than its header")
+    magic, version, code, count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("packed data does not start with b'FR'")
+    if version != WIRE_VERSION:
+        raise ValueError(f"packed format version {version} is not {WIRE_VERSION}")
+    if code not in FLOATS:
+        raise ValueError(f"float type {code} must be b'f' or b'd'")
+    return FLOATS[code], code, count, memoryview(data)[HEADER.size:]
+
+"""
+A packed drawing as a list of (n, 2) float arrays, one per path, viewing data
+without copying it. Also returns the float code, to answer in the same precision
+"""
+def unpack_drawing(data):
+    dtype, code, count, body = unpack_header(data)
+    if len(body) < count * COUNTS.itemsize:
+        raise ValueError(f"packed drawing is too short for {count} path lengths")
+    lengths = np.frombuffer(body, COUNTS, count)
+    body = body[count * COUNTS.itemsize:]
+    expected = int(lengths.sum(dtype=np.int64)) * 2 * dtype.itemsize
+    if len(body) != expected:
+        raise ValueError(f"packed drawing has {len(body)} bytes of points, expected {expected}")
+    coords = np.frombuffer(body, dtype).reshape(-1, 2)
+    if not np.isfinite(coords).all():
+        raise ValueError("packed drawing has non-finite points")
+    return np.split(coords, np.cumsum(lengths[:-1], dtype=np.int64)) if count else [], code
+
+"""Packs a drawing, a list of paths of (x, y) points, with float code b"f" or b"d" """
+def pack_drawing(paths, code=b"d") -> bytes:
+    lengths = np.array([len(path) for path in paths], dtype=COUNTS)
+    coords = np.concatenate([np.asarray(path, dtype=FLOATS[code]).reshape(-1, 2) for path in paths]) \
+        if paths else np.zeros((0, 2), dtype=FLOATS[code])
+    return HEADER.pack(MAGIC, WIRE_VERSION, code, len(paths)) + lengths.tobytes() + coords.tobytes()
+
+"""
+A route, a list of ((x1, y1), (x2, y2)) edges, as a flat float array of x1 y1 x2
+y2 runs. fromiter skips the nested sequence checks np.asarray does per edge
+"""
+def edge_coords(edges, dtype=float):
+    chain = itertools.chain.from_iterable
+    return np.fromiter(chain(chain(edges)), dtype, 4 * len(edges))
+
+"""Packs a route, a list of ((x1, y1), (x2, y2)) edges, with float code b"f" or b"d" """
+def pack_edges(edges, code=b"d") -> bytes:
+    return HEADER.pack(MAGIC, WIRE_VERSION, code, len(edges)) + edge_coords(edges, FLOATS[code]).tobytes()
+
+"""A packed route as an (n, 4) float array of x1 y1 x2 y2 rows"""
+def unpack_edges(data):
+    dtype, _, count, body = unpack_header(data)
+    if len(body) != count * 4 * dtype.itemsize:
+        raise ValueError(f"packed route has {len(body)} bytes of edges, expected {count * 4 * dtype.itemsize}")
+    return np.frombuffer(body, dtype).reshape(-1, 4)
+
+############################# JSON PROTOCOL #############################
+
+"""A JSON drawing (parsed already, e.g. by flask) as a list of (n, 2) float arrays"""
+def drawing_from_json(body):
+    if not isinstance(body, dict) or not isinstance(body.get("paths"), list):
+        raise ValueError('a JSON drawing must be {"paths": [[x0, y0, x1, y1, ...], ...]}')
+    paths = []
+    for path in body["paths"]:
+        try:
+            coords = np.asarray(path, dtype=float)
+        except TypeError:
+            coords = None
+        if coords is None or coords.ndim != 1 or len(coords) % 2 or not np.isfinite(coords).all():
+            raise ValueError("every JSON path must be a flat list of x y pairs of numbers")
+        paths.append(coords.reshape(-1, 2))
+    return paths
+
+"""A route, a list of ((x1, y1), (x2, y2)) edges, as compact JSON"""
+def edges_to_json(edges) -> str:
+    return json.dumps({"edges": edge_coords(edges).tolist()}, separators=(",", ":"))
+
+"""Paths as (n, 2) arrays as the lists of point tuples get_subgraph takes"""
+def as_point_lists(paths) -> list[list[tuple[float, float]]]:
+    return [list(map(tuple, np.asarray(path, dtype=float).tolist())) for path in paths]
@@ -0,0 +1,312 @@
+"""
+Production entry point: serves the API and the built website (website/dist)
+from one set of worker processes, in place of backend.py's development server
+and frontend.py's single-threaded http.server.
+
+The backend is imported - and so the map loaded, indexed and routed over - once,
+in the master process. The workers are forked from it afterwards, so they all
+share the map's pages copy-on-write, and each then starts its own drawing pool
+with its share of the cores (see backend.worker_pools). Queued drawings go to
+one job queue, which the master starts in a process of its own before forking
+the workers, so that every worker sees every job. gunicorn does the serving
+when it is installed; otherwise a small prefork server built on werkzeug's does.
+
+The website is served with its build's content-hashed assets cached for good
+and everything else revalidated by ETag, and as gzip/brotli files precompressed
+at startup when the client accepts them (brotli needs the brotli package).
+
+Signals to the master: SIGHUP replaces the workers gracefully (new ones are
+forked first, the old ones finish their requests and exit), SIGTERM/SIGINT shut
+down gracefully.
+Run from src/ with e.g. `python serve.py --workers 4 --bind 0.0.0.0:443 --certfile ... --keyfile ...`
+"""
+import argparse
+import gzip
+import math
+import mimetypes
+import os
+import pathlib
+import signal
+import socket
+import sys
+import threading
+import time
+
+from flask import abort, request, send_file
+from werkzeug.security import safe_join
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+try:
+    import gunicorn.app.base
+except ImportError:
+    gunicorn = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+root = str(pathlib.Path(__file__).parent.parent)
+DIST = f"{root}/website/dist"
+BIND = "0.0.0.0:8080"
+WORKERS = None # server processes, defaults to one per core
+THREADS = 8 # request threads per worker, so streams and job waits don't block the rest
+KEEPALIVE = 5 # seconds an idle keep-alive connection is held open
+GRACEFUL_TIMEOUT = 30 # seconds a retiring worker gets to finish its requests before it is killed
+POLL = 0.5 # seconds between the prefork master's checks on its workers
+COMPRESSIBLE = {".html", ".js", ".css", ".svg", ".json", ".txt", ".map", ".ico", ".xml"}
+COMPRESS_MIN_BYTES = 1024 # smaller files aren't worth compressing
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")] # precompressed variants, most preferred first
+IMMUTABLE = "assets/" # vite puts the build's content-hashed files here
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+############################# STATIC FILES ##############################
+
+"""
+Writes a .gz (and, with brotli installed, a .br) beside every compressible file
+under directory that lacks an up to date one. Returns how many it wrote
+"""
+def precompress(directory) -> int:
+    compressors = [(".gz", lambda data: gzip.compress(data, 9, mtime=0))]
+    if brotli is not None:
+        compressors.append((".br", lambda data: brotli.compress(data, quality=11)))
+    written = 0
+    for folder, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(folder, name)
+            if os.path.splitext(name)[1] not in COMPRESSIBLE or os.path.getsize(path) < COMPRESS_MIN_BYTES:
+                continue
+            for suffix, compress in compressors:
+                if os.path.exists(path + suffix) and os.path.getmtime(path + suffix) >= os.path.getmtime(path):
+                    continue
+                with open(path, "rb") as f:
+                    data = f.read()
+                with open(path + suffix, "wb") as f:
+                    f.write(compress(data))
+                written += 1
+    return written
+
+"""
+Adds routes to app serving the files under directory, / being index.html. A
+precompressed variant is sent instead of the file when the client accepts its
+encoding. Hashed assets may be cached forever; anything else must be
+revalidated (by its ETag) on every use.
+"""
+def serve_website(app, directory):
+    @app.route("/", defaults={"path": "index.html"})
+    @app.route("/<path:path>")
+    def website_file(path):
+        full = safe_join(directory, path)
+        if full is None or not os.path.isfile(full):
+            abort(404)
+
+        mimetype = mimetypes.guess_type(full)[0] or "application/octet-stream"
+        for encoding, suffix in ENCODINGS:
+            if request.accept_encodings[encoding] and os.path.isfile(full + suffix):
+                response = send_file(full + suffix, mimetype=mimetype)
+                response.content_encoding = encoding
+                break
+        else:
+            response = send_file(full, mimetype=mimetype)
+
+        response.vary.add("Accept-Encoding")
+        if path.startswith(IMMUTABLE):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response
+
+############################## GUNICORN #################################
+
+if gunicorn is not None:
+    """Runs app under gunicorn, with options as its settings"""
+    class GunicornServer(gunicorn.app.base.BaseApplication):
+        def __init__(self, app, options):
+            self.application = app
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+"""
+Serves app with gunicorn, preloaded so workers fork off the loaded map, with
+threaded workers so long streams don't starve other requests. gunicorn handles
+SIGHUP itself; with the app preloaded the new workers keep the loaded code, and
+pick up a changed map file as any request would
+"""
+def serve_gunicorn(app, on_fork, on_exit, options):
+    GunicornServer(app, {"bind": options.bind,
+                         "workers": options.workers,
+                         "worker_class": "gthread",
+                         "threads": THREADS,
+                         "keepalive": options.keepalive,
+                         "graceful_timeout": options.graceful_timeout,
+                         "preload_app": True,
+                         "post_fork": lambda server, worker: on_fork(),
+                         "worker_exit": lambda server, worker: on_exit(),
+                         "certfile": options.certfile,
+                         "keyfile": options.keyfile}).run()
+
+########################### PREFORK FALLBACK ############################
+
+"""
+Handler giving up on a client that sends nothing for timeout seconds. werkzeug
+closes every connection after one response, so unlike gunicorn the fallback
+has no keep-alive, and --keepalive only bounds how long it waits on a request
+"""
+def timeout_handler(timeout):
+    class TimeoutHandler(WSGIRequestHandler):
+        pass
+    TimeoutHandler.timeout = timeout
+    return TimeoutHandler
+
+"""
+One worker of the prefork server: a threaded werkzeug server accepting on the
+master's listening socket. A signal, or the master dying, stops it accepting;
+it exits once the requests it is serving are done
+"""
+def run_worker(app, listener, on_fork, on_exit, options):
+    master = os.getppid()
+    server = make_server(listener.getsockname()[0], listener.getsockname()[1], app, threaded=True,
+                         request_handler=timeout_handler(options.keepalive),
+                         ssl_context=ssl_context(options), fd=listener.fileno())
+    server.daemon_threads = False # so server_close waits for the requests in flight
+
+    # the pools fork their workers here, with the default handlers rather than the master's or ours
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_DFL)
+    on_fork()
+
+    def stop(*_):
+        threading.Thread(target=server.shutdown).start() # shutdown blocks until serve_forever returns
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, stop)
+
+    def watch_master():
+        while os.getppid() == master:
+            time.sleep(POLL)
+        print(f"[-] Error: master {master} died, worker {os.getpid()} stopping", file=sys.stderr)
+        stop()
+    threading.Thread(target=watch_master, daemon=True).start()
+
+    try:
+        server.serve_forever()
+        server.server_close()
+    finally:
+        on_exit()
+
+"""(certfile, keyfile) for werkzeug, or None to serve plain http"""
+def ssl_context(options):
+    return (options.certfile, options.keyfile) if options.certfile else None
+
+"""
+Serves app from options.workers forked processes sharing one listening socket,
+replacing any that die. Each worker calls on_fork once forked and on_exit
+before it exits. SIGHUP forks a fresh set and retires the old one;
+SIGTERM/SIGINT retire every worker, then exit
+"""
+def serve_prefork(app, on_fork, on_exit, options):
+    host, port = options.bind.rsplit(":", 1)
+    listener = socket.create_server((host, int(port)), backlog=128)
+    workers = set()
+    retiring = {} # pid -> time it gets killed at
+    flags = {"reload": False, "stop": False}
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                run_worker(app, listener, on_fork, on_exit, options)
+            except BaseException as e:
+                print(f"[-] Error: worker {os.getpid()} died: {e!r}", file=sys.stderr)
+                status = 1
+            finally:
+                os._exit(status)
+        workers.add(pid)
+
+    def retire(pids):
+        for pid in pids:
+            workers.discard(pid)
+            retiring[pid] = time.time() + options.graceful_timeout
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGHUP, lambda *_: flags.update(reload=True))
+    signal.signal(signal.SIGTERM, lambda *_: flags.update(stop=True))
+    signal.signal(signal.SIGINT, lambda *_: flags.update(stop=True))
+    for _ in range(options.workers):
+        spawn()
+    print(f"[+] serving on {options.bind} with {options.workers} workers", file=sys.stderr)
+
+    while workers or retiring:
+        if flags["stop"]:
+            flags["stop"] = False
+            retire(list(workers))
+        if flags["reload"]:
+            flags["reload"] = False
+            old = list(workers)
+            for _ in old:
+                spawn()
+            retire(old)
+            print(f"[+] reloaded: {len(old)} workers retiring", file=sys.stderr)
+
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if retiring.pop(pid, None) is None and pid in workers: # died unasked
+                workers.discard(pid)
+                print(f"[-] Error: worker {pid} exited, starting another", file=sys.stderr)
+                spawn()
+
+        for pid, deadline in list(retiring.items()):
+            if time.time() > deadline:
+                print(f"[-] Error: worker {pid} did not finish in time, killing it", file=sys.stderr)
+                os.kill(pid, signal.SIGKILL)
+                retiring[pid] = math.inf
+        time.sleep(POLL)
+    listener.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves the Fun Run Mapper API and website")
+    parser.add_argument("--bind", default=BIND, help="host:port to listen on")
+    parser.add_argument("--workers", type=int, default=WORKERS or os.cpu_count() or 1)
+    parser.add_argument("--keepalive", type=int, default=KEEPALIVE, help="seconds idle connections stay open")
+    parser.add_argument("--graceful-timeout", type=int, default=GRACEFUL_TIMEOUT,
+                        help="seconds retiring workers get to finish their requests")
+    parser.add_argument("--certfile", help="TLS certificate chain, e.g. letsencrypt's fullchain.pem")
+    parser.add_argument("--keyfile", help="TLS private key, e.g. letsencrypt's privkey.pem")
+    parser.add_argument("--dist", default=DIST, help="the built website to serve, see `npm run build`")
+    parser.add_argument("--builtin", action="store_true", help="use the prefork server even if gunicorn is installed")
+    options = parser.parse_args()
+
+    import backend # loads the map, once, before anything forks
+    backend.SERVER_WORKERS = options.workers
+    if os.path.isdir(options.dist):
+        written = precompress(options.dist)
+        print(f"[+] serving website {options.dist} ({written} files precompressed)", file=sys.stderr)
+        serve_website(backend.app, options.dist)
+    else:
+        print(f"[-] Error: no website build at {options.dist}, serving the API only", file=sys.stderr)
+
+    backend.start_job_server()
+    try:
+        if gunicorn is not None and not options.builtin:
+            serve_gunicorn(backend.app, backend.worker_pools, backend.stop_pools, options)
+        else:
+            serve_prefork(backend.app, backend.worker_pools, backend.stop_pools, options)
+    finally:
+        backend.stop_job_server()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+"""
+The tests import libstrava the way the scripts in src/ do.
+Run from src/ with `python -m pytest -q tests`
+"""
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
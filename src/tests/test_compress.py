@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from libstrava.graphs import (glue, compress, importance, shave_stubble, hair_length, remove_hair,
+                              IMPORTANCE_THRESH, STUBBLE_THRESH)
+
+"""a path through corners, with count evenly spaced points on each side"""
+def polyline(corners, count):
+    points = []
+    for start, end in zip(corners, corners[1:]):
+        points += [tuple(start + (end - start) * t) for t in np.linspace(0, 1, count, endpoint=False)]
+    return points + [tuple(corners[-1])]
+
+"""every edge goes both ways"""
+def symmetric(graph):
+    return all(graph[neighbor].count(vertex) == neighbors.count(neighbor)
+               for vertex, neighbors in graph.items() for neighbor in neighbors)
+
+"""compress done the slow way: drop the least important path vertex while it is below threshold"""
+def brute_compress(graph, threshold):
+    while True:
+        scores = {point: importance(graph, point) for point in graph if len(graph[point]) == 2}
+        if not scores or min(scores.values()) >= threshold:
+            return graph
+        point = min(scores, key=scores.get)
+        n1, n2 = graph[point]
+        graph[n1][graph[n1].index(point)] = n2
+        graph[n2][graph[n2].index(point)] = n1
+        del graph[point]
+
+"""shave_stubble done the slow way: drop the shortest hair while it is shorter than threshold"""
+def brute_shave(graph, threshold):
+    while True:
+        tips = {point: hair_length(point, graph) for point in graph if len(graph[point]) == 1}
+        if not tips or min(tips.values()) >= threshold:
+            return graph
+        remove_hair(min(tips, key=tips.get), graph)
+
+def test_compress_keeps_corners():
+    corners = np.array([(0, 0), (0, 1), (1, 1), (1, 0.2)], dtype=float)
+    graph = glue([polyline(corners, 50)])
+    compress(graph, IMPORTANCE_THRESH)
+    assert set(graph) == set(map(tuple, corners))
+    assert symmetric(graph)
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_compress_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    paths = [list(map(tuple, (rng.random(2) + np.cumsum(rng.normal(0, 0.05, (60, 2)), axis=0)).tolist()))
+             for _ in range(3)]
+    graph = glue(paths)
+    expected = brute_compress({vertex: list(neighbors) for vertex, neighbors in graph.items()}, 0.01)
+    compress(graph, 0.01)
+    assert graph == expected
+    assert symmetric(graph)
+    assert all(importance(graph, point) >= 0.01 for point in graph if len(graph[point]) == 2)
+
+def test_shave_stubble_removes_short_hairs():
+    line = [(0, 0), (0.1, 0), (0.2, 0), (0.3, 0)]
+    graph = glue([line])
+    graph[(0.1, 0)].append((0.1, 0.01)) # a hair 0.01 long off the line
+    graph[(0.1, 0.01)] = [(0.1, 0)]
+    shave_stubble(graph, STUBBLE_THRESH)
+    # the line's own ends are hairs too, but with the short one gone they are the whole line, too long to go
+    assert graph == glue([line])
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_shave_stubble_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    # a spine with random side branches, some shorter than the threshold
+    spine = [(x, 0.0) for x in np.linspace(0, 1, 21).tolist()]
+    graph = glue([spine])
+    for base in rng.choice(len(spine), 8, replace=False):
+        last = spine[base]
+        for _ in range(int(rng.integers(1, 6))):
+            point = (last[0] + 0.01 * rng.random(), last[1] + 0.005 + 0.005 * rng.random())
+            graph[last].append(point)
+            graph[point] = [last]
+            last = point
+    expected = brute_shave({vertex: list(neighbors) for vertex, neighbors in graph.items()}, STUBBLE_THRESH)
+    shave_stubble(graph, STUBBLE_THRESH)
+    assert {vertex: sorted(neighbors) for vertex, neighbors in graph.items()} == \
+           {vertex: sorted(neighbors) for vertex, neighbors in expected.items()}
+    assert symmetric(graph)
@@ -0,0 +1,46 @@
+import pathlib
+
+import numpy as np
+
+from libstrava.csr_graph import CSRGraph
+from libstrava.edges import read_edges
+from libstrava.graphs import graph_from_edges
+
+MAP_FILE = str(pathlib.Path(__file__).parent.parent.parent / "data" / "edge_list.txt")
+EDGES = read_edges(MAP_FILE)
+
+"""each undirected edge once, orientation and order aside"""
+def edge_set(edges):
+    return {tuple(sorted(edge)) for edge in edges}
+
+"""a dict graph with every vertex's neighbors sorted, as writing out the edges may reorder them"""
+def sorted_neighbors(graph):
+    return {vertex: sorted(neighbors) for vertex, neighbors in graph.items()}
+
+def test_from_edges_matches_graph_from_edges():
+    assert CSRGraph.from_edges(EDGES).to_dict() == graph_from_edges(EDGES)
+
+def test_edges_round_trip():
+    csr = CSRGraph.from_edges(EDGES)
+    assert edge_set(csr.to_edges()) == edge_set(EDGES)
+    assert sorted_neighbors(CSRGraph.from_edges(csr.to_edges()).to_dict()) == sorted_neighbors(csr.to_dict())
+
+def test_dict_round_trip():
+    graph = graph_from_edges(EDGES)
+    assert CSRGraph.from_dict(graph).to_dict() == graph
+
+def test_self_loop_kept_once():
+    edges = [((0.0, 0.0), (1.0, 0.0)), ((1.0, 0.0), (1.0, 0.0)), ((1.0, 0.0), (2.0, 1.0))]
+    assert edge_set(CSRGraph.from_edges(edges).to_edges()) == edge_set(edges)
+
+def test_file_round_trip(tmp_path):
+    csr = CSRGraph.from_edges(EDGES)
+    csr.write(tmp_path / "edges.txt")
+    assert sorted_neighbors(CSRGraph.read(tmp_path / "edges.txt").to_dict()) == sorted_neighbors(csr.to_dict())
+
+def test_arrays_round_trip():
+    csr = CSRGraph.from_edges(EDGES)
+    rebuilt = CSRGraph.from_arrays(csr.to_arrays())
+    for name, array in csr.to_arrays().items():
+        np.testing.assert_array_equal(getattr(rebuilt, name), array)
+    assert rebuilt.to_dict() == csr.to_dict()
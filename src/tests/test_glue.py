@@ -0,0 +1,58 @@
+import contextlib
+import io
+import pathlib
+
+import numpy as np
+import pytest
+
+from benchmarks.glue import fake_drawing, legacy_glue, legacy_intersections, normalized, one_way_clone
+from libstrava import get_map_context
+from libstrava.graphs import glue, find_intersections, split_at_critical_vertices, get_subgraph
+
+MAP_FILE = str(pathlib.Path(__file__).parent.parent.parent / "data" / "edge_list.txt")
+SQUARE = [(0, 0), (0, 1), (1, 1), (1, 0), (0, 0)] # a stroke closing on its first point
+
+"""a closed stroke of count points round a circle"""
+def circle(count):
+    angles = np.linspace(0, 2 * np.pi, count)
+    closed = [tuple(point) for point in (0.5 + 0.1 * np.stack((np.cos(angles), np.sin(angles)), axis=1)).tolist()]
+    closed[-1] = closed[0]
+    return closed
+
+@pytest.mark.parametrize("n", [10, 100, 500])
+def test_glues_the_pairs_the_original_does(n):
+    paths = fake_drawing(np.random.default_rng(n), n)
+    new_pairs, old_pairs = set(find_intersections(paths)), set(legacy_intersections(paths))
+    shared = new_pairs & old_pairs
+    assert all(one_way_clone(paths, pair, shared) for pair in new_pairs ^ old_pairs)
+
+@pytest.mark.parametrize("n", [10, 100])
+def test_glues_the_graph_the_original_does(n):
+    paths = fake_drawing(np.random.default_rng(n), n)
+    assert normalized(glue(paths)) == normalized(legacy_glue(paths))
+
+def test_closed_stroke_glues_into_a_loop():
+    closed = circle(30)
+    graph = glue([closed])
+    assert len(graph) == len(closed) - 1
+    assert all(len(neighbors) == 2 for neighbors in graph.values())
+
+@pytest.mark.parametrize("stroke", [SQUARE, circle(30)])
+def test_closed_stroke_splits_into_pieces(stroke):
+    critical_vertices, pieces = split_at_critical_vertices(glue([stroke]))
+    assert len(critical_vertices) == 3
+    assert {vertex for _, _, path in pieces for vertex in path} == set(stroke)
+    assert all(start != end for start, end, _ in pieces)
+
+def test_closed_stroke_beside_an_open_one():
+    closed = circle(30)
+    critical_vertices, pieces = split_at_critical_vertices(glue([closed, [(0, 0), (0.1, 0.05), (0.2, 0)]]))
+    assert len(critical_vertices) == 5
+    assert set(closed) <= {vertex for _, _, path in pieces for vertex in path}
+
+@pytest.mark.parametrize("seed", [0, 3])
+def test_closed_stroke_draws_a_route(seed):
+    context = get_map_context(MAP_FILE, watch=False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        route = get_subgraph(context, context.vertex_tree, [SQUARE], seed=seed)
+    assert route
@@ -0,0 +1,50 @@
+import pathlib
+
+import numpy as np
+import pytest
+
+from libstrava.edges import read_edges
+from libstrava.fast_gradient_decent import (build_edge_index, embed, embedding_loss, gradient,
+                                            loss_and_gradient, random_init, representative_subgraph)
+
+MAP_FILE = str(pathlib.Path(__file__).parent.parent.parent / "data" / "edge_list.txt")
+STEPS = (1e-7, 1e-7, 1e-7, 1e-7, 1e-6) # finite difference step per parameter, (x, y, theta, r, gamma)
+
+"""the mean squared distance from the embedded points to the closest edge of a fixed subgraph"""
+def fixed_subgraph_loss(points, parameters, subgraph_index):
+    _, dists = subgraph_index.nearest(embed(points, parameters))
+    return np.mean(dists ** 2)
+
+@pytest.fixture(scope="module")
+def graph():
+    edges = read_edges(MAP_FILE)
+    return edges, build_edge_index(edges)
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_loss_matches_embedding_loss(graph, seed):
+    edges, graph_index = graph
+    rng = np.random.default_rng(seed)
+    points = rng.random((200, 2))
+    parameters = random_init(rng)
+    loss, _ = loss_and_gradient(points, edges, parameters, graph_index)
+    assert loss == pytest.approx(embedding_loss(points, edges, parameters, graph_index))
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_gradient_matches_finite_differences(graph, seed):
+    edges, graph_index = graph
+    rng = np.random.default_rng(seed)
+    points = rng.random((200, 2))
+    parameters = random_init(rng)
+    # the gradient holds the subgraph fixed for the step, so difference the loss over that subgraph
+    _, subgraph_index = representative_subgraph(points, edges, parameters, graph_index, with_index=True)
+
+    expected = []
+    for i, step in enumerate(STEPS):
+        up, down = list(parameters), list(parameters)
+        up[i] += step
+        down[i] -= step
+        expected.append((fixed_subgraph_loss(points, up, subgraph_index)
+                         - fixed_subgraph_loss(points, down, subgraph_index)) / (2 * step))
+
+    grad = gradient(points, edges, parameters, graph_index)
+    np.testing.assert_allclose(grad, expected, rtol=1e-3, atol=1e-9)
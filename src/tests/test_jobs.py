@@ -0,0 +1,86 @@
+import os
+import time
+
+import pytest
+
+from libstrava.jobs import JobQueue, QueueFull, JobQueueClient, serve_job_queue
+
+"""a job: doubles x after sleeping for seconds, or kills its worker when x is "die" """
+def run(x, seconds=0.0):
+    if x == "die":
+        os._exit(1)
+    time.sleep(seconds)
+    return x * 2
+
+@pytest.fixture
+def queue():
+    queue = JobQueue(run, processes=1, max_pending=2)
+    yield queue
+    queue.shutdown()
+
+def test_runs_jobs(queue):
+    job = queue.submit("a", 21)
+    assert job.wait(10)
+    assert (job.status, job.result, job.error) == ("done", 42, None)
+    assert queue.get(job.id) is job
+    assert queue.get("no such job") is None
+
+def test_coalesces_pending_and_finished_jobs(queue):
+    job = queue.submit("a", 1, 0.5)
+    assert queue.submit("a", 1, 0.5) is job
+    job.wait(10)
+    assert queue.submit("a", 1, 0.5) is job
+    assert queue.stats()["submitted"] == 1 and queue.stats()["coalesced"] == 2
+
+def test_refuses_past_max_pending(queue):
+    running = queue.submit("a", 1, 0.5)
+    queue.submit("b", 2, 0.5)
+    with pytest.raises(QueueFull):
+        queue.submit("c", 3)
+    assert queue.stats()["refused"] == 1 and queue.stats()["pending"] == 2
+    assert queue.submit("a", 1) is running # a coalesced submission isn't refused
+    running.wait(10)
+    queue.get(queue.submit("c", 3).id).wait(10)
+
+def test_forgets_the_oldest_finished_jobs():
+    queue = JobQueue(run, processes=1, keep_finished=2)
+    jobs = [queue.submit(key, 1) for key in "abc"]
+    for job in jobs:
+        job.wait(10)
+    time.sleep(0.1) # the done callbacks run just after the waits return
+    assert queue.get(jobs[0].id) is None and queue.get(jobs[2].id) is jobs[2]
+    assert queue.submit("a", 1) is not jobs[0]
+    queue.shutdown()
+
+def test_recovers_from_a_dead_worker(queue):
+    dead = queue.submit("die", "die")
+    dead.wait(10)
+    assert dead.status == "failed"
+    job = queue.submit("a", 21)
+    assert job.wait(10) and job.result == 42
+    assert queue.stats()["restarts"] == 1
+    assert queue.submit("die", 1) is not dead # failed jobs don't coalesce
+
+@pytest.fixture
+def served():
+    manager = serve_job_queue(run, processes=1, max_pending=2)
+    yield manager
+    manager.shutdown()
+
+def test_clients_share_a_served_queue(served):
+    first, second = JobQueueClient(served.address), JobQueueClient(served.address)
+    job = first.submit("a", 21)
+    assert job.wait(10)
+    assert (job.status, job.result, job.error) == ("done", 42, None)
+    # the other client sees the same job, and coalesces onto it
+    assert second.get(job.id).result == 42
+    assert second.submit("a", 21).id == job.id
+    assert second.get("no such job") is None
+    assert first.stats()["submitted"] == 1 and second.stats()["coalesced"] == 1
+
+def test_served_queue_refuses_past_max_pending(served):
+    client = JobQueueClient(served.address)
+    client.submit("a", 1, 0.5)
+    client.submit("b", 2, 0.5)
+    with pytest.raises(QueueFull):
+        client.submit("c", 3)
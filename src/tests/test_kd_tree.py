@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from libstrava.kd_tree import KDTree
+
+"""the index of, and distance to, the closest of points for every query, comparing every pair"""
+def brute_closest(points, queries):
+    dist = np.linalg.norm(queries[:, None, :] - points[None, :, :], axis=2)
+    return dist.argmin(axis=1), dist.min(axis=1)
+
+@pytest.mark.parametrize("count", [1, 7, 100, 2000])
+def test_closest_points_match_brute_force(count):
+    rng = np.random.default_rng(count)
+    points = rng.random((count, 2))
+    queries = rng.random((500, 2)) * 1.4 - 0.2 # some off the points' box
+    tree = KDTree(points)
+    indices, distances = tree.closest_points(queries)
+    _, expected = brute_closest(points, queries)
+    np.testing.assert_allclose(distances, expected)
+    np.testing.assert_allclose(np.linalg.norm(points[indices] - queries, axis=1), expected)
+
+def test_closest_point_matches_brute_force():
+    rng = np.random.default_rng(0)
+    points = rng.random((300, 2))
+    tree = KDTree(points)
+    for query in rng.random((50, 2)):
+        index, _ = brute_closest(points, query[None])
+        assert tree.closest_point(query) == tuple(points[index[0]].tolist())
+
+def test_duplicate_points():
+    points = np.repeat(np.random.default_rng(1).random((20, 2)), 5, axis=0)
+    indices, distances = KDTree(points).closest_points(points)
+    np.testing.assert_array_equal(distances, 0)
+    np.testing.assert_array_equal(points[indices], points)
+
+def test_query_radius_matches_brute_force():
+    rng = np.random.default_rng(2)
+    points = rng.random((500, 2))
+    targets = rng.random((40, 2))
+    tree = KDTree(points)
+    query_ids, point_ids = tree.query_radius_pairs(targets, 0.1)
+    pairs = set(zip(query_ids.tolist(), point_ids.tolist()))
+    dist = np.linalg.norm(targets[:, None, :] - points[None, :, :], axis=2)
+    assert pairs == set(zip(*map(np.ndarray.tolist, np.nonzero(dist <= 0.1))))
+    for i, target in enumerate(targets):
+        found = [tuple(point.tolist()) for point in tree.query_radius(target, 0.1)]
+        assert sorted(found) == sorted(map(tuple, points[dist[i] <= 0.1].tolist()))
+
+def test_arrays_round_trip():
+    rng = np.random.default_rng(3)
+    tree = KDTree(rng.random((1000, 2)))
+    queries = rng.random((200, 2))
+    rebuilt = KDTree.from_arrays(tree.to_arrays())
+    for expected, found in zip(tree.closest_points(queries), rebuilt.closest_points(queries)):
+        np.testing.assert_array_equal(found, expected)
+
+def test_empty_tree():
+    tree = KDTree([])
+    indices, distances = tree.closest_points([(0.5, 0.5)])
+    assert indices.tolist() == [-1] and distances.tolist() == [np.inf]
+    assert tree.closest_point((0.5, 0.5)) is None
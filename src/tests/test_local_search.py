@@ -0,0 +1,60 @@
+import contextlib
+import io
+import pathlib
+
+import numpy as np
+import pytest
+
+from libstrava import get_map_context
+from libstrava.graphs import (glue, split_at_critical_vertices, get_embedding, get_embedding_params,
+                              local_search, search_loss, get_subgraph)
+
+MAP_FILE = str(pathlib.Path(__file__).parent.parent.parent / "data" / "edge_list.txt")
+DRAWING = [[(0, 0), (0.2, 0.1), (0.5, 0.5), (0.8, 0.6), (1, 1)],
+           [(0, 1), (0.5, 0.5), (1, 0)],
+           [(0.1, 0.9), (0.3, 0.95), (0.2, 0.7), (0.1, 0.9)]]
+
+"""a random starting embedding of DRAWING, as (pieces, embeddings, params)"""
+def start(context, seed):
+    with contextlib.redirect_stdout(io.StringIO()):
+        critical_vertices, pieces = split_at_critical_vertices(glue(DRAWING))
+    params = get_embedding_params(np.random.default_rng(seed))
+    embeddings = dict(zip(critical_vertices, get_embedding(context.vertex_tree, critical_vertices, params)))
+    return pieces, embeddings, params
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_local_search_never_makes_the_loss_worse(seed):
+    context = get_map_context(MAP_FILE, watch=False)
+    pieces, embeddings, params = start(context, seed)
+    start_loss = search_loss(pieces, embeddings, embeddings, params, context, context.vertex_tree)
+    _, _, loss = local_search(pieces, embeddings, params, context, context.vertex_tree, 0.5, seed)
+    assert loss <= start_loss
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_local_search_loss_matches_a_full_recompute(seed):
+    context = get_map_context(MAP_FILE, watch=False)
+    pieces, embeddings, params = start(context, seed)
+    best, drawn, loss = local_search(pieces, embeddings, params, context, context.vertex_tree, 0.5, seed)
+    assert best != embeddings # it did move something, or there'd be nothing to check
+    assert loss == pytest.approx(search_loss(pieces, best, embeddings, params, context, context.vertex_tree))
+    assert sum(1 for path in drawn if path) > 0
+
+def test_local_search_by_moves_replays_from_its_seed():
+    context = get_map_context(MAP_FILE, watch=False)
+    pieces, embeddings, params = start(context, 2)
+    runs = [local_search(pieces, embeddings, params, context, context.vertex_tree, None, 5, max_moves=300)
+            for _ in range(2)]
+    assert runs[0] == runs[1]
+
+def test_local_search_needs_somewhere_to_stop():
+    context = get_map_context(MAP_FILE, watch=False)
+    pieces, embeddings, params = start(context, 0)
+    with pytest.raises(ValueError):
+        local_search(pieces, embeddings, params, context, context.vertex_tree, None)
+
+def test_seeded_drawing_without_budgets_replays():
+    context = get_map_context(MAP_FILE, watch=False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        routes = [get_subgraph(context, context.vertex_tree, DRAWING, candidates=8, local_search_moves=200, seed=4)
+                  for _ in range(2)]
+    assert routes[0] == routes[1]
@@ -0,0 +1,37 @@
+import os
+import pathlib
+
+import numpy as np
+
+from libstrava.csr_graph import CSRGraph
+from libstrava.edges import read_edges
+from libstrava.kd_tree import KDTree
+from libstrava.map_file import save_map, load_map, compile_map, is_current
+from libstrava.routing import Landmarks
+from libstrava.segment_index import SegmentIndex
+
+MAP_FILE = str(pathlib.Path(__file__).parent.parent.parent / "data" / "edge_list.txt")
+EDGES = read_edges(MAP_FILE)
+
+def test_map_file_round_trip(tmp_path):
+    csr = CSRGraph.from_edges(EDGES)
+    parts = (csr, KDTree(csr.coords), SegmentIndex(EDGES), Landmarks.build(csr))
+    save_map(str(tmp_path / "edges.map"), *parts)
+    for part, loaded in zip(parts, load_map(str(tmp_path / "edges.map"))):
+        assert type(loaded) is type(part)
+        for name, array in part.to_arrays().items():
+            np.testing.assert_array_equal(loaded.to_arrays()[name], array)
+
+    queries = np.random.default_rng(0).random((100, 2)) * 0.01 + csr.coords.min(axis=0)
+    loaded_csr, loaded_tree, loaded_index, _ = load_map(str(tmp_path / "edges.map"))
+    assert loaded_csr.to_dict() == csr.to_dict()
+    np.testing.assert_array_equal(loaded_tree.closest_points(queries)[0], parts[1].closest_points(queries)[0])
+    np.testing.assert_array_equal(loaded_index.nearest(queries)[0], parts[2].nearest(queries)[0])
+
+def test_compiled_map_tracks_its_source(tmp_path):
+    source = tmp_path / "edges.txt"
+    CSRGraph.from_edges(EDGES).write(source)
+    directory = compile_map(str(source))
+    assert is_current(directory, str(source))
+    os.utime(source, (0, source.stat().st_mtime + 1))
+    assert not is_current(directory, str(source))
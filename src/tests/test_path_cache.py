@@ -0,0 +1,51 @@
+import pytest
+
+from libstrava.path_cache import PathCache, entry_bytes, MAX_ENTRY_FRACTION
+
+"""a route value of count vertex ids"""
+def route(count):
+    return list(range(count))
+
+def test_stays_within_its_bytes():
+    cache = PathCache(max_bytes=100 * entry_bytes(route(10)))
+    for i in range(1000):
+        cache.put(("route", i, i + 1), route(10))
+        assert cache.bytes <= cache.max_bytes
+    assert len(cache) == 100
+    assert cache.bytes == sum(entry_bytes(value) for value, _ in cache.entries.values())
+    assert cache.stats()["evictions"] == 900
+
+def test_evicts_least_recently_used():
+    cache = PathCache(max_bytes=100 * entry_bytes(route(10)))
+    for i in range(100):
+        cache.put(("route", i, i), route(10))
+    assert cache.get(("route", 0, 0)) == route(10) # 1 is now the least recently used
+    cache.put(("route", 100, 100), route(10))
+    assert ("route", 1, 1) not in cache
+    assert all(("route", i, i) in cache for i in [0] + list(range(2, 101)))
+
+def test_skips_values_too_big():
+    cache = PathCache(max_bytes=64 * entry_bytes(route(10)))
+    big = route(int(cache.max_bytes * MAX_ENTRY_FRACTION)) # more than MAX_ENTRY_FRACTION with the entry overhead
+    cache.put(("route", 0, 1), big)
+    assert ("route", 0, 1) not in cache
+    assert cache.stats()["too_big"] == 1
+    assert cache.bytes == 0
+
+def test_replacing_a_key_keeps_the_count():
+    cache = PathCache(max_bytes=100 * entry_bytes(route(10)))
+    cache.put(("route", 0, 1), route(10))
+    cache.put(("route", 0, 1), route(5))
+    assert len(cache) == 1
+    assert cache.bytes == entry_bytes(route(5))
+
+def test_get_or_compute_counts_hits_and_misses():
+    cache = PathCache()
+    calls = []
+    compute = lambda: calls.append(1) or route(3)
+    assert cache.get_or_compute(("route", 0, 1), compute) == route(3)
+    assert cache.get_or_compute(("route", 0, 1), compute) == route(3)
+    assert len(calls) == 1
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+    assert stats["hit_ratio"] == pytest.approx(0.5)
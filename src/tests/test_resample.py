@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from libstrava.segment import resample
+
+"""num_points samples evenly spaced by arc length along path, interpolating each coordinate with np.interp"""
+def interp_samples(path, num_points):
+    path = np.asarray(path, dtype=float)
+    arc = np.concatenate(([0.0], np.cumsum(np.linalg.norm(np.diff(path, axis=0), axis=1))))
+    targets = np.linspace(0, arc[-1], num_points)
+    return np.stack((np.interp(targets, arc, path[:, 0]), np.interp(targets, arc, path[:, 1])), axis=1)
+
+@pytest.mark.parametrize("num_points", [2, 7, 50])
+def test_matches_interp(num_points):
+    rng = np.random.default_rng(num_points)
+    paths = [rng.random((count, 2)) for count in (2, 3, 10, 40)]
+    samples, _, path_ids = resample(paths, num_points)
+    assert path_ids.tolist() == np.repeat(np.arange(len(paths)), num_points).tolist()
+    for i, path in enumerate(paths):
+        np.testing.assert_allclose(samples[path_ids == i], interp_samples(path, num_points), atol=1e-12)
+
+def test_sample_vectors_point_back_along_their_edge():
+    path = [(0, 0), (1, 0), (1, 2)]
+    samples, sample_vecs, _ = resample([path], 5) # at arc lengths 0, 0.75, 1.5, 2.25, 3
+    np.testing.assert_allclose(samples, [(0, 0), (0.75, 0), (1, 0.5), (1, 1.25), (1, 2)])
+    np.testing.assert_allclose(sample_vecs, [(-1, 0), (-1, 0), (0, -2), (0, -2), (0, -2)])
+
+def test_zero_length_edges_and_paths():
+    paths = [[(0, 0), (0, 0), (1, 0), (1, 0), (1, 1)], # repeated points
+             [(5, 5), (5, 5)], # no length at all, no samples
+             [(2, 2)]]
+    samples, _, path_ids = resample(paths, 9)
+    assert path_ids.tolist() == [0] * 9
+    np.testing.assert_allclose(samples, interp_samples([(0, 0), (1, 0), (1, 1)], 9), atol=1e-12)
@@ -0,0 +1,57 @@
+import os
+
+from libstrava.result_cache import ResultCache, result_key
+
+"""a compute function returning result that records each call in calls"""
+def computing(result, calls):
+    return lambda: calls.append(result) or result
+
+def test_key_ignores_formatting():
+    assert result_key("v2", [(0, 1)], {"a": 1, "b": 2}) == result_key("v2", [[0, 1]], {"b": 2, "a": 1})
+    assert result_key("v2", [(0, 1)], 1) != result_key("v2", [(0, 1)], 2)
+
+def test_memory_tier_keeps_the_most_recent():
+    cache, calls = ResultCache(maxsize=2), []
+    cache.get_or_compute("a", computing("A", calls))
+    cache.get_or_compute("b", computing("B", calls))
+    cache.get_or_compute("a", computing("A", calls)) # b is now the least recently used
+    cache.get_or_compute("c", computing("C", calls))
+    assert cache.get_or_compute("a", computing("A", calls)) == "A"
+    assert cache.get_or_compute("b", computing("B", calls)) == "B"
+    assert calls == ["A", "B", "C", "B"]
+    stats = cache.stats()
+    assert (stats["memory_hits"], stats["misses"], stats["size"]) == (2, 4, 2)
+
+def test_disk_tier_outlives_the_process(tmp_path):
+    calls = []
+    ResultCache(directory=str(tmp_path)).get_or_compute("a", computing("A", calls))
+    restarted = ResultCache(directory=str(tmp_path)) # a new process, with nothing in memory
+    assert restarted.get_or_compute("a", computing("A", calls)) == "A"
+    assert calls == ["A"]
+    assert restarted.stats()["disk_hits"] == 1
+    assert restarted.get_or_compute("a", computing("A", calls)) == "A"
+    assert restarted.stats()["memory_hits"] == 1
+
+def test_disk_tier_is_shared_between_processes(tmp_path):
+    first, second, calls = ResultCache(directory=str(tmp_path)), ResultCache(directory=str(tmp_path)), []
+    first.get_or_compute("a", computing("A", calls))
+    assert second.get_or_compute("a", computing("A", calls)) == "A"
+    assert calls == ["A"]
+
+def test_disk_tier_stays_within_its_bytes(tmp_path):
+    result = "x" * 1000
+    size = len('{"result": "", "seconds": 0.0}') + len(result) # about one file's bytes
+    cache = ResultCache(maxsize=1, directory=str(tmp_path), max_bytes=5 * size)
+    for i in range(20):
+        cache.get_or_compute(f"key{i}", lambda: result)
+        assert sum(entry.stat().st_size for entry in os.scandir(tmp_path)) <= cache.max_bytes
+    assert cache.stats()["disk_files"] == len(os.listdir(tmp_path)) < 20
+    assert os.path.exists(tmp_path / "key19.json") # the newest stays
+
+def test_disk_tier_counts_other_processes_files(tmp_path):
+    result = "x" * 1000
+    first = ResultCache(maxsize=1, directory=str(tmp_path), max_bytes=10_000)
+    second = ResultCache(maxsize=1, directory=str(tmp_path), max_bytes=10_000)
+    for i in range(20):
+        (first if i % 2 else second).get_or_compute(f"key{i}", lambda: result)
+    assert sum(entry.stat().st_size for entry in os.scandir(tmp_path)) <= 10_000
@@ -0,0 +1,107 @@
+import heapq
+import math
+import pathlib
+
+import numpy as np
+import pytest
+
+from libstrava.csr_graph import CSRGraph
+from libstrava.edges import read_edges
+from libstrava.routing import Router, Landmarks
+
+MAP_FILE = str(pathlib.Path(__file__).parent.parent.parent / "data" / "edge_list.txt")
+# the map, plus a triangle off on its own so some pairs are unconnected
+EDGES = read_edges(MAP_FILE) + [((0.0, 0.0), (0.0, 0.001)), ((0.0, 0.001), (0.001, 0.0)), ((0.001, 0.0), (0.0, 0.0))]
+
+@pytest.fixture(scope="module")
+def csr():
+    return CSRGraph.from_edges(EDGES)
+
+"""plain Dijkstra from start over csr's dict graph, edges weighted by their length, keyed on vertex id"""
+def dijkstra(csr, start):
+    graph = csr.to_dict()
+    points = csr.points
+    dist = {points[start]: 0.0}
+    open_set = [(0.0, points[start])]
+    while open_set:
+        base, current = heapq.heappop(open_set)
+        if base > dist[current]:
+            continue
+        for neighbor in graph[current]:
+            tentative = base + math.dist(current, neighbor)
+            if tentative < dist.get(neighbor, math.inf):
+                dist[neighbor] = tentative
+                heapq.heappush(open_set, (tentative, neighbor))
+    return [dist.get(point, math.inf) for point in points]
+
+"""the length of a vertex id path, checking each step is an edge of csr"""
+def path_length(csr, path):
+    for a, b in zip(path, path[1:]):
+        assert b in csr.neighbors_of(a)
+    return sum(math.dist(csr.points[a], csr.points[b]) for a, b in zip(path, path[1:]))
+
+"""pairs of vertex ids to route between, from a few starts so pairs share them"""
+def queries(csr, seed, count=60):
+    rng = np.random.default_rng(seed)
+    starts = rng.integers(csr.num_vertices, size=count // 4)
+    return [(int(rng.choice(starts)), int(rng.integers(csr.num_vertices))) for _ in range(count)]
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_distances_from_match_dijkstra(csr, seed):
+    start = int(np.random.default_rng(seed).integers(csr.num_vertices))
+    np.testing.assert_allclose(Router(csr).distances_from(start), dijkstra(csr, start))
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_shortest_paths_match_dijkstra(csr, seed):
+    router = Router(csr)
+    for start, goal in queries(csr, seed):
+        expected = dijkstra(csr, start)[goal]
+        path = router.shortest_path(start, goal)
+        if expected == math.inf:
+            assert path is None
+            assert router.distance(start, goal) == math.inf
+        else:
+            assert (path[0], path[-1]) == (start, goal)
+            assert path_length(csr, path) == pytest.approx(expected)
+            assert router.distance(start, goal) == pytest.approx(expected)
+
+def test_batched_paths_match_single_ones(csr):
+    router = Router(csr)
+    pairs = queries(csr, 2)
+    for (start, goal), path in zip(pairs, router.shortest_paths(pairs)):
+        single = router.shortest_path(start, goal)
+        if single is None:
+            assert path is None
+        else:
+            assert path_length(csr, path) == pytest.approx(path_length(csr, single))
+
+def test_unconnected_pair(csr):
+    router = Router(csr)
+    island, mainland = csr.vertex_id((0.0, 0.0)), csr.vertex_id(EDGES[0][0])
+    assert router.shortest_path(mainland, island) is None
+    assert router.distance(island, mainland) == math.inf
+    assert router.shortest_paths_from(mainland, [island])[island] is None
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_landmark_routes_match_dijkstra(csr, seed):
+    router = Router(csr, Landmarks.build(csr))
+    for start, goal in queries(csr, seed):
+        expected = dijkstra(csr, start)[goal]
+        assert router.distance(start, goal) == pytest.approx(expected)
+        if expected != math.inf:
+            assert path_length(csr, router.shortest_path(start, goal)) == pytest.approx(expected)
+
+def test_landmark_bounds_never_overestimate(csr):
+    router = Router(csr, Landmarks.build(csr))
+    rng = np.random.default_rng(3)
+    for start in rng.integers(csr.num_vertices, size=5).tolist():
+        expected = dijkstra(csr, start)
+        for goal in rng.integers(csr.num_vertices, size=50).tolist():
+            assert router.lower_bound(start, goal) <= expected[goal] + 1e-12
+
+def test_landmarks_stay_off_islands(csr):
+    landmarks = Landmarks.build(csr)
+    island = csr.vertex_id((0.0, 0.0))
+    assert island not in landmarks.vertices.tolist()
+    # so the tables tell the island apart from the rest of the map without searching
+    assert Router(csr, landmarks).lower_bound(csr.vertex_id(EDGES[0][0]), island) == math.inf
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from libstrava.segment_index import SegmentIndex, closest_on_segments
+
+"""distance from every point to its closest edge, comparing every pair"""
+def brute_distances(edges, points):
+    starts, ends = edges[:, 0], edges[:, 1]
+    probes = np.repeat(points, len(edges), axis=0)
+    closest = closest_on_segments(probes, np.tile(starts, (len(points), 1)), np.tile(ends, (len(points), 1)))
+    return np.linalg.norm(probes - closest, axis=1).reshape(len(points), len(edges)).min(axis=1)
+
+"""count short edges, like a street map's, some of zero length"""
+def random_edges(rng, count):
+    starts = rng.random((count, 2))
+    ends = starts + rng.normal(0, 0.02, (count, 2))
+    ends[::17] = starts[::17]
+    return np.stack((starts, ends), axis=1)
+
+@pytest.mark.parametrize("count", [5, 40, 2000])
+def test_nearest_matches_brute_force(count):
+    rng = np.random.default_rng(count)
+    edges = random_edges(rng, count)
+    points = np.concatenate((rng.random((300, 2)), # on the grid
+                             rng.random((100, 2)) * 6 - 2.5)) # mostly off it
+    index = SegmentIndex(edges)
+    edge_ids, distances = index.nearest(points)
+    expected = brute_distances(edges, points)
+    np.testing.assert_allclose(distances, expected, atol=1e-12)
+    projected = index.project(points, edge_ids)
+    np.testing.assert_allclose(np.linalg.norm(points - projected, axis=1), expected, atol=1e-12)
+
+def test_lists_and_arrays_index_alike():
+    rng = np.random.default_rng(0)
+    edges = random_edges(rng, 500)
+    listed = [(tuple(a), tuple(b)) for a, b in edges.tolist()]
+    points = rng.random((200, 2))
+    from_list, from_array = SegmentIndex(listed), SegmentIndex(edges)
+    assert from_array.edges == listed
+    for expected, found in zip(from_list.nearest(points), from_array.nearest(points)):
+        np.testing.assert_array_equal(found, expected)
+
+def test_arrays_round_trip():
+    rng = np.random.default_rng(1)
+    index = SegmentIndex(random_edges(rng, 1000))
+    points = rng.random((300, 2))
+    rebuilt = SegmentIndex.from_arrays(index.to_arrays())
+    assert rebuilt.edges == index.edges
+    for expected, found in zip(index.nearest(points), rebuilt.nearest(points)):
+        np.testing.assert_array_equal(found, expected)
+
+def test_subset():
+    rng = np.random.default_rng(2)
+    edges = random_edges(rng, 300)
+    keep = np.arange(0, 300, 3)
+    points = rng.random((100, 2))
+    _, distances = SegmentIndex(edges).subset(keep).nearest(points)
+    np.testing.assert_allclose(distances, brute_distances(edges[keep], points), atol=1e-12)
+
+def test_empty_index():
+    edge_ids, distances = SegmentIndex([]).nearest([(0.5, 0.5)])
+    assert edge_ids.tolist() == [-1] and distances.tolist() == [np.inf]
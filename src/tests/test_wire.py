@@ -0,0 +1,55 @@
+import json
+
+import numpy as np
+import pytest
+
+from libstrava.wire import pack_drawing, unpack_drawing, pack_edges, unpack_edges, drawing_from_json, \
+                           edges_to_json, as_point_lists, read_in_data_new_api, write_points
+
+DRAWING = [[(0.1, 0.2), (0.3, 0.4), (0.5, 0.25)], [(0.9, 0.9)], [(0.0, 1.0), (1.0, 0.0)]]
+EDGES = [((41.8, -71.4), (41.81, -71.41)), ((41.81, -71.41), (41.805, -71.39))]
+
+@pytest.mark.parametrize("code", [b"f", b"d"])
+def test_drawing_round_trip(code):
+    paths, unpacked_code = unpack_drawing(pack_drawing(DRAWING, code))
+    assert unpacked_code == code
+    assert [len(path) for path in paths] == [len(path) for path in DRAWING]
+    for path, expected in zip(paths, DRAWING):
+        assert path.dtype.itemsize == (4 if code == b"f" else 8)
+        np.testing.assert_allclose(path, expected, rtol=1e-6)
+
+def test_double_drawing_is_exact():
+    paths, _ = unpack_drawing(pack_drawing(DRAWING))
+    assert as_point_lists(paths) == DRAWING
+
+def test_empty_drawing():
+    assert unpack_drawing(pack_drawing([]))[0] == []
+
+@pytest.mark.parametrize("code", [b"f", b"d"])
+def test_edges_round_trip(code):
+    edges = unpack_edges(pack_edges(EDGES, code))
+    np.testing.assert_allclose(edges, [[*a, *b] for a, b in EDGES], rtol=1e-6)
+
+@pytest.mark.parametrize("data", [b"", b"XX\x01d\x00\x00\x00\x00", b"FR\x02d\x00\x00\x00\x00",
+                                  b"FR\x01q\x00\x00\x00\x00", pack_drawing(DRAWING)[:-1]])
+def test_bad_packed_drawings(data):
+    with pytest.raises(ValueError):
+        unpack_drawing(data)
+
+def test_non_finite_drawing():
+    with pytest.raises(ValueError):
+        unpack_drawing(pack_drawing([[(0.0, np.nan)]]))
+
+def test_json_round_trip():
+    body = {"paths": [[coord for point in path for coord in point] for path in DRAWING]}
+    assert as_point_lists(drawing_from_json(json.loads(json.dumps(body)))) == DRAWING
+    assert json.loads(edges_to_json(EDGES)) == {"edges": [coord for a, b in EDGES for coord in (*a, *b)]}
+
+@pytest.mark.parametrize("body", [[], {"paths": 1}, {"paths": [[0.0, 1.0, 2.0]]}, {"paths": [["a", "b"]]}])
+def test_bad_json_drawings(body):
+    with pytest.raises(ValueError):
+        drawing_from_json(body)
+
+def test_text_round_trip():
+    text = "".join(write_points(path) for path in DRAWING)
+    assert read_in_data_new_api(iter(text.splitlines())) == DRAWING
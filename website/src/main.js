@@ -9,5 +9,6 @@ const app = createApp(App)
 // app.use(VueCookies, { expires: '7d'})
 app.config.globalProperties.$hostv1 = `https://sky.jason.cash:8080/api/v1`
 app.config.globalProperties.$hostv2 = `https://sky.jason.cash:8080/api/v2`
+app.config.globalProperties.$hostv2stream = `https://sky.jason.cash:8080/api/v2/stream`
 
 app.mount('#app')